@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+"""
+WaterAccounting benchmarks, run with asv
+"""
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+**Products**
+
+`Description`
+
+Benchmarks of the offline stages of the products, decode, clip and write,
+on synthetic global inputs with the real shapes.
+
+The inputs are created once by ``setup_cache``, each timing copies the
+input files it consumes, so ``number = 1``.
+The ``time_file`` benchmarks run the whole per-date function of a product,
+from the transfer to the output, against the stand-in servers of the tests.
+
+**Examples:**
+::
+
+    asv run --bench products
+    asv continuous master HEAD --bench products
+"""
+import os
+import sys
+import shutil
+import tempfile
+
+import pandas as pd
+
+from wateraccounting.Collect.download import Download
+from wateraccounting.Collect.products import ALEXI, ASCAT, CFSR, CHIRPS, CMRSET, DEM
+from wateraccounting.Collect.transform import Transform
+
+from . import synthetic
+
+# Stand-in servers of the tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'tests'))
+from servers import Server, populate  # noqa: E402
+
+
+class Product(object):
+    """Base of the product benchmarks
+    """
+    number = 1
+    repeat = 5
+    timeout = 600
+
+    def setup(self, files):
+        self.folder = tempfile.mkdtemp()
+        self.download = Download('', '', is_status=False)
+
+    def teardown(self, files):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def copy(self, file):
+        return shutil.copy(file, self.folder)
+
+
+class Served(Product):
+    """Base of the product benchmarks with a stand-in server
+
+    ``serve`` lays out the remote files under ``self.root``,
+    ``env`` points the product at the server.
+    """
+    kind = 'ftp'
+    env = ''
+
+    def setup(self, files):
+        Product.setup(self, files)
+        self.root = os.path.join(self.folder, self.kind)
+        self.output = os.path.join(self.folder, 'output')
+        os.makedirs(self.root)
+        os.makedirs(self.output)
+        self.serve(files)
+        self.server = Server(self.root, self.kind).start()
+        os.environ[self.env] = self.server.url
+
+    def teardown(self, files):
+        self.server.stop()
+        os.environ.pop(self.env, None)
+        Product.teardown(self, files)
+
+    def serve(self, files):
+        pass
+
+    @staticmethod
+    def check(task):
+        """A failed date is a failed benchmark
+        """
+        if task.get('error') is not None:
+            raise task['error']
+
+
+class CHIRPSDaily(Product):
+    """CHIRPS daily, 7200x2000 tif.gz
+    """
+
+    def setup_cache(self):
+        return synthetic.chirps_tif_gz(os.getcwd())
+
+    def setup(self, files):
+        Product.setup(self, files)
+        grid, yID, xID, geo = synthetic.get_grid(
+            'CHIRPS', 'Precipitation', 'v2', 'daily', 'P')
+        self.task = {
+            'Date': pd.Timestamp('2003-01-01'),
+            'args': [self.download, self.folder, 'daily', xID, yID, geo],
+            'file': self.copy(files)
+        }
+        self.data = synthetic.get_rain((yID[1] - yID[0], xID[1] - xID[0]))
+
+    def time_decode(self, files):
+        CHIRPS.Decode_data(self.task)
+
+    def time_save(self, files):
+        CHIRPS.Save_data(dict(self.task, data=self.data))
+
+
+class ALEXIDaily(Served):
+    """ALEXI daily, 3000x7200 '<f4' dat.gz
+    """
+    env = 'WA_URL_ALEXI'
+    date = pd.Timestamp('2005-01-01')
+
+    def setup_cache(self):
+        return synthetic.alexi_dat_gz(os.getcwd())
+
+    def serve(self, files):
+        populate(self.root, 'ALEXI', 'Evaporation', 'v1', 'daily', [self.date],
+                 files)
+
+    def setup(self, files):
+        Served.setup(self, files)
+        grid, self.yID, self.xID, self.geo = synthetic.get_grid(
+            'ALEXI', 'Evaporation', 'v1', 'daily', 'ETa')
+        self.data = ALEXI.Decode_ALEXI_daily(files, self.yID, self.xID)
+        self.args = [Download('', 'FTP_WA', is_status=False), self.output,
+                     self.yID, self.xID, self.geo, 'daily']
+
+    def time_decode(self, files):
+        ALEXI.Decode_ALEXI_daily(files, self.yID, self.xID)
+
+    def time_save(self, files):
+        self.download.save_tif(os.path.join(self.folder, 'ETa.tif'), self.data,
+                               self.geo, "WGS84")
+
+    def time_file(self, files):
+        self.check(ALEXI.ALEXI_daily_file(self.date, self.args))
+
+
+class ASCATDaily(Served):
+    """ASCAT SWI daily, (1, 1800, 3600) NetCDF
+    """
+    kind = 'http'
+    env = 'WA_URL_ASCAT'
+    date = pd.Timestamp('2007-01-01')
+
+    def setup_cache(self):
+        return synthetic.ascat_nc(os.getcwd())
+
+    def serve(self, files):
+        # the layout of Download_ASCAT_from_VITO
+        folder = os.path.join(self.root, 'Vegetation', 'Soil_Water', 'SWI_V3',
+                              '2007', '1', '1', 'SWI_200701011200_GLOBE_ASCAT_V3.1.1')
+        os.makedirs(folder)
+        shutil.copy(files, folder)
+
+    def setup(self, files):
+        Served.setup(self, files)
+        grid, self.yID, self.xID, self.geo = synthetic.get_grid(
+            'ASCAT', 'SoilWaterIndex', 'v3', 'daily', 'SWI_010')
+        self.data = ASCAT.Decode_ASCAT(files, self.yID, self.xID)
+        temp = os.path.join(self.output, 'Temp')
+        os.makedirs(temp)
+        self.args = [Download('', 'Copernicus', is_status=False), self.output,
+                     temp, self.yID, self.xID, self.geo]
+
+    def time_decode(self, files):
+        ASCAT.Decode_ASCAT(files, self.yID, self.xID)
+
+    def time_save(self, files):
+        self.download.save_tif(os.path.join(self.folder, 'SWI.tif'), self.data,
+                               self.geo, "WGS84")
+
+    def time_file(self, files):
+        self.check(ASCAT.ASCAT_daily_file(self.date, self.args))
+
+
+class CMRSETMonthly(Served):
+    """CMRSET monthly, 3600x7200 tif
+    """
+    env = 'WA_URL_CMRSET'
+    date = pd.Timestamp('2003-01-01')
+
+    def setup_cache(self):
+        return synthetic.cmrset_tif(os.getcwd())
+
+    def serve(self, files):
+        populate(self.root, 'CMRSET', 'Evaporation', 'v1', 'monthly', [self.date],
+                 files)
+
+    def setup(self, files):
+        Served.setup(self, files)
+        grid, yID, xID, geo = synthetic.get_grid(
+            'CMRSET', 'Evaporation', 'v1', 'monthly', 'ETa')
+        self.args = [self.download, self.output, yID, xID, geo]
+
+    def time_file(self, files):
+        self.check(CMRSET.CMRSET_monthly_file(self.date, self.args))
+
+
+class CFSRDaily(Product):
+    """CFSRv2 daily, 4 6-hourly grib bands of 880x1760
+    """
+
+    def setup_cache(self):
+        return synthetic.cfsr_grb(os.getcwd(), version=2)
+
+    def setup(self, files):
+        Product.setup(self, files)
+        grid, yID, xID, geo = synthetic.get_grid(
+            'CFSR', 'Radiation', 'v2', 'daily', 'dlwsfc')
+        transform = Transform.from_conf('CFSR', 'Radiation', 'v2', 'daily',
+                                        'dlwsfc')
+        self.window = ([1, 2, 3, 4], grid.shape, yID, xID, transform)
+        self.task = {
+            'Date': pd.Timestamp('2011-01-01'),
+            'args': [self.download, self.folder, {2: (grid.shape, yID, xID, geo)},
+                     'dlwsfc', 2],
+            'data': CFSR.Read_6hourly(self.download, files, *self.window),
+            'geo': geo
+        }
+
+    def time_decode(self, files):
+        CFSR.Read_6hourly(self.download, files, *self.window)
+
+    def time_save(self, files):
+        CFSR.Save_data(dict(self.task))
+
+
+class DEMTiles(Product):
+    """HydroSHEDS 3s, 2x2 clipped 1200x1200 chunks
+    """
+
+    def setup_cache(self):
+        return synthetic.hydroshed_chunks(os.getcwd())
+
+    def time_merge(self, files):
+        names, latlim, lonlim, shape = files
+        DEM.Merge_DEM(latlim, lonlim, names, shape[0], shape[1])
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+**Synthetic**
+
+`Description`
+
+Synthetic global inputs with the real shapes and formats of the products,
+for offline benchmarks of the decode, clip and write stages.
+
+The values are random but deterministic, with the value distribution of
+the product, so the compressed sizes are close to the real files.
+"""
+import os
+import gzip
+
+import numpy as np
+from netCDF4 import Dataset
+
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+from wateraccounting.Collect.grid import Grid
+
+# Window of the benchmarks, a country size area
+latlim = [-10., 30.]
+lonlim = [-20., 10.]
+
+
+def get_grid(product, dataset, version, datatype, variable):
+    """Grid and window of a product variable
+
+    Returns:
+      tuple: (grid, yID, xID, geo).
+    """
+    grid = Grid.from_conf(product, dataset, version, datatype, variable)
+    yID, xID = grid.window(*grid.check_latlon(latlim, lonlim))
+    return grid, yID, xID, grid.window_geo(yID, xID)
+
+
+def get_rain(shape, seed=0):
+    """Rain like data, mostly zeros, float32
+    """
+    rng = np.random.RandomState(seed)
+    data = rng.gamma(0.5, 8., shape).astype(np.float32)
+    data[rng.rand(*shape) < 0.6] = 0.
+    return data
+
+
+def get_field(shape, low, high, seed=0):
+    """Smooth field with noise, float32
+    """
+    rng = np.random.RandomState(seed)
+    y = np.linspace(0., np.pi, shape[0], dtype=np.float32)[:, None]
+    x = np.linspace(0., 2. * np.pi, shape[1], dtype=np.float32)[None, :]
+    data = np.sin(y) * (1. + 0.2 * np.cos(3. * x))
+    data += 0.05 * rng.rand(*shape).astype(np.float32)
+    return (low + (high - low) * data / data.max()).astype(np.float32)
+
+
+def save_tif(file, data, geo, nodata=-9999., options=()):
+    """Save array as Float32 geotiff
+    """
+    driver = gdal.GetDriverByName('GTiff')
+    dst = driver.Create(file, int(data.shape[1]), int(data.shape[0]), 1,
+                        gdal.GDT_Float32, list(options))
+    dst.SetGeoTransform(geo)
+    dst.GetRasterBand(1).SetNoDataValue(nodata)
+    dst.GetRasterBand(1).WriteArray(data)
+    dst = None
+    return file
+
+
+def gzip_file(file, file_gz):
+    """Gzip file, the input file is removed
+    """
+    with open(file, 'rb') as fp_in, gzip.open(file_gz, 'wb') as fp_out:
+        fp_out.write(fp_in.read())
+    os.remove(file)
+    return file_gz
+
+
+def chirps_tif_gz(folder):
+    """CHIRPS daily, 7200x2000 tif.gz
+
+    Returns:
+      str: File.
+    """
+    grid = Grid.from_conf('CHIRPS', 'Precipitation', 'v2', 'daily', 'P')
+    data = get_rain(grid.shape)
+    data[:20, :] = -9999.
+
+    file = os.path.join(folder, 'chirps-v2.0.2003.01.01.tif')
+    save_tif(file, data, grid.geo)
+    return gzip_file(file, file + '.gz')
+
+
+def alexi_dat_gz(folder):
+    """ALEXI daily, 3000x7200 '<f4' dat.gz, south-up, MJ/m2d
+
+    Returns:
+      str: File.
+    """
+    grid = Grid.from_conf('ALEXI', 'Evaporation', 'v1', 'daily', 'ETa')
+    data = np.flipud(get_field(grid.shape, -1., 20.))
+
+    file = os.path.join(folder, 'EDAY_CERES_2005001.dat.gz')
+    with gzip.open(file, 'wb') as fp:
+        fp.write(data.astype('<f4').tobytes())
+    return file
+
+
+def ascat_nc(folder):
+    """ASCAT SWI daily, (1, 1800, 3600) NetCDF, 'SWI_010' in 0.5 %
+
+    Returns:
+      str: File.
+    """
+    grid = Grid.from_conf('ASCAT', 'SoilWaterIndex', 'v3', 'daily', 'SWI_010')
+    data = get_field(grid.shape, 0., 200.)
+    data[get_rain(grid.shape, seed=1) == 0.] = 255.
+
+    file = os.path.join(folder, 'c_gls_SWI_200701011200_GLOBE_ASCAT_V3.1.1.nc')
+    fh = Dataset(file, mode='w')
+    fh.createDimension('time', 1)
+    fh.createDimension('lat', grid.shape[0])
+    fh.createDimension('lon', grid.shape[1])
+    var = fh.createVariable('SWI_010', 'u1', ('time', 'lat', 'lon'), zlib=True)
+    var.set_auto_maskandscale(False)
+    var[0, :, :] = data.astype(np.uint8)
+    fh.close()
+    return file
+
+
+def cmrset_tif(folder):
+    """CMRSET monthly, 3600x7200 tif, mm/d
+
+    Returns:
+      str: File.
+    """
+    grid = Grid.from_conf('CMRSET', 'Evaporation', 'v1', 'monthly', 'ETa')
+    data = get_field(grid.shape, 0., 8.)
+
+    file = os.path.join(folder, 'M01CMRSETGlobalY2003M01.tif')
+    return save_tif(file, data, grid.geo)
+
+
+def cfsr_grb(folder, version=2):
+    """CFSR 6-hourly, the 4 bands of a day, north-up, 0-360 longitude
+
+    The bands are written as a geotiff, GDAL reads them as the GRIB bands.
+
+    Returns:
+      str: File.
+    """
+    grid = Grid.from_conf('CFSR', 'Radiation', 'v%d' % version, 'daily', 'dlwsfc')
+
+    file = os.path.join(folder, 'dlwsfc.gdas.201101.grb2')
+    driver = gdal.GetDriverByName('GTiff')
+    dst = driver.Create(file, int(grid.shape[1]), int(grid.shape[0]), 4,
+                        gdal.GDT_Float32)
+    dst.SetGeoTransform([0., grid.geo[1], 0., grid.geo[3], 0., grid.geo[5]])
+    for i in range(4):
+        dst.GetRasterBand(i + 1).WriteArray(
+            get_field(grid.shape, 150., 450., seed=i))
+    dst = None
+    return file
+
+
+def hydroshed_chunks(folder, resolution=3. / 3600., size=1200):
+    """HydroSHEDS 3s DEM chunks, clipped 1x1 degree parts of 2x2 tiles
+
+    Returns:
+      tuple: (files, latlim, lonlim, shape).
+    """
+    files = []
+    for i, lat in enumerate([11., 10.]):
+        for j, lon in enumerate([20., 21.]):
+            file = os.path.join(folder, 'n%02de%03d_temporary.tif' % (lat - 1, lon))
+            data = get_field((size, size), 0., 3000., seed=2 * i + j)
+            save_tif(file, data, [lon, resolution, 0., lat, 0., -resolution])
+            files.append(file)
+    return files, [9., 11.], [20., 22.], (2 * size, 2 * size)
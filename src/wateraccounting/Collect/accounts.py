@@ -81,6 +81,10 @@ class Accounts(Base):
             },
         }
     }
+    # Last line of the wait bar
+    __bar = {
+        'line': ''
+    }
 
     def __init__(self, workspace, account, is_status, **kwargs):
         """Class instantiation
@@ -376,8 +380,12 @@ class Accounts(Base):
         filled = int(length * i // total)
         bar = fill * filled + '-' * (length - filled)
 
-        sys.stdout.write('\r%s |%s| %s%% %s' % (prefix, bar, percent, suffix))
-        sys.stdout.flush()
+        # Write only when the line changes, not on every iteration
+        line = '\r%s |%s| %s%% %s' % (prefix, bar, percent, suffix)
+        if line != Accounts.__bar['line'] or i == total:
+            Accounts.__bar['line'] = line
+            sys.stdout.write(line)
+            sys.stdout.flush()
 
         if i == total:
             print()
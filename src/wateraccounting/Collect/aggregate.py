@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+**Aggregate**
+
+`Restrictions`
+
+The data and this python file may not be distributed to others without
+permission of the WA+ team.
+
+`Description`
+
+Streaming temporal aggregation of daily product outputs,
+to dekad, monthly and yearly sum, mean and count of valid values.
+
+The daily files are read one by one into running accumulators,
+only the accumulator of the current period is kept in memory.
+The accumulator state of each period is saved next to the outputs,
+so new days update the aggregates incrementally.
+
+**Examples:**
+::
+
+    import glob
+    from wateraccounting.Collect.aggregate import Aggregate
+    aggregate = Aggregate('', is_status=True)
+    aggregate.run(glob.glob('C:/Temp/Precipitation/CHIRPS/Daily/*.tif'),
+                  'C:/Temp/Precipitation/CHIRPS/Monthly_sum',
+                  freq='monthly', stats=('sum', 'count'))
+"""
+import os
+# import sys
+import inspect
+# import shutil
+# import yaml
+
+import re
+import datetime
+
+import numpy as np
+
+try:
+    from .gis import GIS
+except ImportError:
+    from src.wateraccounting.Collect.gis import GIS
+
+
+class Accumulator(object):
+    """This Accumulator class
+
+    Running sum and count of valid values, -9999 aware.
+
+    Args:
+      shape (tuple): Data shape, (rows, cols).
+      nodata (float): Nodata value.
+    """
+
+    def __init__(self, shape, nodata=-9999):
+        """Class instantiation
+        """
+        self.shape = tuple(shape)
+        self.nodata = nodata
+        self.sum = np.zeros(self.shape, dtype=np.float64)
+        self.count = np.zeros(self.shape, dtype=np.int32)
+
+    def add(self, data):
+        """Add data
+
+        Args:
+          data (:obj:`numpy.ndarray`): Data of one time step.
+        """
+        if data.shape != self.shape:
+            raise ValueError('Accumulator requires shape "{s}", received "{t}"'
+                             .format(s=self.shape, t=data.shape))
+
+        valid = np.isfinite(data)
+        valid &= data != self.nodata
+        np.add(self.sum, data, out=self.sum, where=valid)
+        self.count += valid
+
+    def get(self, stat):
+        """Get statistic
+
+        Args:
+          stat (str): 'sum', 'mean' or 'count'.
+
+        Returns:
+          :obj:`numpy.ndarray`: Statistic, float32, nodata where count is 0.
+        """
+        valid = self.count > 0
+        data = np.full(self.shape, self.nodata, dtype=np.float32)
+
+        if stat == 'sum':
+            data[valid] = self.sum[valid]
+        elif stat == 'mean':
+            data[valid] = self.sum[valid] / self.count[valid]
+        elif stat == 'count':
+            data[:] = self.count
+        else:
+            raise ValueError('Unknown stat: {v}'.format(v=stat))
+
+        return data
+
+
+class Aggregate(GIS):
+    """This Aggregate class
+
+    Description
+
+    Args:
+      workspace (str): Directory to accounts.yml.
+      is_status (bool): Is to print status message.
+      kwargs (dict): Other arguments.
+    """
+    __conf = {
+        'path': '',
+        'file': '',
+        'data': {
+            'freqs': ['dekad', 'monthly', 'yearly'],
+            'stats': ['sum', 'mean', 'count'],
+            'pattern': r'(\d{4})\.(\d{2})\.(\d{2})\.tif$',
+            'locfile': '{stat}_{freq}_{Y:>04s}.{m:>02s}.{d:>02s}.tif',
+            'state': '.state'
+        }
+    }
+
+    def __init__(self, workspace='', is_status=True, **kwargs):
+        """Class instantiation
+        """
+        GIS.__init__(self, workspace, is_status, **kwargs)
+
+        self.stmsg = {
+            0: 'S: WA.Aggregate "{f}" status {c}: {m}',
+            1: 'E: WA.Aggregate "{f}" status {c}: {m}',
+            2: 'W: WA.Aggregate "{f}" status {c}: {m}',
+        }
+        self.stcode = 0
+        self.status = 'Aggregate status.'
+
+        if self.stcode == 0:
+            message = ''
+
+        self._status(
+            inspect.currentframe().f_code.co_name,
+            prt=self.is_status,
+            ext=message)
+
+    @staticmethod
+    def get_period(date, freq):
+        """Get period
+
+        Args:
+          date (:obj:`datetime.date`): Date.
+          freq (str): 'dekad', 'monthly' or 'yearly'.
+
+        Returns:
+          :obj:`datetime.date`: First day of the period.
+
+        :Example:
+
+            >>> import datetime
+            >>> from wateraccounting.Collect.aggregate import Aggregate
+            >>> Aggregate.get_period(datetime.date(2003, 1, 25), 'dekad')
+            datetime.date(2003, 1, 21)
+        """
+        if freq == 'dekad':
+            return datetime.date(date.year, date.month,
+                                 min((date.day - 1) // 10, 2) * 10 + 1)
+        elif freq == 'monthly':
+            return datetime.date(date.year, date.month, 1)
+        elif freq == 'yearly':
+            return datetime.date(date.year, 1, 1)
+        else:
+            raise ValueError('Unknown freq: {v}'.format(v=freq))
+
+    @classmethod
+    def get_date(cls, file):
+        """Get date from file name
+
+        Args:
+          file (str): 'C:/file/to/path/P_CHIRPS.v2.0_mm-day-1_daily_2003.01.01.tif'.
+
+        Returns:
+          :obj:`datetime.date`: Date.
+        """
+        match = re.search(cls.__conf['data']['pattern'], os.path.basename(file))
+        if match is None:
+            raise ValueError('Date not found in "{f}".'.format(f=file))
+
+        return datetime.date(*[int(v) for v in match.groups()])
+
+    def run(self, files, output_folder, freq='monthly',
+            stats=('sum', 'mean', 'count'), nodata=-9999):
+        """Aggregate files
+
+        This function streams the daily files through the accumulators,
+        and saves the statistics of each period as geotiff.
+        Days already in the saved state of a period are skipped,
+        periods without new days are not written again.
+
+        Args:
+          files (list): Daily files, the date ``yyyy.mm.dd.tif`` in the name.
+          output_folder (str): Directory of the outputs.
+          freq (str): 'dekad', 'monthly' or 'yearly'.
+          stats (tuple): 'sum', 'mean' and/or 'count'.
+          nodata (float): Nodata value.
+
+        Returns:
+          list: Files written.
+        """
+        if freq not in self.__conf['data']['freqs']:
+            raise ValueError('Unknown freq: {v}'.format(v=freq))
+        for stat in stats:
+            if stat not in self.__conf['data']['stats']:
+                raise ValueError('Unknown stat: {v}'.format(v=stat))
+
+        folder_state = os.path.join(output_folder, self.__conf['data']['state'])
+        if not os.path.exists(folder_state):
+            os.makedirs(folder_state)
+
+        files = sorted((self.get_date(file), file) for file in files)
+
+        results = []
+        period = None
+        state = None
+        for date, file in files:
+            if self.get_period(date, freq) != period:
+                if state is not None and state['new']:
+                    results += self._save(state, output_folder, freq, stats)
+                period = self.get_period(date, freq)
+                state = self._load(folder_state, freq, period, nodata)
+
+            if date.isoformat() in state['dates']:
+                continue
+
+            geo = self.get_tif_geo(file)
+            data = self.get_tif(file, 1)
+
+            if state['accumulator'] is None:
+                state['accumulator'] = Accumulator(data.shape, nodata)
+                state['geo'] = geo
+            elif state['geo'] != geo:
+                raise ValueError('"{f}" grid "{g}" differs from "{s}".'
+                                 .format(f=file, g=geo, s=state['geo']))
+
+            state['accumulator'].add(data)
+            state['dates'].add(date.isoformat())
+            state['new'] = True
+
+        if state is not None and state['new']:
+            results += self._save(state, output_folder, freq, stats)
+
+        self.stcode = 0
+        self._status(
+            inspect.currentframe().f_code.co_name,
+            prt=self.is_status,
+            ext='{n} files written.'.format(n=len(results)))
+
+        return results
+
+    def _load(self, folder, freq, period, nodata):
+        """Load accumulator state of period
+
+        Returns:
+          dict: State.
+        """
+        file = os.path.join(folder, '{freq}_{p}.npz'.format(
+            freq=freq, p=period.strftime('%Y.%m.%d')))
+
+        state = {
+            'file': file,
+            'period': period,
+            'accumulator': None,
+            'geo': None,
+            'dates': set(),
+            'new': False
+        }
+
+        if os.path.exists(file):
+            with np.load(file) as fp:
+                accumulator = Accumulator(fp['sum'].shape, nodata)
+                accumulator.sum[:] = fp['sum']
+                accumulator.count[:] = fp['count']
+                state['accumulator'] = accumulator
+                state['geo'] = fp['geo'].tolist()
+                state['dates'] = set(fp['dates'].tolist())
+
+        return state
+
+    def _save(self, state, output_folder, freq, stats):
+        """Save accumulator state and statistics of period
+
+        Returns:
+          list: Files written.
+        """
+        accumulator = state['accumulator']
+
+        # Write to temporary file first, a killed run keeps the old state
+        file_tmp = '{f}.tmp.npz'.format(f=os.path.splitext(state['file'])[0])
+        np.savez(file_tmp,
+                 sum=accumulator.sum,
+                 count=accumulator.count,
+                 geo=np.array(state['geo']),
+                 dates=np.array(sorted(state['dates'])))
+        os.replace(file_tmp, state['file'])
+
+        results = []
+        for stat in stats:
+            file = os.path.join(output_folder,
+                                self.__conf['data']['locfile'].format(
+                                    stat=stat, freq=freq,
+                                    Y=state['period'].strftime('%Y'),
+                                    m=state['period'].strftime('%m'),
+                                    d=state['period'].strftime('%d')))
+            self.save_tif(file, accumulator.get(stat), state['geo'], "WGS84")
+            results.append(file)
+
+        return results
+
+
+def main():
+    from pprint import pprint
+
+    # Aggregate __init__
+    print('\nAggregate\n=====')
+    aggregate = Aggregate('', is_status=True)
+
+    # Aggregate attributes
+    print('\naggregate._Aggregate__conf\n=====')
+    pprint(aggregate._Aggregate__conf)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,7 +26,26 @@ import inspect
 # import shutil
 # import yaml
 
+import io
 import gzip
+import time
+import queue
+import atexit
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+try:
+    from .base import Base
+except ImportError:
+    from src.wateraccounting.Collect.base import Base
 
 try:
     from .accounts import Accounts
@@ -38,6 +57,11 @@ try:
 except ImportError:
     from src.wateraccounting.Collect.gis import GIS
 
+try:
+    from .trace import Trace
+except ImportError:
+    from src.wateraccounting.Collect.trace import Trace
+
 
 class Download(Accounts, GIS):
     """This Download class
@@ -55,6 +79,23 @@ class Download(Accounts, GIS):
         'file': '',
         'data': {}
     }
+    # Warm worker pools, shared by all calls in this process
+    __pools = {
+        'lock': threading.Lock(),
+        'modes': ['serial', 'thread', 'process', 'asyncio'],
+        'thread': {},
+        'process': {}
+    }
+    # Intermediate files in memory, GDAL /vsimem/ and in-process buffers
+    __temp = {
+        'env': 'WA_VSIMEM',
+        'root': '/vsimem/wa'
+    }
+    # Server urls of the products, from base.yml
+    __urls = {
+        'env': 'WA_URL_{product}',
+        'urls': {}
+    }
 
     def __init__(self, workspace='', account='', is_status=True, **kwargs):
         """Class instantiation
@@ -212,22 +253,526 @@ class Download(Accounts, GIS):
         This function extract zip file as gz file.
 
         Args:
-          file (str): Name of the file that must be unzipped.
-          outfile (str): Directory where the unzipped data must be stored.
+          file (str): Name of the file that must be unzipped,
+            or the bytes of the file, of ``get_buffer``.
+          outfile (str): Directory where the unzipped data must be stored,
+            a ``/vsimem/`` name, of ``get_temp``, keeps it in memory.
 
         :Example:
 
             >>> import os
             >>> from wateraccounting.Collect.download import Download
         """
+        if isinstance(file, bytes):
+            file_content = gzip.decompress(file)
+        else:
+            with gzip.GzipFile(file, 'rb') as zf:
+                file_content = zf.read()
+            os.remove(file)
+
+        self.put_temp(outfile, file_content)
+
+    @classmethod
+    def is_vsimem(cls):
+        """Is to keep the intermediate files in memory
+
+        The environment variable ``WA_VSIMEM`` enables it, '1' or 'true'.
+
+        Returns:
+          bool: Is in memory.
+        """
+        value = os.environ.get(cls.__temp['env'], '')
+        return value.strip().lower() not in ('', '0', 'false', 'no')
+
+    @classmethod
+    def get_temp(cls, file, is_vsimem=None):
+        """Get name of an intermediate file
+
+        Args:
+          file (str): 'C:/file/to/path/file.tif', the name on disk.
+          is_vsimem (bool): Is in memory, default ``is_vsimem``.
+
+        Returns:
+          str: '/vsimem/wa/C:/file/to/path/file.tif' when ``is_vsimem``,
+          else the name on disk.
+
+        :Example:
+
+            >>> from wateraccounting.Collect.download import Download
+            >>> Download.get_temp('/tmp/chirps-v2.0.2003.01.01.tif')
+            '/tmp/chirps-v2.0.2003.01.01.tif'
+        """
+        if is_vsimem is None:
+            is_vsimem = cls.is_vsimem()
+        if not is_vsimem:
+            return file
+        return '{r}/{f}'.format(
+            r=cls.__temp['root'],
+            f=os.path.abspath(file).replace('\\', '/').lstrip('/'))
+
+    @staticmethod
+    def get_buffer(retrieve):
+        """Get file in an in-process buffer
+
+        Args:
+          retrieve (callable): Writes the file, retrieve(write),
+            ``lambda write: ftp.retrbinary('RETR ' + filename, write)``.
+
+        Returns:
+          bytes: File content.
+        """
+        with io.BytesIO() as fp:
+            retrieve(fp.write)
+            return fp.getvalue()
+
+    @staticmethod
+    def put_temp(file, buffer):
+        """Put bytes in an intermediate file
+
+        Args:
+          file (str): Name, of ``get_temp``, a ``/vsimem/`` name keeps it
+            in memory.
+          buffer (bytes): File content.
+        """
+        if file.startswith('/vsimem/'):
+            gdal.FileFromMemBuffer(file, buffer)
+        else:
+            with open(file, 'wb') as fp:
+                fp.write(buffer)
+
+    @classmethod
+    def remove_temp(cls, file):
+        """Remove an intermediate file
+
+        The cached dataset handle is closed first, see ``GIS.close_tif``.
+        A directory in ``/vsimem/`` is removed with the files below it.
+
+        Args:
+          file (str): Name, of ``get_temp``.
+        """
+        cls.close_tif(file)
+        if file.startswith('/vsimem/'):
+            for name in gdal.ReadDir(file) or []:
+                cls.remove_temp('{d}/{n}'.format(d=file.rstrip('/'), n=name))
+            gdal.Unlink(file)
+        elif os.path.isfile(file):
+            os.remove(file)
+
+    @classmethod
+    def get_url(cls, product, dataset, version, datatype):
+        """Get server url of product
+
+        This function gets the ``url`` of the product from ``base.yml``.
+        The environment variable ``WA_URL_<PRODUCT>`` overrides it,
+        to use a mirror or a local stand-in server.
+
+        Args:
+          product (str): Product name, 'CHIRPS'.
+          dataset (str): Dataset name, 'Precipitation'.
+          version (str): Version name, 'v2'.
+          datatype (str): Data type, 'daily'.
+
+        Returns:
+          str: Url, 'ftp://chg-ftpout.geog.ucsb.edu'.
 
-        with gzip.GzipFile(file, 'rb') as zf:
-            file_content = zf.read()
-            save_file_content = open(outfile, 'wb')
-            save_file_content.write(file_content)
-        save_file_content.close()
-        zf.close()
-        os.remove(file)
+        :Example:
+
+            >>> from wateraccounting.Collect.download import Download
+            >>> Download.get_url('CHIRPS', 'Precipitation', 'v2', 'daily')
+            'ftp://chg-ftpout.geog.ucsb.edu'
+        """
+        url = os.environ.get(cls.__urls['env'].format(product=product.upper()))
+        if url:
+            return url.rstrip('/')
+
+        key = (product, dataset, version, datatype)
+        if key not in cls.__urls['urls']:
+            conf = Base.check_conf('data', is_status=False)
+            try:
+                url = conf['products'][product]['data'][dataset][version][
+                    datatype]['url']
+            except (KeyError, TypeError):
+                raise KeyError('Url "{k}" not found in "{f}".'
+                               .format(k='.'.join(key), f='base.yml'))
+            cls.__urls['urls'][key] = url.rstrip('/')
+
+        return cls.__urls['urls'][key]
+
+    @classmethod
+    def get_pool(cls, kind, workers):
+        """Get warm worker pool
+
+        The pools are created on first use and reused by all later calls,
+        so the process workers are spawned once per ``workers`` value.
+
+        Args:
+          kind (str): 'thread' or 'process'.
+          workers (int): Number of workers.
+
+        Returns:
+          :obj:`concurrent.futures.Executor`: Worker pool.
+        """
+        if kind not in ('thread', 'process'):
+            raise ValueError('Unknown kind: {v}'.format(v=kind))
+
+        workers = int(workers)
+        with cls.__pools['lock']:
+            pools = cls.__pools[kind]
+            if workers not in pools:
+                if kind == 'thread':
+                    pools[workers] = ThreadPoolExecutor(max_workers=workers)
+                else:
+                    pools[workers] = ProcessPoolExecutor(max_workers=workers)
+            return pools[workers]
+
+    @classmethod
+    def drop_pool(cls, kind, workers):
+        """Drop worker pool
+
+        A broken pool, a process pool with a killed worker, is dropped,
+        the next ``get_pool`` creates a new one.
+
+        Args:
+          kind (str): 'thread' or 'process'.
+          workers (int): Number of workers.
+        """
+        with cls.__pools['lock']:
+            pool = cls.__pools[kind].pop(int(workers), None)
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    @classmethod
+    def shutdown(cls):
+        """Shutdown all worker pools
+        """
+        with cls.__pools['lock']:
+            pools = list(cls.__pools['thread'].values()) + \
+                list(cls.__pools['process'].values())
+            cls.__pools['thread'].clear()
+            cls.__pools['process'].clear()
+        for pool in pools:
+            pool.shutdown()
+
+    @classmethod
+    def map(cls, func, items, mode='serial', workers=None, callback=None,
+            progress=None, metrics=None, ledger=None):
+        """Map function over items
+
+        This function is the executor of the date loops of all products.
+        ``workers`` is the one knob, False, None or 0 runs serial,
+        for any ``mode``.
+
+        Args:
+          func (function): Function of one item. A module level function
+            for 'process', a function or coroutine function for 'asyncio'.
+          items (iterable): Items.
+          mode (str): 'serial', 'thread', 'process' or 'asyncio'.
+          workers (int): Number of workers, the cores argument of the products.
+          callback (function): Called with each result in the calling thread,
+            in order of completion.
+          progress (:obj:`Progress`): Progress, updated with one file per item,
+            an int result, or 'nbytes' of a dict result,
+            is counted as bytes transferred.
+          metrics (:obj:`Metrics`): Metrics, updated like the progress,
+            with the timings of a dict result.
+          ledger (:obj:`Ledger`): Ledger, updated with each dict result,
+            failed when it has an 'error'.
+
+        Each item is a span of the active ``Trace``, when tracing is enabled.
+
+        Returns:
+          list: Results, in order of the items.
+
+        :Example:
+
+            >>> from wateraccounting.Collect.download import Download
+            >>> Download.map(abs, [-1, -2, 3], 'thread', 2)
+            [1, 2, 3]
+        """
+        if mode not in cls.__pools['modes']:
+            raise ValueError('Unknown mode: {v}'.format(v=mode))
+
+        if progress is not None or metrics is not None or ledger is not None:
+            callback = cls._progress_callback(progress, metrics, callback, ledger)
+
+        items = list(items)
+        results = [None] * len(items)
+
+        # Process workers send their spans back with the results
+        trace = Trace.get_active()
+        if trace is not None and not (workers and mode == 'process'):
+            func = Trace.wrap(func)
+
+        if not workers or mode == 'serial':
+            for i, item in enumerate(items):
+                results[i] = func(item)
+                if callback is not None:
+                    callback(results[i])
+
+        elif mode == 'asyncio':
+            asyncio.run(cls._map_async(func, items, int(workers), results, callback))
+
+        else:
+            pool = cls.get_pool(mode, workers)
+            is_trace = trace is not None and mode == 'process'
+            try:
+                if is_trace:
+                    futures = {pool.submit(Trace.call, func, item): i
+                               for i, item in enumerate(items)}
+                else:
+                    futures = {pool.submit(func, item): i
+                               for i, item in enumerate(items)}
+                for future in as_completed(futures):
+                    if is_trace:
+                        result, events, threads = future.result()
+                        trace.add(events, threads)
+                    else:
+                        result = future.result()
+                    results[futures[future]] = result
+                    if callback is not None:
+                        callback(results[futures[future]])
+            except BrokenProcessPool:
+                cls.drop_pool(mode, workers)
+                raise
+
+        return results
+
+    @staticmethod
+    def _progress_callback(progress, metrics, callback, ledger=None):
+        """Callback updating progress, metrics and ledger
+        """
+        def wrapper(result):
+            nbytes, is_error = 0, False
+            if isinstance(result, int) and not isinstance(result, bool):
+                nbytes = result
+            elif isinstance(result, dict):
+                nbytes = result.pop('nbytes', 0)
+                is_error = result.get('error') is not None
+                if ledger is not None:
+                    ledger.update(result, sum(result.get('timings', {}).values()),
+                                  nbytes, True)
+            if progress is not None:
+                progress.update(files=1, nbytes=nbytes)
+            if metrics is not None:
+                metrics.record(result, nbytes=nbytes, files=int(not is_error),
+                               errors=int(is_error))
+            if callback is not None:
+                callback(result)
+
+        return wrapper
+
+    @classmethod
+    async def _map_async(cls, func, items, workers, results, callback):
+        """Map function over items on the event loop
+        """
+        semaphore = asyncio.Semaphore(workers)
+        loop = asyncio.get_running_loop()
+
+        async def run(i, item):
+            async with semaphore:
+                if asyncio.iscoroutinefunction(func):
+                    results[i] = await func(item)
+                else:
+                    results[i] = await loop.run_in_executor(
+                        cls.get_pool('thread', workers), func, item)
+            if callback is not None:
+                callback(results[i])
+
+        await asyncio.gather(*[run(i, item) for i, item in enumerate(items)])
+
+
+atexit.register(Download.shutdown)
+
+
+class Pipeline(object):
+    """This Pipeline class
+
+    Staged pipeline, the stages are connected by bounded queues.
+    'thread' stages run in threads, for network and disk I/O.
+    'process' stages run in the warm process pool of ``Download.get_pool``,
+    for decompression, decoding and clipping.
+    All stages work at the same time, so the network is not idle
+    during CPU work, and the CPU is not idle during transfers.
+
+    A stage function takes one item and returns the item for the next stage,
+    or None to drop it. Failed items are dropped and kept in ``errors``.
+    A stage may set 'nbytes' in a dict item, the number of bytes it
+    transferred, which is counted in the progress,
+    and the keys of ``Metrics.record``, which are counted in the metrics.
+    A dropped or failed item is counted with the keys set by the stage
+    in the input item, a thread stage may set them before returning None.
+    Each item of each stage is a span of the active ``Trace``,
+    when tracing is enabled, on the lane of its worker.
+    Each item leaving the pipeline is done or failed in the ``Ledger``.
+
+    Args:
+      stages (list): [(name, func, kind, workers), ...],
+        kind is 'thread' or 'process'.
+      maxsize (int): Maximum number of items waiting between two stages,
+        default two per worker of the next stage.
+      progress (:obj:`Progress`): Progress, updated with the time and bytes
+        of each stage, and one file per item leaving the pipeline.
+      metrics (:obj:`Metrics`): Metrics, updated with the time, bytes and
+        timings of each stage, files and errors.
+      ledger (:obj:`Ledger`): Ledger, updated with the time and bytes
+        of each stage, and the items leaving the pipeline.
+
+    :Example:
+
+        >>> from wateraccounting.Collect.download import Pipeline
+        >>> pipeline = Pipeline([('double', lambda x: x * 2, 'thread', 2)])
+        >>> sorted(pipeline.run(range(3)))
+        [0, 2, 4]
+    """
+    __conf = {
+        'kinds': ['thread', 'process']
+    }
+    __stop = object()
+
+    def __init__(self, stages, maxsize=None, progress=None, metrics=None,
+                 ledger=None):
+        """Class instantiation
+        """
+        for name, func, kind, workers in stages:
+            if kind not in self.__conf['kinds']:
+                raise ValueError('Unknown kind: {v}'.format(v=kind))
+            if int(workers) < 1:
+                raise ValueError('Stage "{k}" requires workers > 0, received "{v}"'
+                                 .format(k=name, v=workers))
+
+        self.stages = [(name, func, kind, int(workers))
+                       for name, func, kind, workers in stages]
+        self.maxsize = maxsize
+        self.progress = progress
+        self.metrics = metrics
+        self.ledger = ledger
+        self.errors = []
+
+    def run(self, items):
+        """Run pipeline
+
+        Args:
+          items (iterable): Items of the first stage.
+
+        Returns:
+          list: Items returned by the last stage, in order of completion.
+        """
+        nstage = len(self.stages)
+        if nstage == 0:
+            return list(items)
+
+        queues = []
+        for name, func, kind, workers in self.stages:
+            maxsize = self.maxsize if self.maxsize is not None else 2 * workers
+            queues.append(queue.Queue(maxsize))
+
+        pools = {}
+        for i, (name, func, kind, workers) in enumerate(self.stages):
+            if kind == 'process':
+                pools[i] = Download.get_pool('process', workers)
+
+        state = {
+            'lock': threading.Lock(),
+            'running': [workers for name, func, kind, workers in self.stages],
+            'results': [],
+            'trace': Trace.get_active()
+        }
+        self.errors = []
+
+        threads = []
+        for i, (name, func, kind, workers) in enumerate(self.stages):
+            for j in range(workers):
+                thread = threading.Thread(target=self._worker,
+                                          args=(i, queues, pools.get(i), state),
+                                          name='{n}-{j}'.format(n=name, j=j))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        try:
+            for item in items:
+                queues[0].put(item)
+        finally:
+            for _ in range(self.stages[0][3]):
+                queues[0].put(self.__stop)
+
+            for thread in threads:
+                thread.join()
+
+        return state['results']
+
+    def _worker(self, i, queues, pool, state):
+        """Worker thread of stage i
+        """
+        name, func, kind, workers = self.stages[i]
+        is_last = i == len(self.stages) - 1
+
+        while True:
+            item = queues[i].get()
+            if item is self.__stop:
+                break
+
+            t0 = time.time()
+            try:
+                with Trace.span(name, item, stage=name):
+                    if pool is None:
+                        item_out = func(item)
+                    elif state['trace'] is None:
+                        item_out = pool.submit(func, item).result()
+                    else:
+                        item_out, events, threads = pool.submit(
+                            Trace.call, func, item).result()
+                        state['trace'].add(events, threads)
+            except BrokenProcessPool as err:
+                Download.drop_pool('process', workers)
+                with state['lock']:
+                    self.errors.append((name, item, err))
+                self._update(name, t0, item, True, err)
+                continue
+            except BaseException as err:
+                with state['lock']:
+                    self.errors.append((name, item, err))
+                self._update(name, t0, item, True, err)
+                continue
+
+            if item_out is None:
+                self._update(name, t0, item, True)
+                continue
+            self._update(name, t0, item_out, is_last)
+            if is_last:
+                with state['lock']:
+                    state['results'].append(item_out)
+            else:
+                queues[i + 1].put(item_out)
+
+        # The last worker of this stage stops the next stage
+        with state['lock']:
+            state['running'][i] -= 1
+            is_done = state['running'][i] == 0
+        if is_done and not is_last:
+            for _ in range(self.stages[i + 1][3]):
+                queues[i + 1].put(self.__stop)
+
+    def _update(self, name, t0, item, is_done, error=None):
+        """Update progress, metrics and ledger of stage
+        """
+        if self.progress is None and self.metrics is None and self.ledger is None:
+            return
+
+        seconds = time.time() - t0
+        is_error = error is not None
+        nbytes = 0
+        if isinstance(item, dict):
+            nbytes = item.pop('nbytes', 0)
+        if self.ledger is not None:
+            self.ledger.update(item, seconds, nbytes, is_done, error)
+        if self.progress is not None:
+            self.progress.update(files=int(is_done), nbytes=nbytes,
+                                 stage=name, seconds=seconds)
+        if self.metrics is not None:
+            self.metrics.record(item, name, seconds, nbytes,
+                                files=int(is_done and not is_error),
+                                errors=int(is_error))
 
 
 def main():
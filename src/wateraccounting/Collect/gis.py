@@ -34,7 +34,12 @@ import inspect
 # import shutil
 # import yaml
 
+import re
+import threading
+from collections import OrderedDict
+
 import numpy as np
+from scipy import sparse
 
 try:
     from osgeo import gdal, osr, gdalconst
@@ -65,6 +70,34 @@ class GIS(Base):
         'file': '',
         'data': {}
     }
+    __cache = {
+        'lock': threading.Lock(),
+        'resample': OrderedDict(),
+        'resample_size': 32,
+        'tif': OrderedDict(),
+        'tif_size': 64,
+        'tif_counters': {'opens': 0, 'hits': 0},
+        'tif_archive': re.compile(r'^(/vsi(gzip|zip|tar)/)+'),
+        'encoding': {},
+        'clip': {}
+    }
+    # Polygons the outputs are clipped to
+    __clip = {
+        'env': 'WA_CLIP'
+    }
+    __encoding = {
+        'nodata': -9999.,
+        'dtypes': {
+            'uint8': 'Byte',
+            'int8': 'Int8',
+            'uint16': 'UInt16',
+            'int16': 'Int16',
+            'uint32': 'UInt32',
+            'int32': 'Int32',
+            'float32': 'Float32',
+            'float64': 'Float64'
+        }
+    }
 
     def __init__(self, workspace, is_status, **kwargs):
         """Class instantiation
@@ -115,15 +148,154 @@ class GIS(Base):
         """
         self.status = self.set_status(self.stcode, fun, prt, ext)
 
-    def get_tif(self, file='', band=1):
+    def open_tif(self, file=''):
+        """Open tif, from the cache of dataset handles
+
+        The handles are kept in a bounded LRU, shared by all instances,
+        so repeated metadata and data reads of a file skip the open cost.
+        A handle is invalidated by ``close_tif``, which the save methods call
+        before writing, and when the modification time or size of the file
+        changes, of the archive for a file read in place through ``/vsizip/``,
+        ``/vsigzip/`` or ``/vsitar/``.
+        A GDAL handle is not thread-safe, read it under its lock.
+
+        Args:
+          file (str): 'C:/file/to/path/file.tif'
+            string that defines the input tif file.
+
+        Returns:
+          tuple: (dataset, lock), :obj:`gdal.Dataset` and its
+          :obj:`threading.Lock`.
+
+        :Example:
+
+            >>> import os
+            >>> from wateraccounting.Collect.gis import GIS
+            >>> gis = GIS(os.getcwd(), is_status=False)
+            >>> path = os.path.join(os.getcwd(), 'tests', 'data', 'BigTIFF')
+            >>> file = os.path.join(path, 'Classic.tif')
+            >>> f, lock = gis.open_tif(file)
+            >>> with lock:
+            ...     f.RasterXSize
+            64
+        """
+        key = self._get_tif_key(file)
+        mtime = self._get_tif_mtime(key)
+
+        cache = self.__cache['tif']
+        with self.__cache['lock']:
+            handle = cache.get(key)
+            if handle is not None and handle[2] == mtime:
+                cache.move_to_end(key)
+                self.__cache['tif_counters']['hits'] += 1
+                return handle[0], handle[1]
+
+        f = gdal.Open(file)
+        if f is None:
+            raise IOError('{} not found.'.format(file))
+
+        lock = threading.Lock()
+        with self.__cache['lock']:
+            self.__cache['tif_counters']['opens'] += 1
+            cache[key] = (f, lock, mtime)
+            cache.move_to_end(key)
+            while len(cache) > self.__cache['tif_size']:
+                cache.popitem(last=False)
+
+        return f, lock
+
+    @classmethod
+    def close_tif(cls, file=None):
+        """Close tif, invalidate the cached dataset handles
+
+        Call it before a file is written or deleted outside ``GIS``.
+
+        Args:
+          file (str): 'C:/file/to/path/file.tif', a directory closes
+            the files below it, also the files read in place from the archives
+            below it, None closes all files.
+        """
+        with cls.__cache['lock']:
+            if file is None:
+                cls.__cache['tif'].clear()
+            elif os.path.isdir(str(file)):
+                folder = os.path.join(cls._get_tif_key(file), '')
+                for key in list(cls.__cache['tif']):
+                    path = cls.__cache['tif_archive'].sub('', key)
+                    if cls._get_tif_key(path).startswith(folder):
+                        del cls.__cache['tif'][key]
+            else:
+                cls.__cache['tif'].pop(cls._get_tif_key(file), None)
+
+    @classmethod
+    def set_tif_cache(cls, size):
+        """Set size of the cache of dataset handles
+
+        Args:
+          size (int): Maximum number of open files.
+
+        Returns:
+          dict: Cache info, {'size', 'files', 'opens', 'hits'}.
+        """
+        with cls.__cache['lock']:
+            cls.__cache['tif_size'] = int(size)
+            while len(cls.__cache['tif']) > cls.__cache['tif_size']:
+                cls.__cache['tif'].popitem(last=False)
+        return cls.get_tif_cache()
+
+    @classmethod
+    def get_tif_cache(cls):
+        """Get info of the cache of dataset handles
+
+        Returns:
+          dict: {'size', 'files', 'opens', 'hits'}, 'opens' and 'hits' count
+          from the start of the process.
+        """
+        with cls.__cache['lock']:
+            return dict(cls.__cache['tif_counters'],
+                        size=cls.__cache['tif_size'],
+                        files=len(cls.__cache['tif']))
+
+    @classmethod
+    def _get_tif_mtime(cls, key):
+        """Modification time and size of a file, of its archive for a file
+        read in place, None when not found
+        """
+        path = cls.__cache['tif_archive'].sub('', key)
+        while True:
+            if path.startswith('/vsimem/'):
+                stat = gdal.VSIStatL(path)
+                if stat is not None:
+                    return stat.mtime, stat.size
+            elif os.path.isfile(path):
+                return os.path.getmtime(path), os.path.getsize(path)
+
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    @staticmethod
+    def _get_tif_key(file):
+        """Cache key of a file, absolute path, GDAL virtual paths as is
+        """
+        file = str(file)
+        return file if file.startswith('/vsi') else os.path.abspath(file)
+
+    def get_tif(self, file='', band=1, window=None):
         """Get tif band data
 
         This function get tif band as numpy.ndarray.
+        GDAL virtual file systems read archives in place,
+        '/vsigzip/C:/file/to/path/file.tif.gz' or
+        '/vsizip/C:/file/to/path/file.zip/file.bil',
+        with a window only the needed part of a stream is decoded.
 
         Args:
           file (str): 'C:/file/to/path/file.tif' or a gdal file (gdal.Open(file))
             string that defines the input tif file or gdal file.
           band (int): Defines the band of the tif that must be opened.
+          window (tuple): (xoff, yoff, xsize, ysize), default the whole band.
 
         Returns:
           :obj:`numpy.ndarray`: Band data.
@@ -143,6 +315,9 @@ class GIS(Base):
             >>> data.shape
             (64, 64)
 
+            >>> gis.get_tif(file, 1, (0, 0, 8, 4)).shape
+            (4, 8)
+
             >>> data
             array([[255, 255, 255, ...   0,   0,   0],
                    [255, 255, 255, ...   0,   0,   0],
@@ -157,21 +332,81 @@ class GIS(Base):
         if band == '':
             band = 1
 
-        f = gdal.Open(file)
-        if f is not None:
+        f, lock = self.open_tif(file)
+        with lock:
             try:
-                Data = f.GetRasterBand(band).ReadAsArray()
+                fb = f.GetRasterBand(band)
+                if window is None:
+                    Data = fb.ReadAsArray()
+                else:
+                    Data = fb.ReadAsArray(*[int(v) for v in window])
             except AttributeError:
                 raise AttributeError('Band {band} not found.'.format(band=band))
-        else:
-            raise IOError('{} not found.'.format(file))
+            Data = self.decode(Data, fb.GetScale(), fb.GetOffset(),
+                               fb.GetNoDataValue())
 
         return Data
 
-    def save_tif(self, name='', data='', geo='', projection=''):
+    def get_tif_geo(self, file=''):
+        """Get tif geo
+
+        Args:
+          file (str): 'C:/file/to/path/file.tif'
+            string that defines the input tif file.
+
+        Returns:
+          list: [minimum lon, pixelsize, rotation, maximum lat, rotation, pixelsize].
+
+        :Example:
+
+            >>> import os
+            >>> from wateraccounting.Collect.gis import GIS
+            >>> gis = GIS(os.getcwd(), is_status=False)
+            >>> path = os.path.join(os.getcwd(), 'tests', 'data', 'BigTIFF')
+            >>> file = os.path.join(path, 'Classic.tif')
+            >>> len(gis.get_tif_geo(file))
+            6
+        """
+        f, lock = self.open_tif(file)
+        with lock:
+            return list(f.GetGeoTransform())
+
+    def get_tif_info(self, file=''):
+        """Get tif info
+
+        Args:
+          file (str): 'C:/file/to/path/file.tif'
+            string that defines the input tif file.
+
+        Returns:
+          tuple: (geo, projection, size_X, size_Y), geo is a list,
+          projection is WKT.
+
+        :Example:
+
+            >>> import os
+            >>> from wateraccounting.Collect.gis import GIS
+            >>> gis = GIS(os.getcwd(), is_status=False)
+            >>> path = os.path.join(os.getcwd(), 'tests', 'data', 'BigTIFF')
+            >>> file = os.path.join(path, 'Classic.tif')
+            >>> gis.get_tif_info(file)[2:]
+            (64, 64)
+        """
+        f, lock = self.open_tif(file)
+        with lock:
+            return (list(f.GetGeoTransform()), f.GetProjection(),
+                    f.RasterXSize, f.RasterYSize)
+
+    def save_tif(self, name='', data='', geo='', projection='', encoding=None,
+                 clip=None):
         """Save as tif
 
         This function save the array as a geotiff.
+        With an encoding, from ``get_encoding``, the data is stored as
+        scaled integers, ``get_tif`` reads it back as float32.
+        With clip zones, from ``get_clip``, pixels outside the polygons are
+        nodata and the geotiff is cropped to the extent of the polygons;
+        the product save stages pass them, intermediate files are not clipped.
 
         Args:
           name (str): Directory name.
@@ -179,6 +414,9 @@ class GIS(Base):
           geo (list): Geospatial dataset, [minimum lon, pixelsize, rotation,
             maximum lat, rotation, pixelsize].
           projection (int): EPSG code.
+          encoding (dict): {'dtype', 'scale', 'offset', 'nodata'},
+            default float32.
+          clip (:obj:`Zones`): Polygons to clip to, default not clipped.
 
         :Example:
 
@@ -209,10 +447,212 @@ class GIS(Base):
                    [  0.,   0.,   0., ...,   0.,   0.,   0.],
                    [  0.,   0.,   0., ...,   0.,   0.,   0.]], dtype=float32)
         """
+        # clip to the polygons, the mask is cached per grid
+        if clip is not None:
+            data, geo = clip.clip(data, geo, self.__encoding['nodata'])
+
         # save as a geotiff
+        dtype = gdal.GDT_Float32
+        nodata = self.__encoding['nodata']
+        if encoding is not None:
+            data = self.encode(data, encoding)
+            dtype = gdal.GetDataTypeByName(
+                self.__encoding['dtypes'][data.dtype.name])
+            nodata = encoding['nodata']
+
+        self.close_tif(name)
         driver = gdal.GetDriverByName("GTiff")
         dst_ds = driver.Create(name, int(data.shape[1]), int(data.shape[0]), 1,
-                               gdal.GDT_Float32, ['COMPRESS=LZW'])
+                               dtype, ['COMPRESS=LZW'])
+
+        dst_ds.SetProjection(self._get_srs(projection))
+        dst_ds.SetGeoTransform(geo)
+        dst_band = dst_ds.GetRasterBand(1)
+        dst_band.SetNoDataValue(nodata)
+        if encoding is not None:
+            dst_band.SetScale(encoding['scale'])
+            dst_band.SetOffset(encoding['offset'])
+        dst_band.WriteArray(data)
+        dst_band = None
+        dst_ds = None
+
+        return
+
+    @classmethod
+    def get_clip(cls, file=None):
+        """Get clip zones
+
+        This function reads the polygons, GeoJSON or shapefile, the product
+        outputs are clipped to by ``save_tif``. The environment variable
+        ``WA_CLIP`` is the default file, read by the product save stages.
+        The zones are cached per file, and their masks per grid,
+        so a polygon is rasterized once for all dates.
+
+        Args:
+          file (str): 'C:/file/to/path/basin.geojson', default ``WA_CLIP``.
+
+        Returns:
+          :obj:`Zones`: Zones, None without file.
+        """
+        if file is None:
+            file = os.environ.get(cls.__clip['env'], '')
+        if not file:
+            return None
+
+        key = (os.path.abspath(file), os.path.getmtime(file))
+        with cls.__cache['lock']:
+            if key in cls.__cache['clip']:
+                return cls.__cache['clip'][key]
+
+        # zonal builds on GIS
+        try:
+            from .zonal import Zones
+        except ImportError:
+            from src.wateraccounting.Collect.zonal import Zones
+        zones = Zones.from_file(file)
+
+        with cls.__cache['lock']:
+            return cls.__cache['clip'].setdefault(key, zones)
+
+    @classmethod
+    def get_encoding(cls, product, dataset, version, datatype, variable=None):
+        """Get output encoding
+
+        The output dtype is ``dtype.o`` of the data type in ``base.yml``,
+        ``encoding`` of the data type, or of the variable,
+        gives the scale, offset and nodata, default 1, 0 and -9999.
+
+        Args:
+          product (str): Product name, 'CHIRPS'.
+          dataset (str): Dataset name, 'Precipitation'.
+          version (str): Version name, 'v2'.
+          datatype (str): Data type, 'daily'.
+          variable (str): Variable name, 'P', default the data type encoding.
+
+        Returns:
+          dict: {'dtype', 'scale', 'offset', 'nodata'}, None is float32.
+
+        :Example:
+
+            >>> from wateraccounting.Collect.gis import GIS
+            >>> GIS.get_encoding('CHIRPS', 'Precipitation', 'v2', 'daily', 'P')
+            {'dtype': 'uint16', 'scale': 0.1, 'offset': 0.0, 'nodata': 65535}
+        """
+        key = (product, dataset, version, datatype, variable)
+        with cls.__cache['lock']:
+            if key in cls.__cache['encoding']:
+                return cls.__cache['encoding'][key]
+
+        conf = Base.check_conf('data', is_status=False)
+        conf = conf['products'][product]['data'][dataset][version][datatype]
+        encoding = dict(conf.get('encoding') or {})
+        if variable is not None:
+            encoding.update(conf['variables'][variable].get('encoding') or {})
+
+        dtype = np.dtype(conf.get('dtype', {}).get('o', 'float32')).name
+        if dtype == 'float32' and not encoding:
+            encoding = None
+        else:
+            encoding = {
+                'dtype': dtype,
+                'scale': float(encoding.get('scale', 1.)),
+                'offset': float(encoding.get('offset', 0.)),
+                'nodata': encoding.get('nodata', cls.__encoding['nodata'])
+            }
+
+        with cls.__cache['lock']:
+            cls.__cache['encoding'][key] = encoding
+        return encoding
+
+    @classmethod
+    def encode(cls, data, encoding):
+        """Encode data
+
+        Nodata, -9999 or ``nan``, becomes the nodata of the encoding,
+        the other values are scaled, rounded and clipped to the dtype.
+
+        Args:
+          data (:obj:`numpy.ndarray`): Data, -9999 as nodata.
+          encoding (dict): {'dtype', 'scale', 'offset', 'nodata'}.
+
+        Returns:
+          :obj:`numpy.ndarray`: Data of the dtype of the encoding.
+
+        :Example:
+
+            >>> import numpy as np
+            >>> from wateraccounting.Collect.gis import GIS
+            >>> encoding = {'dtype': 'uint8', 'scale': 0.5, 'offset': 0.,
+            ...             'nodata': 255}
+            >>> GIS.encode(np.array([0., 12.5, -9999.]), encoding)
+            array([  0,  25, 255], dtype=uint8)
+        """
+        dtype = np.dtype(encoding['dtype'])
+        data = np.asarray(data, dtype=np.float64)
+        nodata = ~np.isfinite(data) | (data == cls.__encoding['nodata'])
+
+        data = (data - encoding['offset']) / encoding['scale']
+        if dtype.kind in 'iu':
+            lo, hi = np.iinfo(dtype).min, np.iinfo(dtype).max
+            if encoding['nodata'] == lo:
+                lo += 1
+            if encoding['nodata'] == hi:
+                hi -= 1
+            data = np.clip(np.round(data), lo, hi)
+        data[nodata] = encoding['nodata']
+
+        return data.astype(dtype)
+
+    @classmethod
+    def decode(cls, data, scale=None, offset=None, nodata=None):
+        """Decode data
+
+        The inverse of ``encode``, data with a scale or an offset,
+        or integers with a nodata other than -9999, becomes float32 with
+        -9999 as nodata. Other data is returned as is.
+
+        Args:
+          data (:obj:`numpy.ndarray`): Data of the band.
+          scale (float): Scale of the band, None is 1.
+          offset (float): Offset of the band, None is 0.
+          nodata (float): Nodata of the band.
+
+        Returns:
+          :obj:`numpy.ndarray`: Data.
+
+        :Example:
+
+            >>> import numpy as np
+            >>> from wateraccounting.Collect.gis import GIS
+            >>> GIS.decode(np.array([0, 25, 255], dtype=np.uint8), 0.5, 0., 255)
+            array([    0. ,    12.5, -9999. ], dtype=float32)
+        """
+        scale = 1. if scale is None else scale
+        offset = 0. if offset is None else offset
+        is_nodata = (nodata is not None and data.dtype.kind in 'iu' and
+                     nodata != cls.__encoding['nodata'])
+        if scale == 1. and offset == 0. and not is_nodata:
+            return data
+
+        out = data.astype(np.float32)
+        if scale != 1.:
+            out *= np.float32(scale)
+        if offset != 0.:
+            out += np.float32(offset)
+        if nodata is not None:
+            out[data == nodata] = cls.__encoding['nodata']
+        return out
+
+    @staticmethod
+    def _get_srs(projection=''):
+        """Get spatial reference
+
+        Args:
+          projection (str): Well known name, EPSG code or WKT.
+
+        Returns:
+          str: Spatial reference as WKT.
+        """
         srse = osr.SpatialReference()
         if projection == '':
             srse.SetWellKnownGeogCS("WGS84")
@@ -236,14 +676,344 @@ class GIS(Base):
                 else:
                     srse.ImportFromWkt(projection)
 
-        dst_ds.SetProjection(srse.ExportToWkt())
+        return srse.ExportToWkt()
+
+    def get_tif_blocks(self, file='', band=1, halo=0, size=None):
+        """Get tif band data by blocks
+
+        This function yields the tif band block by block,
+        so the whole band never has to fit in memory.
+        Blocks are aligned to the internal tiling of the file,
+        a multiple of the internal block size, at least 256 by 256 pixels
+        by default.
+
+        Args:
+          file (str): 'C:/file/to/path/file.tif'
+            string that defines the input tif file.
+          band (int): Defines the band of the tif that must be opened.
+          halo (int): Overlap in pixels around each block,
+            for neighbourhood operations, clipped at the raster edge.
+          size (tuple): Minimum block size, (xsize, ysize),
+            rounded up to the internal block size.
+
+        Yields:
+          tuple: (window, data), window is the block without halo,
+          (xoff, yoff, xsize, ysize), data is the block with halo,
+          decoded as ``get_tif``.
+
+        :Example:
+
+            >>> import os
+            >>> from wateraccounting.Collect.gis import GIS
+            >>> gis = GIS(os.getcwd(), is_status=False)
+            >>> path = os.path.join(os.getcwd(), 'tests', 'data', 'BigTIFF')
+            >>> file = os.path.join(path, 'Classic.tif')
+            >>> for window, data in gis.get_tif_blocks(file, 1, halo=1):
+            ...     print(window, data.shape)
+            (0, 0, 64, 64) (64, 64)
+        """
+        if band == '':
+            band = 1
+
+        f = gdal.Open(file)
+        if f is None:
+            raise IOError('{} not found.'.format(file))
+
+        fb = f.GetRasterBand(band)
+        if fb is None:
+            raise AttributeError('Band {band} not found.'.format(band=band))
+
+        xsize_tot, ysize_tot = f.RasterXSize, f.RasterYSize
+        xblock, yblock = fb.GetBlockSize()
+        encoding = (fb.GetScale(), fb.GetOffset(), fb.GetNoDataValue())
+        if size is None:
+            size = (256, 256)
+        xsize = min(int(np.ceil(size[0] / xblock)) * xblock, xsize_tot)
+        ysize = min(int(np.ceil(size[1] / yblock)) * yblock, ysize_tot)
+
+        for yoff in range(0, ysize_tot, ysize):
+            for xoff in range(0, xsize_tot, xsize):
+                window = (xoff, yoff,
+                          min(xsize, xsize_tot - xoff),
+                          min(ysize, ysize_tot - yoff))
+
+                # Block with halo, clipped at the raster edge
+                x0 = max(xoff - halo, 0)
+                y0 = max(yoff - halo, 0)
+                x1 = min(xoff + window[2] + halo, xsize_tot)
+                y1 = min(yoff + window[3] + halo, ysize_tot)
+
+                yield window, self.decode(
+                    fb.ReadAsArray(x0, y0, x1 - x0, y1 - y0), *encoding)
+
+        fb = None
+        f = None
+
+    def save_tif_blocks(self, name='', blocks=(), shape=(), geo='', projection='',
+                        halo=0):
+        """Save as tif by blocks
+
+        This function saves blocks, from ``get_tif_blocks``, as a tiled geotiff.
+        The halo of each block is removed before writing.
+
+        Args:
+          name (str): Directory name.
+          blocks (iterable): (window, data) pairs,
+            window is (xoff, yoff, xsize, ysize).
+          shape (tuple): Shape of the geotiff, (rows, cols).
+          geo (list): Geospatial dataset, [minimum lon, pixelsize, rotation,
+            maximum lat, rotation, pixelsize].
+          projection (int): EPSG code.
+          halo (int): Overlap in pixels around each block.
+
+        :Example:
+
+            >>> import os
+            >>> from wateraccounting.Collect.gis import GIS
+            >>> gis = GIS(os.getcwd(), is_status=False)
+            >>> path = os.path.join(os.getcwd(), 'tests', 'data', 'BigTIFF')
+            >>> file = os.path.join(path, 'Classic.tif')
+            >>> test = os.path.join(path, 'test.tif')
+            >>> blocks = ((window, data * 2.)
+            ...           for window, data in gis.get_tif_blocks(file, 1))
+            >>> gis.save_tif_blocks(test, blocks, (64, 64), [0, 1, 0, 0, 1, 0])
+        """
+        self.close_tif(name)
+        driver = gdal.GetDriverByName("GTiff")
+        dst_ds = driver.Create(name, int(shape[1]), int(shape[0]), 1,
+                               gdal.GDT_Float32,
+                               ['COMPRESS=LZW', 'TILED=YES',
+                                'BLOCKXSIZE=256', 'BLOCKYSIZE=256',
+                                'BIGTIFF=IF_SAFER'])
+
+        dst_ds.SetProjection(self._get_srs(projection))
         dst_ds.SetGeoTransform(geo)
-        dst_ds.GetRasterBand(1).SetNoDataValue(-9999)
-        dst_ds.GetRasterBand(1).WriteArray(data)
+        dst_band = dst_ds.GetRasterBand(1)
+        dst_band.SetNoDataValue(-9999)
+
+        for window, data in blocks:
+            xoff, yoff, xsize, ysize = window
+            x0 = xoff - max(xoff - halo, 0)
+            y0 = yoff - max(yoff - halo, 0)
+            dst_band.WriteArray(data[y0:y0 + ysize, x0:x0 + xsize], xoff, yoff)
+
+        dst_band = None
         dst_ds = None
 
         return
 
+    def get_resample_weights(self, geo, shape, dst_geo, dst_shape,
+                             method='nearest'):
+        """Get resample weights
+
+        This function computes the source to target index/weight mapping
+        between two regular lat/lon grids. Rows and columns of a regular grid
+        are independent, so the mapping is kept per axis, which is small.
+        The result is cached by (grid, target grid, method), so it is
+        computed once for all dates of a product.
+
+        Args:
+          geo (list): Source geo, [minimum lon, pixelsize, rotation,
+            maximum lat, rotation, pixelsize].
+          shape (tuple): Source shape, (rows, cols).
+          dst_geo (list): Target geo.
+          dst_shape (tuple): Target shape, (rows, cols).
+          method (str): 'nearest', 'bilinear' or 'average'.
+
+        Returns:
+          dict: Weights, {'method': str, 'y': tuple, 'x': tuple}.
+
+        :Example:
+
+            >>> import os
+            >>> from wateraccounting.Collect.gis import GIS
+            >>> gis = GIS(os.getcwd(), is_status=False)
+            >>> weights = gis.get_resample_weights(
+            ...     [0, 1, 0, 2, 0, -1], (2, 2),
+            ...     [0, 0.5, 0, 2, 0, -0.5], (4, 4), 'nearest')
+            >>> weights['x'][0]
+            array([0, 0, 1, 1])
+        """
+        if method not in ('nearest', 'bilinear', 'average'):
+            raise ValueError('Unknown method: {v}'.format(v=method))
+
+        key = (tuple(float(v) for v in geo),
+               tuple(int(v) for v in shape),
+               tuple(float(v) for v in dst_geo),
+               tuple(int(v) for v in dst_shape),
+               method)
+
+        cache = self.__cache['resample']
+        with self.__cache['lock']:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+
+        weights = {
+            'method': method,
+            'y': self._resample_axis(geo[3], geo[5], shape[0],
+                                     dst_geo[3], dst_geo[5], dst_shape[0],
+                                     method),
+            'x': self._resample_axis(geo[0], geo[1], shape[1],
+                                     dst_geo[0], dst_geo[1], dst_shape[1],
+                                     method)
+        }
+
+        with self.__cache['lock']:
+            cache[key] = weights
+            while len(cache) > self.__cache['resample_size']:
+                cache.popitem(last=False)
+
+        return weights
+
+    @staticmethod
+    def _resample_axis(org, res, size, dst_org, dst_res, dst_size, method):
+        """Resample weights of one axis
+
+        Args:
+          org (float): Source origin, edge of the first pixel.
+          res (float): Source pixel size, negative for north-up latitude.
+          size (int): Source number of pixels.
+          dst_org (float): Target origin.
+          dst_res (float): Target pixel size.
+          dst_size (int): Target number of pixels.
+          method (str): 'nearest', 'bilinear' or 'average'.
+
+        Returns:
+          tuple: Indices and weights for 'nearest' and 'bilinear',
+          :obj:`scipy.sparse.csr_matrix` for 'average'.
+        """
+        if method == 'average':
+            # Target pixel edges in source index space
+            edge = (dst_org + np.arange(dst_size + 1) * dst_res - org) / res
+            lo = np.minimum(edge[:-1], edge[1:])
+            hi = np.maximum(edge[:-1], edge[1:])
+
+            first = np.floor(lo).astype(np.int64)
+            span = int(np.max(np.ceil(hi) - first)) if dst_size > 0 else 0
+            idx = first[:, None] + np.arange(max(span, 1))[None, :]
+            overlap = np.minimum(hi[:, None], idx + 1) - np.maximum(lo[:, None], idx)
+
+            keep = (idx >= 0) & (idx < size) & (overlap > 0)
+            rows = np.broadcast_to(np.arange(dst_size)[:, None], idx.shape)
+            return sparse.csr_matrix((overlap[keep], (rows[keep], idx[keep])),
+                                     shape=(dst_size, size))
+
+        # Target pixel centres in source index space
+        pos = (dst_org + (np.arange(dst_size) + 0.5) * dst_res - org) / res - 0.5
+        valid = (pos >= -0.5) & (pos < size - 0.5)
+
+        if method == 'nearest':
+            idx = np.clip(np.floor(pos + 0.5).astype(np.int64), 0, size - 1)
+            return idx, valid
+
+        idx = np.floor(pos).astype(np.int64)
+        wgt = pos - idx
+        return (np.clip(idx, 0, size - 1), np.clip(idx + 1, 0, size - 1),
+                1.0 - wgt, wgt, valid)
+
+    def resample(self, data, geo, dst_geo, dst_shape, method='nearest',
+                 nodata=-9999):
+        """Resample array
+
+        This function resamples the array to the target grid,
+        by the cached weights from ``get_resample_weights``.
+        Nodata pixels are excluded, and the weights are normalized
+        over the valid pixels.
+
+        Args:
+          data (:obj:`numpy.ndarray`): Source data.
+          geo (list): Source geo, [minimum lon, pixelsize, rotation,
+            maximum lat, rotation, pixelsize].
+          dst_geo (list): Target geo.
+          dst_shape (tuple): Target shape, (rows, cols).
+          method (str): 'nearest', 'bilinear' or 'average'.
+          nodata (float): Nodata value of source and target.
+
+        Returns:
+          :obj:`numpy.ndarray`: Resampled data, float32.
+
+        :Example:
+
+            >>> import os
+            >>> import numpy as np
+            >>> from wateraccounting.Collect.gis import GIS
+            >>> gis = GIS(os.getcwd(), is_status=False)
+            >>> data = np.array([[1., 2.], [3., -9999.]])
+            >>> gis.resample(data, [0, 1, 0, 2, 0, -1],
+            ...              [0, 2, 0, 2, 0, -2], (1, 1), 'average')
+            array([[2.]], dtype=float32)
+        """
+        weights = self.get_resample_weights(geo, data.shape,
+                                            dst_geo, dst_shape, method)
+
+        valid = np.isfinite(data) & (data != nodata)
+        value = np.where(valid, data, 0.)
+
+        if method == 'nearest':
+            iy, vy = weights['y']
+            ix, vx = weights['x']
+            num = value[np.ix_(iy, ix)]
+            den = valid[np.ix_(iy, ix)] & vy[:, None] & vx[None, :]
+
+        if method == 'bilinear':
+            y0, y1, wy0, wy1, vy = weights['y']
+            x0, x1, wx0, wx1, vx = weights['x']
+            num = np.zeros(dst_shape)
+            den = np.zeros(dst_shape)
+            for iy, wy in ((y0, wy0), (y1, wy1)):
+                for ix, wx in ((x0, wx0), (x1, wx1)):
+                    wgt = np.outer(wy, wx) * valid[np.ix_(iy, ix)]
+                    num += wgt * value[np.ix_(iy, ix)]
+                    den += wgt
+            den[~(vy[:, None] & vx[None, :])] = 0.
+
+        if method == 'average':
+            wy = weights['y']
+            wx = weights['x']
+            num = wx.dot(wy.dot(value).T).T
+            den = wx.dot(wy.dot(valid.astype(np.float64)).T).T
+
+        out = np.full(dst_shape, nodata, dtype=np.float32)
+        ok = den > 0
+        out[ok] = num[ok] / den[ok]
+
+        return out
+
+    def resample_tif(self, file, dst_file, dst_geo, dst_shape, method='nearest',
+                     band=1):
+        """Resample tif
+
+        This function resamples a tif band to the target grid,
+        and saves it as a geotiff. The band is decoded as ``get_tif``.
+
+        Args:
+          file (str): 'C:/file/to/path/file.tif', the input tif file.
+          dst_file (str): 'C:/file/to/path/file.tif', the output tif file.
+          dst_geo (list): Target geo, [minimum lon, pixelsize, rotation,
+            maximum lat, rotation, pixelsize].
+          dst_shape (tuple): Target shape, (rows, cols).
+          method (str): 'nearest', 'bilinear' or 'average'.
+          band (int): Defines the band of the tif that must be opened.
+        """
+        f, lock = self.open_tif(file)
+        with lock:
+            geo = f.GetGeoTransform()
+            fb = f.GetRasterBand(band)
+            nodata = fb.GetNoDataValue()
+            raw = fb.ReadAsArray()
+            data = self.decode(raw, fb.GetScale(), fb.GetOffset(), nodata)
+
+        # decode keeps float bands as is, with their nodata
+        if data is raw and nodata is not None and nodata != -9999:
+            data = data.astype(np.float32)
+            data[data == nodata] = -9999
+
+        data = self.resample(data, geo, dst_geo, dst_shape, method)
+        self.save_tif(dst_file, data, list(dst_geo), "WGS84")
+
+        return
+
     def save_netcdf(self):
         pass
 
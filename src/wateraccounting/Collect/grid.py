@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+**Grid**
+
+`Restrictions`
+
+The data and this python file may not be distributed to others without
+permission of the WA+ team.
+
+`Description`
+
+Product grid descriptor, built from the ``lat`` and ``lon`` entries,
+``s``, ``n``, ``w``, ``e`` and ``r``, of a product variable in ``base.yml``.
+
+All coordinate transforms are vectorized,
+converting many points or many bounding boxes is a single numpy call.
+
+**Examples:**
+::
+
+    from wateraccounting.Collect.grid import Grid
+    grid = Grid.from_conf('CHIRPS', 'Precipitation', 'v2', 'daily', 'P')
+    yID, xID = grid.window(latlim=[-10, 30], lonlim=[-20, -10])
+    geo = grid.window_geo(yID, xID)
+"""
+# import os
+# import sys
+# import inspect
+# import shutil
+# import yaml
+
+import numpy as np
+
+try:
+    from .base import Base
+except ImportError:
+    from src.wateraccounting.Collect.base import Base
+
+
+class Grid(object):
+    """This Grid class
+
+    Regular lat/lon grid, north-up, origin at the north-west corner.
+
+    Args:
+      lat (dict): {'s': south edge, 'n': north edge, 'r': pixel size}.
+      lon (dict): {'w': west edge, 'e': east edge, 'r': pixel size}.
+    """
+    __conf = {
+        # Snapping tolerance in pixels, for float noise of the limits
+        'eps': 1.0e-6,
+        # Maximum number of cached windows per grid
+        'size': 1024,
+        'grids': {}
+    }
+
+    def __init__(self, lat, lon):
+        """Class instantiation
+        """
+        self.lat = {
+            's': float(lat['s']),
+            'n': float(lat['n']),
+            'r': float(lat['r'])
+        }
+        self.lon = {
+            'w': float(lon['w']),
+            'e': float(lon['e']),
+            'r': float(lon['r'])
+        }
+
+        if self.lat['r'] <= 0. or self.lon['r'] <= 0.:
+            raise ValueError('Grid pixel size must be positive, received "{v}"'
+                             .format(v=[self.lat['r'], self.lon['r']]))
+
+        self.shape = (
+            int(np.round((self.lat['n'] - self.lat['s']) / self.lat['r'])),
+            int(np.round((self.lon['e'] - self.lon['w']) / self.lon['r']))
+        )
+        self.geo = [self.lon['w'], self.lon['r'], 0.,
+                    self.lat['n'], 0., -self.lat['r']]
+
+        self.__windows = {}
+
+    def __repr__(self):
+        return 'Grid(shape={s}, geo={g})'.format(s=self.shape, g=self.geo)
+
+    @classmethod
+    def from_conf(cls, product, dataset, version, datatype, variable):
+        """Grid from configuration
+
+        This function creates the grid of a product variable from ``base.yml``.
+        Grids are cached, so the window cache is shared by all callers.
+
+        Args:
+          product (str): Product name, 'CHIRPS'.
+          dataset (str): Dataset name, 'Precipitation'.
+          version (str): Version name, 'v2'.
+          datatype (str): Data type, 'daily'.
+          variable (str): Variable name, 'P'.
+
+        Returns:
+          :obj:`Grid`: Product grid.
+
+        :Example:
+
+            >>> from wateraccounting.Collect.grid import Grid
+            >>> grid = Grid.from_conf('CHIRPS', 'Precipitation', 'v2', 'daily', 'P')
+            >>> grid.shape
+            (2000, 7200)
+        """
+        key = (product, dataset, version, datatype, variable)
+
+        if key not in cls.__conf['grids']:
+            conf = Base.check_conf('data', is_status=False)
+            try:
+                var = conf['products'][product]['data'][dataset][version][
+                    datatype]['variables'][variable]
+                grid = cls(var['lat'], var['lon'])
+            except (KeyError, TypeError):
+                raise KeyError('Grid "{k}" not found in "{f}".'
+                               .format(k='.'.join(key), f='base.yml'))
+            cls.__conf['grids'][key] = grid
+
+        return cls.__conf['grids'][key]
+
+    @classmethod
+    def from_geo(cls, geo, shape):
+        """Grid from geo
+
+        Args:
+          geo (list): [minimum lon, pixelsize, rotation,
+            maximum lat, rotation, pixelsize].
+          shape (tuple): (rows, cols).
+
+        Returns:
+          :obj:`Grid`: Grid.
+        """
+        return cls({'s': geo[3] + shape[0] * geo[5],
+                    'n': geo[3],
+                    'r': -geo[5]},
+                   {'w': geo[0],
+                    'e': geo[0] + shape[1] * geo[1],
+                    'r': geo[1]})
+
+    def check_latlon(self, latlim, lonlim):
+        """Check lat/lon limits
+
+        This function sets the limits outside the grid to the grid extent.
+
+        Args:
+          latlim (list): [ymin, ymax].
+          lonlim (list): [xmin, xmax].
+
+        Returns:
+          tuple: (latlim, lonlim), new lists.
+        """
+        latlim = [float(latlim[0]), float(latlim[1])]
+        lonlim = [float(lonlim[0]), float(lonlim[1])]
+
+        if latlim[0] < self.lat['s'] or latlim[1] > self.lat['n']:
+            print('Latitude above {n}N or below {s}S is not possible.'
+                  ' Value set to maximum'.format(n=abs(self.lat['n']),
+                                                  s=abs(self.lat['s'])))
+            latlim[0] = max(latlim[0], self.lat['s'])
+            latlim[1] = min(latlim[1], self.lat['n'])
+        if lonlim[0] < self.lon['w'] or lonlim[1] > self.lon['e']:
+            print('Longitude must be between {e}E and {w}W.'
+                  ' Now value is set to maximum'.format(e=abs(self.lon['e']),
+                                                        w=abs(self.lon['w'])))
+            lonlim[0] = max(lonlim[0], self.lon['w'])
+            lonlim[1] = min(lonlim[1], self.lon['e'])
+
+        return latlim, lonlim
+
+    def to_index(self, lat, lon):
+        """Lat/lon to pixel index
+
+        Args:
+          lat (:obj:`numpy.ndarray`): Latitudes, any shape.
+          lon (:obj:`numpy.ndarray`): Longitudes, same shape.
+
+        Returns:
+          tuple: (rows, cols), int64 arrays, pixels containing the points.
+          Points outside the grid are not clipped.
+
+        :Example:
+
+            >>> from wateraccounting.Collect.grid import Grid
+            >>> grid = Grid({'s': -50, 'n': 50, 'r': 0.05},
+            ...             {'w': -180, 'e': 180, 'r': 0.05})
+            >>> grid.to_index([49.99, -49.99], [-179.99, 179.99])
+            (array([   0, 1999]), array([   0, 7199]))
+        """
+        eps = self.__conf['eps']
+
+        row = (self.lat['n'] - np.asarray(lat, dtype=np.float64)) / self.lat['r']
+        col = (np.asarray(lon, dtype=np.float64) - self.lon['w']) / self.lon['r']
+
+        return (np.floor(row + eps).astype(np.int64),
+                np.floor(col + eps).astype(np.int64))
+
+    def to_latlon(self, row, col):
+        """Pixel index to lat/lon of the pixel centres
+
+        Args:
+          row (:obj:`numpy.ndarray`): Rows, any shape.
+          col (:obj:`numpy.ndarray`): Cols, same shape.
+
+        Returns:
+          tuple: (lat, lon), float64 arrays.
+        """
+        return (self.lat['n'] - (np.asarray(row) + 0.5) * self.lat['r'],
+                self.lon['w'] + (np.asarray(col) + 0.5) * self.lon['r'])
+
+    def windows(self, latlims, lonlims):
+        """Lat/lon limits to snapped windows
+
+        The windows are snapped outwards to whole pixels,
+        and clipped to the grid.
+
+        Args:
+          latlims (:obj:`numpy.ndarray`): [[ymin, ymax], ...], (N, 2).
+          lonlims (:obj:`numpy.ndarray`): [[xmin, xmax], ...], (N, 2).
+
+        Returns:
+          tuple: (yID, xID), int64 arrays (N, 2), [start, end] indices.
+        """
+        eps = self.__conf['eps']
+
+        latlims = np.asarray(latlims, dtype=np.float64).reshape(-1, 2)
+        lonlims = np.asarray(lonlims, dtype=np.float64).reshape(-1, 2)
+
+        yID = np.empty(latlims.shape, dtype=np.int64)
+        xID = np.empty(lonlims.shape, dtype=np.int64)
+
+        yID[:, 0] = np.floor((self.lat['n'] - latlims[:, 1]) / self.lat['r'] + eps)
+        yID[:, 1] = np.ceil((self.lat['n'] - latlims[:, 0]) / self.lat['r'] - eps)
+        xID[:, 0] = np.floor((lonlims[:, 0] - self.lon['w']) / self.lon['r'] + eps)
+        xID[:, 1] = np.ceil((lonlims[:, 1] - self.lon['w']) / self.lon['r'] - eps)
+
+        np.clip(yID, 0, self.shape[0], out=yID)
+        np.clip(xID, 0, self.shape[1], out=xID)
+
+        return yID, xID
+
+    def window(self, latlim, lonlim):
+        """Lat/lon limits to snapped window
+
+        Same as ``windows`` for one bounding box, the result is cached.
+
+        Args:
+          latlim (list): [ymin, ymax].
+          lonlim (list): [xmin, xmax].
+
+        Returns:
+          tuple: (yID, xID), (start, end) indices.
+
+        :Example:
+
+            >>> from wateraccounting.Collect.grid import Grid
+            >>> grid = Grid({'s': -50, 'n': 50, 'r': 0.05},
+            ...             {'w': -180, 'e': 180, 'r': 0.05})
+            >>> grid.window([-10, 30], [-20, -10])
+            ((400, 1200), (3200, 3400))
+        """
+        key = (float(latlim[0]), float(latlim[1]),
+               float(lonlim[0]), float(lonlim[1]))
+
+        if key not in self.__windows:
+            yID, xID = self.windows(latlim, lonlim)
+            if len(self.__windows) >= self.__conf['size']:
+                self.__windows.clear()
+            self.__windows[key] = ((int(yID[0, 0]), int(yID[0, 1])),
+                                   (int(xID[0, 0]), int(xID[0, 1])))
+
+        return self.__windows[key]
+
+    def window_geo(self, yID, xID):
+        """Geo of window
+
+        Args:
+          yID (tuple): (start, end) row indices.
+          xID (tuple): (start, end) col indices.
+
+        Returns:
+          list: [minimum lon, pixelsize, rotation,
+          maximum lat, rotation, pixelsize].
+        """
+        return [self.lon['w'] + xID[0] * self.lon['r'], self.lon['r'], 0.,
+                self.lat['n'] - yID[0] * self.lat['r'], 0., -self.lat['r']]
+
+
+def main():
+    from pprint import pprint
+
+    # Grid __init__
+    print('\nGrid\n=====')
+    grid = Grid.from_conf('CHIRPS', 'Precipitation', 'v2', 'daily', 'P')
+    pprint(grid)
+
+    # Grid methods
+    print('\ngrid.window()\n=====')
+    yID, xID = grid.window(latlim=[-10, 30], lonlim=[-20, -10])
+    pprint((yID, xID))
+    pprint(grid.window_geo(yID, xID))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,646 @@
+# -*- coding: utf-8 -*-
+"""
+**Job**
+
+`Restrictions`
+
+The data and this python file may not be distributed to others without
+permission of the WA+ team.
+
+`Description`
+
+Job of many products, variables, regions and date ranges, from a YAML job file,
+the ``wa-collect`` command.
+
+The entries of the job are planned with ``Planner``, per region.
+The entries of the same product, dataset, version, datatype and variables
+are one group, the todo dates of all their regions are downloaded once,
+and the regions are clipped from the outputs of the union of the regions.
+Identical entries and overlapping date ranges are merged.
+The groups run one after another with all workers of the job,
+so the job never runs more than ``cores`` workers per stage.
+The throughput of each group is read from the ``Metrics`` JSON lines file.
+``sync`` fetches only the dates published after the high-water marks
+of the entries and regions, see ``Sync``.
+
+Job file:
+::
+
+    output: C:/Temp/
+    cores: 8
+    metrics: C:/Temp/collect.jsonl
+    ledger: C:/Temp/collect.sqlite
+    sync: C:/Temp/wa_sync.json
+    vsimem: true
+    regions:
+      nile: {latlim: [-5, 32], lonlim: [21, 48]}
+      volta: {latlim: [5, 15], lonlim: [-6, 2], clip: C:/Temp/volta.geojson}
+    products:
+      - {product: CHIRPS, dataset: Precipitation, version: v2, datatype: daily,
+         regions: [nile, volta], Startdate: '2003-01-01', Enddate: '2003-12-31'}
+      - {product: CFSR, dataset: Radiation, version: v2, datatype: daily,
+         variables: [dlwsfc, dswsfc], regions: [nile],
+         Startdate: '2012-01-01', Enddate: '2012-12-31'}
+
+The outputs of a region are written in ``output/<region>``.
+The outputs of a region with ``clip`` polygons are nodata outside the
+polygons and cropped to their extent, see ``GIS.save_tif``.
+
+**Examples:**
+::
+
+    from wateraccounting.Collect.job import Job
+    job = Job.from_yaml('job.yml')
+    print(job.format(job.plan()))
+    job.run()
+    job.sync()
+"""
+import os
+# import sys
+# import inspect
+# import shutil
+# import yaml
+
+import json
+import time
+import shutil
+
+import yaml
+import pandas as pd
+
+try:
+    from .base import Base
+except ImportError:
+    from src.wateraccounting.Collect.base import Base
+
+try:
+    from .planner import Planner
+except ImportError:
+    from src.wateraccounting.Collect.planner import Planner
+
+try:
+    from .grid import Grid
+except ImportError:
+    from src.wateraccounting.Collect.grid import Grid
+
+try:
+    from .download import Download
+except ImportError:
+    from src.wateraccounting.Collect.download import Download
+
+try:
+    from .sync import Sync
+except ImportError:
+    from src.wateraccounting.Collect.sync import Sync
+
+
+class Job(object):
+    """This Job class
+
+    Args:
+      conf (dict): Job, {'output', 'cores', 'metrics', 'ledger', 'sync', 'vsimem',
+        'regions': {name: {'latlim', 'lonlim', 'clip'}},
+        'products': [entry, ...]}.
+        An entry is {'product', 'dataset', 'version', 'datatype',
+        'variables', 'regions', 'Startdate', 'Enddate'},
+        default all variables of the datatype and all regions.
+
+    Raises:
+      KeyError: Product without runner, or region not found.
+    """
+    __conf = {
+        'env': {
+            'metrics': 'WA_METRICS_JSONL',
+            'ledger': 'WA_LEDGER',
+            'vsimem': 'WA_VSIMEM',
+            'clip': 'WA_CLIP'
+        },
+        'metrics': 'wa_collect.jsonl',
+        'sync': 'wa_sync.json',
+        'staging': '.staging',
+        # Products which run from a job, with the folder of their outputs
+        'runners': {
+            'CHIRPS': {
+                'daily': ['Precipitation', 'CHIRPS', 'Daily'],
+                'monthly': ['Precipitation', 'CHIRPS', 'Monthly']
+            },
+            'CFSR': {
+                'daily': ['Radiation', '{product}']
+            }
+        }
+    }
+
+    def __init__(self, conf):
+        """Class instantiation
+        """
+        self.output = conf.get('output', '')
+        self.cores = int(conf.get('cores', 0) or 0)
+        self.metrics = conf.get('metrics') or os.path.join(
+            self.output, self.__conf['metrics'])
+        self.ledger = conf.get('ledger')
+        self.vsimem = bool(conf.get('vsimem', False))
+        self.sync_file = conf.get('sync') or os.path.join(
+            self.output, self.__conf['sync'])
+        self.regions = dict(conf.get('regions') or {})
+
+        self.entries = []
+        for entry in conf.get('products') or []:
+            entry = dict(entry)
+            if entry['datatype'] not in \
+                    self.__conf['runners'].get(entry['product'], {}):
+                raise KeyError('Product "{k}" has no runner, use one of "{v}".'
+                               .format(k='.'.join([entry['product'],
+                                                   entry['datatype']]),
+                                       v=sorted(self.__conf['runners'])))
+            entry['regions'] = list(entry.get('regions') or sorted(self.regions))
+            for region in entry['regions']:
+                if region not in self.regions:
+                    raise KeyError('Region "{v}" not found in "{k}".'
+                                   .format(v=region, k=sorted(self.regions)))
+            self.entries.append(entry)
+
+    @classmethod
+    def from_yaml(cls, file):
+        """Job from YAML job file
+
+        Args:
+          file (str): Job file.
+
+        Returns:
+          :obj:`Job`: Job.
+        """
+        with open(file) as fp:
+            conf = yaml.safe_load(fp)
+        return cls(conf or {})
+
+    def get_folder(self, Dir, entry):
+        """Output folder of an entry, in the Dir of the product
+
+        Returns:
+          str: Folder.
+        """
+        names = self.__conf['runners'][entry['product']][entry['datatype']]
+        product = entry['product'] if entry['version'] in ('v1', '') \
+            else '{p}{v}'.format(p=entry['product'], v=entry['version'])
+        return os.path.join(Dir, *[name.format(product=product) for name in names])
+
+    @staticmethod
+    def get_group(entry):
+        """Group key of an entry, the entries sharing the remote files
+
+        Returns:
+          tuple: (product, dataset, version, datatype, variables).
+        """
+        variables = entry.get('variables')
+        return (entry['product'], entry['dataset'], entry['version'],
+                entry['datatype'],
+                None if variables is None else tuple(sorted(variables)))
+
+    @staticmethod
+    def get_encoding(key):
+        """Output encoding of a group, from ``base.yml``
+
+        Args:
+          key (tuple): Group key, from ``get_group``.
+
+        Returns:
+          dict: Encoding of the variables, None is float32, also when the
+          variables of the group have different encodings.
+        """
+        product, dataset, version, datatype, variables = key
+        if variables is None:
+            conf = Base.check_conf('data', is_status=False)
+            variables = sorted(conf['products'][product]['data'][dataset][
+                version][datatype]['variables'])
+
+        encodings = [Download.get_encoding(product, dataset, version, datatype,
+                                           variable) for variable in variables]
+        if all(encoding == encodings[0] for encoding in encodings):
+            return encodings[0]
+        return None
+
+    @staticmethod
+    def get_ranges(dates, freq):
+        """Split dates into ranges of consecutive dates
+
+        Args:
+          dates (iterable): Dates.
+          freq (str): Frequency of the dates, 'D'.
+
+        Returns:
+          list: [(Startdate, Enddate), ...].
+
+        :Example:
+
+            >>> import pandas as pd
+            >>> from wateraccounting.Collect.job import Job
+            >>> dates = pd.to_datetime(['2003-01-01', '2003-01-02', '2003-01-05'])
+            >>> [(s.day, e.day) for s, e in Job.get_ranges(dates, 'D')]
+            [(1, 2), (5, 5)]
+        """
+        dates = sorted(set(dates))
+        ranges = []
+        for date in dates:
+            if ranges and pd.date_range(ranges[-1][1], periods=2,
+                                        freq=freq)[1] == date:
+                ranges[-1][1] = date
+            else:
+                ranges.append([date, date])
+        return [tuple(item) for item in ranges]
+
+    def plan(self, is_remote=False):
+        """Plan job
+
+        Args:
+          is_remote (bool): Is to request the remote sizes.
+
+        Returns:
+          list: Groups, [{'key', 'regions': {name: {'latlim', 'lonlim', 'Dir',
+          'dates', 'plan'}}, 'dates', 'ranges', 'tasks', 'todo', 'files',
+          'shared', 'remote_nbytes', 'seconds'}, ...].
+          'files' counts each remote file of the group once,
+          'shared' the remote files needed by more than one region or entry.
+        """
+        groups = {}
+        for entry in self.entries:
+            key = self.get_group(entry)
+            group = groups.setdefault(key, {'key': key, 'regions': {},
+                                            'remotes': {}})
+            for name in entry['regions']:
+                region = self.regions[name]
+                Dir = os.path.join(self.output, name)
+                planner = Planner(entry['product'], entry['dataset'],
+                                  entry['version'], entry['datatype'],
+                                  entry.get('variables'),
+                                  region['latlim'], region['lonlim'],
+                                  entry.get('Startdate'), entry.get('Enddate'),
+                                  folder=self.get_folder(Dir, entry),
+                                  history=self.metrics)
+                plan = planner.plan(is_remote)
+                info = group['regions'].setdefault(name, {
+                    'latlim': region['latlim'],
+                    'lonlim': region['lonlim'],
+                    'clip': region.get('clip'),
+                    'Dir': Dir,
+                    'dates': set(),
+                    'plan': [],
+                    'freq': planner.conf['freq']
+                })
+                info['plan'].append(plan)
+                for task in plan['todo_tasks']:
+                    info['dates'].add(task['Date'])
+                    owners = group['remotes'].setdefault(task['remote'], set())
+                    owners.add((name, len(info['plan'])))
+
+        result = []
+        for key, group in groups.items():
+            dates, freq = set(), 'D'
+            for info in group['regions'].values():
+                dates |= info['dates']
+                freq = info['freq']
+            plans = [plan for info in group['regions'].values()
+                     for plan in info['plan']]
+            seconds = [plan['seconds'] for plan in plans]
+            todo = sum(plan['todo'] for plan in plans)
+            nbytes = sum(plan['remote_nbytes'] for plan in plans)
+            files = len(group['remotes'])
+            result.append({
+                'key': key,
+                'regions': group['regions'],
+                'dates': sorted(dates),
+                'ranges': self.get_ranges(dates, freq),
+                'tasks': sum(plan['tasks'] for plan in plans),
+                'todo': todo,
+                'files': files,
+                'shared': len([owners for owners in group['remotes'].values()
+                               if len(owners) > 1]),
+                # Each remote file once, the mean size of the planned files
+                'remote_nbytes': int(nbytes * files / max(sum(
+                    plan['files'] for plan in plans), 1)),
+                'seconds': None if None in seconds or not seconds else
+                max(seconds)
+            })
+        return result
+
+    def format(self, groups):
+        """Format plan
+
+        Args:
+          groups (list): Plan.
+
+        Returns:
+          str: Report.
+        """
+        lines = []
+        for group in groups:
+            product, dataset, version, datatype, variables = group['key']
+            lines.append('{k} {v}'.format(
+                k='.'.join([product, dataset, version, datatype]),
+                v=','.join(variables) if variables else 'all variables'))
+            lines.append('  regions:   {}'.format(', '.join(sorted(group['regions']))))
+            lines.append('  tasks:     {n}, {t} to do, {d} dates in {r} ranges'.format(
+                n=group['tasks'], t=group['todo'], d=len(group['dates']),
+                r=len(group['ranges'])))
+            lines.append('  remote:    {n} files, {s} shared, {b:.1f} MB'.format(
+                n=group['files'], s=group['shared'],
+                b=group['remote_nbytes'] / 1024. ** 2))
+            if group['seconds'] is not None:
+                lines.append('  runtime:   {:.0f} s'.format(group['seconds']))
+        return '\n'.join(lines)
+
+    def run(self, groups=None, cores=None, Waitbar=0):
+        """Run job
+
+        The regions of a group with more than one region are clipped from the
+        outputs of the union of the regions, in ``output/.staging``.
+
+        Args:
+          groups (list): Plan, default ``plan()``.
+          cores (int): Workers of the job, default the 'cores' of the job.
+          Waitbar (int): 1 prints a wait bar.
+
+        Returns:
+          list: Summaries of the groups, {'key', 'files', 'errors',
+          'cache_hits', 'nbytes_in', 'nbytes_out', 'seconds', 'mbps'}.
+        """
+        cores = self.cores if cores is None else int(cores or 0)
+
+        # Runs of the products are summarized in the metrics file
+        env = {key: os.environ.get(name)
+               for key, name in self.__conf['env'].items()}
+        os.environ[self.__conf['env']['metrics']] = self.metrics
+        if self.ledger:
+            os.environ[self.__conf['env']['ledger']] = self.ledger
+        if self.vsimem:
+            os.environ[self.__conf['env']['vsimem']] = '1'
+        folder = os.path.dirname(os.path.abspath(self.metrics))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        if groups is None:
+            groups = self.plan()
+        summaries = []
+        try:
+            for group in groups:
+                offset = os.path.getsize(self.metrics) \
+                    if os.path.exists(self.metrics) else 0
+                t0 = time.time()
+                self.run_group(group, cores, Waitbar)
+                summary = self.get_summary(offset)
+                summary['key'] = group['key']
+                summary['seconds'] = time.time() - t0
+                summary['mbps'] = summary['nbytes_in'] / 1024. ** 2 / \
+                    max(summary['seconds'], 1.0e-9)
+                summaries.append(summary)
+        finally:
+            for key, value in env.items():
+                if value is None:
+                    os.environ.pop(self.__conf['env'][key], None)
+                else:
+                    os.environ[self.__conf['env'][key]] = value
+
+        return summaries
+
+    def sync(self, cores=None, Waitbar=0):
+        """Sync job, fetch only the newly published dates
+
+        The 'Startdate' of an entry is the first date of the first sync,
+        the 'Enddate' is today.
+
+        Args:
+          cores (int): Workers of the job, default the 'cores' of the job.
+          Waitbar (int): 1 prints a wait bar.
+
+        Returns:
+          list: Summaries of the groups with new dates, see ``run``.
+        """
+        sync = Sync(self.sync_file)
+
+        groups, planners = {}, []
+        for entry in self.entries:
+            key = self.get_group(entry)
+            group = groups.setdefault(key, {'key': key, 'regions': {},
+                                            'dates': set(), 'freq': 'D'})
+            for name in entry['regions']:
+                region = self.regions[name]
+                Dir = os.path.join(self.output, name)
+                planner = sync.get_planner(entry['product'], entry['dataset'],
+                                           entry['version'], entry['datatype'],
+                                           entry.get('variables'),
+                                           region['latlim'], region['lonlim'],
+                                           entry.get('Startdate'),
+                                           folder=self.get_folder(Dir, entry),
+                                           history=self.metrics)
+                if planner is None:
+                    continue
+                planners.append(planner)
+
+                tasks = sync.discover(planner)
+                if not tasks:
+                    continue
+                group['regions'].setdefault(name, {
+                    'latlim': region['latlim'],
+                    'lonlim': region['lonlim'],
+                    'clip': region.get('clip'),
+                    'Dir': Dir
+                })
+                group['dates'] |= set(task['Date'] for task in tasks)
+                group['freq'] = planner.conf['freq']
+
+        plan = [dict(group, dates=sorted(group['dates']),
+                     ranges=self.get_ranges(group['dates'], group['freq']))
+                for group in groups.values() if group['dates']]
+        try:
+            summaries = self.run(plan, cores, Waitbar)
+        finally:
+            for planner in planners:
+                sync.update(planner)
+            sync.save()
+        return summaries
+
+    def run_group(self, group, cores, Waitbar=0):
+        """Run group, once for all its regions
+
+        Args:
+          group (dict): Group of the plan.
+          cores (int): Workers.
+          Waitbar (int): 1 prints a wait bar.
+        """
+        if not group['dates']:
+            return
+
+        product, dataset, version, datatype, variables = group['key']
+        entry = {'product': product, 'dataset': dataset, 'version': version,
+                 'datatype': datatype, 'variables': variables}
+        regions = group['regions']
+
+        # The outputs of one region are clipped by the product,
+        # the outputs of the union of the regions per region
+        os.environ.pop(self.__conf['env']['clip'], None)
+        if len(regions) == 1:
+            info = list(regions.values())[0]
+            Dir, latlim, lonlim = info['Dir'], info['latlim'], info['lonlim']
+            if info.get('clip'):
+                os.environ[self.__conf['env']['clip']] = info['clip']
+        else:
+            Dir = os.path.join(self.output, self.__conf['staging'],
+                               '_'.join([product, version, datatype]))
+            latlim = [min(info['latlim'][0] for info in regions.values()),
+                      max(info['latlim'][1] for info in regions.values())]
+            lonlim = [min(info['lonlim'][0] for info in regions.values()),
+                      max(info['lonlim'][1] for info in regions.values())]
+
+        for Startdate, Enddate in group['ranges']:
+            self.run_product(entry, Dir, Startdate.strftime('%Y-%m-%d'),
+                             Enddate.strftime('%Y-%m-%d'), latlim, lonlim,
+                             Waitbar, cores)
+
+        if len(regions) > 1:
+            self.clip(Dir, regions, group['key'])
+            shutil.rmtree(Dir, ignore_errors=True)
+
+    @staticmethod
+    def run_product(entry, Dir, Startdate, Enddate, latlim, lonlim, Waitbar,
+                    cores):
+        """Run the product of an entry
+
+        Keyword arguments:
+        entry -- {'product', 'dataset', 'version', 'datatype', 'variables'}
+        Dir -- 'C:/file/to/path/'
+        Startdate -- 'yyyy-mm-dd'
+        Enddate -- 'yyyy-mm-dd'
+        latlim -- [ymin, ymax]
+        lonlim -- [xmin, xmax]
+        Waitbar -- 1 (Default) will print a wait bar
+        cores -- The number of cores used to run the routine.
+        """
+        # The products import their own dependencies, pycurl and netCDF4
+        if entry['product'] == 'CHIRPS':
+            try:
+                from .products import CHIRPS
+            except ImportError:
+                from src.wateraccounting.Collect.products import CHIRPS
+            CHIRPS.DownloadData(Dir, Startdate, Enddate, latlim, lonlim,
+                                Waitbar, cores, entry['datatype'])
+        elif entry['product'] == 'CFSR':
+            try:
+                from .products import CFSR
+            except ImportError:
+                from src.wateraccounting.Collect.products import CFSR
+            Vars = entry['variables'] or ['dlwsfc', 'dswsfc', 'ulwsfc', 'uswsfc']
+            CFSR.CollectVars(Dir, Vars, Startdate, Enddate, latlim, lonlim,
+                             Waitbar, cores, int(entry['version'].lstrip('v')))
+        else:
+            raise KeyError('Product "{k}" has no runner.'.format(k=entry['product']))
+
+    def clip(self, Dir, regions, key=None):
+        """Clip the regions from the outputs of the union of the regions
+
+        The outputs are clipped on the grid of each output,
+        outputs which exist in a region are kept.
+        The outputs are stored with the encoding of the group, as the outputs
+        of a single region.
+
+        Args:
+          Dir (str): Dir of the union.
+          regions (dict): {name: {'latlim', 'lonlim', 'clip', 'Dir'}}.
+          key (tuple): Group key, from ``get_group``, default float32.
+        """
+        download = Download('', '', is_status=False)
+        encoding = None if key is None else self.get_encoding(key)
+        clips = {name: download.get_clip(info['clip'])
+                 for name, info in regions.items() if info.get('clip')}
+        for root, dirs, files in os.walk(Dir):
+            for file in sorted(files):
+                if not file.endswith('.tif'):
+                    continue
+                path = os.path.join(root, file)
+                relpath = os.path.relpath(path, Dir)
+                data, geo = None, None
+                for region, info in regions.items():
+                    name = os.path.join(info['Dir'], relpath)
+                    if os.path.exists(name):
+                        continue
+                    if data is None:
+                        data = download.get_tif(path, 1)
+                        geo = download.get_tif_geo(path)
+                    grid = Grid.from_geo(geo, data.shape)
+                    yID, xID = grid.window(info['latlim'], info['lonlim'])
+                    if not os.path.exists(os.path.dirname(name)):
+                        os.makedirs(os.path.dirname(name))
+                    download.save_tif(name, data[yID[0]:yID[1], xID[0]:xID[1]],
+                                      grid.window_geo(yID, xID), "WGS84",
+                                      encoding, clip=clips.get(region))
+
+    def get_summary(self, offset=0):
+        """Sum the run summaries of the metrics file, after offset
+
+        Returns:
+          dict: {'files', 'errors', 'cache_hits', 'nbytes_in', 'nbytes_out'}.
+        """
+        total = {'files': 0, 'errors': 0, 'cache_hits': 0, 'nbytes_in': 0,
+                 'nbytes_out': 0}
+        if not os.path.exists(self.metrics):
+            return total
+        with open(self.metrics) as fp:
+            fp.seek(offset)
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('type') != 'summary':
+                    continue
+                for key in total:
+                    total[key] += record.get(key, 0)
+        return total
+
+    @staticmethod
+    def format_summary(summaries):
+        """Format throughput summary
+
+        Args:
+          summaries (list): Summaries of ``run``.
+
+        Returns:
+          str: Table.
+        """
+        lines = ['{:32} {:>6} {:>6} {:>6} {:>9} {:>8} {:>8}'.format(
+            'group', 'files', 'errors', 'cached', 'MB', 'seconds', 'MB/s')]
+        for summary in summaries:
+            lines.append('{:32} {:>6} {:>6} {:>6} {:>9.1f} {:>8.1f} {:>8.2f}'.format(
+                '.'.join(str(item) for item in summary['key'][:4]),
+                summary['files'], summary['errors'], summary['cache_hits'],
+                summary['nbytes_in'] / 1024. ** 2, summary['seconds'],
+                summary['mbps']))
+        return '\n'.join(lines)
+
+
+def main():
+    from pprint import pprint
+
+    # Job __init__
+    print('\nJob\n=====')
+    job = Job({
+        'output': '',
+        'cores': 4,
+        'regions': {
+            'nile': {'latlim': [-5, 32], 'lonlim': [21, 48]},
+            'volta': {'latlim': [5, 15], 'lonlim': [-6, 2]}
+        },
+        'products': [
+            {'product': 'CHIRPS', 'dataset': 'Precipitation', 'version': 'v2',
+             'datatype': 'daily', 'Startdate': '2003-01-01',
+             'Enddate': '2003-01-31'}
+        ]
+    })
+
+    # Job methods
+    print('\njob.plan()\n=====')
+    groups = job.plan()
+    pprint(groups[0]['ranges'])
+    print(job.format(groups))
+
+
+if __name__ == "__main__":
+    main()
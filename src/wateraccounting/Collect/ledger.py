@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+**Ledger**
+
+`Restrictions`
+
+The data and this python file may not be distributed to others without
+permission of the WA+ team.
+
+`Description`
+
+Persistent task ledger of the product downloads, in SQLite,
+to resume long backfills.
+
+Each task, a date of a product and its labels, is planned, running,
+done or failed, with its number of attempts, bytes, seconds and last error.
+A product claims the dates of a run from the ledger, the dates which are
+done in an earlier run are skipped without looking at the files,
+the failed dates and the dates of a killed run are retried.
+The ``Pipeline`` and ``Download.map`` record the tasks leaving them.
+
+The updates are written in batches, a killed run loses at most one batch,
+these dates are found by their outputs in the next run.
+One ledger file is shared by all products, and by concurrent runs.
+The ledger is enabled by a file, an argument or the ``WA_LEDGER``
+environment variable.
+
+**Examples:**
+::
+
+    from wateraccounting.Collect.ledger import Ledger
+    ledger = Ledger('CHIRPS', {'datatype': 'daily'}, file='collect.sqlite')
+    dates = ledger.claim(pd.date_range('2003-01-01', '2003-12-31'))
+    ledger.update({'Date': dates[0]}, seconds=1.0, nbytes=1024, is_done=True)
+    ledger.close()
+"""
+import os
+# import sys
+# import inspect
+# import shutil
+# import yaml
+
+import json
+import time
+import socket
+import sqlite3
+import threading
+import uuid
+
+
+class Ledger(object):
+    """This Ledger class
+
+    Thread-safe task ledger of a product.
+
+    Args:
+      product (str): Product name, 'CHIRPS'.
+      labels (dict): Other labels, {'datatype': 'daily'}.
+      file (str): SQLite file, default ``WA_LEDGER``.
+      attempts (int): Maximum number of attempts of a failed task,
+        None retries without limit.
+      batch (int): Number of updates written in one transaction.
+    """
+    __conf = {
+        'env': 'WA_LEDGER',
+        'states': ['planned', 'running', 'done', 'failed'],
+        'timeout': 60.,
+        'schema': [
+            'CREATE TABLE IF NOT EXISTS tasks ('
+            ' product TEXT NOT NULL,'
+            ' labels TEXT NOT NULL,'
+            ' date TEXT NOT NULL,'
+            ' state TEXT NOT NULL,'
+            ' attempts INTEGER NOT NULL DEFAULT 0,'
+            ' nbytes INTEGER NOT NULL DEFAULT 0,'
+            ' seconds REAL NOT NULL DEFAULT 0,'
+            ' error TEXT,'
+            ' host TEXT,'
+            ' pid INTEGER,'
+            ' run TEXT,'
+            ' updated REAL,'
+            ' PRIMARY KEY (product, labels, date))',
+            'CREATE INDEX IF NOT EXISTS tasks_state'
+            ' ON tasks (product, labels, state)'
+        ]
+    }
+    # Runs of the ledgers of this process which are not closed
+    __runs = set()
+
+    def __init__(self, product='', labels=None, file=None, attempts=None,
+                 batch=100):
+        """Class instantiation
+        """
+        self.product = product
+        self.labels = dict(labels) if labels is not None else {}
+        self.file = file if file is not None else os.environ.get(self.__conf['env'])
+        self.attempts = attempts
+        self.batch = int(batch)
+
+        self.__key = json.dumps(self.labels, sort_keys=True, default=str)
+        self.__run = uuid.uuid4().hex
+        self.__lock = threading.Lock()
+        # Stage seconds and bytes of running tasks, updates to write
+        self.__running = {}
+        self.__updates = []
+        self.__db = None
+
+    @property
+    def is_enabled(self):
+        return bool(self.file)
+
+    def _connect(self):
+        if self.__db is None:
+            db = sqlite3.connect(self.file, timeout=self.__conf['timeout'],
+                                 check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            with db:
+                for sql in self.__conf['schema']:
+                    db.execute(sql)
+            self.__db = db
+        return self.__db
+
+    @staticmethod
+    def get_date(item):
+        """Ledger date of a task
+
+        Args:
+          item (object): Task dict with a 'Date', or a date.
+
+        Returns:
+          str: ISO date, None without a date.
+        """
+        if isinstance(item, dict):
+            item = item.get('Date')
+        if item is None:
+            return None
+        return item.isoformat() if hasattr(item, 'isoformat') else str(item)
+
+    @classmethod
+    def _is_alive(cls, host, pid, run):
+        """Is the run of a running task alive
+        """
+        if host != socket.gethostname():
+            return True
+        if pid == os.getpid():
+            return run in cls.__runs
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except (PermissionError, OSError):
+            return True
+        return True
+
+    def claim(self, dates):
+        """Plan dates and claim the dates to run
+
+        The new dates are planned. The planned and failed dates,
+        and the running dates of a killed run on this host, are claimed.
+        The done dates, the running dates of another live run,
+        and the dates failed ``attempts`` times are skipped.
+
+        Args:
+          dates (iterable): Dates of the run.
+
+        Returns:
+          list: Claimed dates, in order of ``dates``,
+          all dates when the ledger is disabled.
+        """
+        dates = list(dates)
+        if not self.is_enabled:
+            return dates
+
+        keys = [self.get_date(date) for date in dates]
+        now = time.time()
+        host, pid = socket.gethostname(), os.getpid()
+        with self.__lock:
+            db = self._connect()
+            with db:
+                # BEGIN IMMEDIATE, two runs do not claim the same dates
+                db.execute('BEGIN IMMEDIATE')
+                rows = db.execute(
+                    'SELECT date, state, attempts, host, pid, run FROM tasks'
+                    ' WHERE product = ? AND labels = ?',
+                    (self.product, self.__key)).fetchall()
+                known = {row[0]: row[1:] for row in rows}
+
+                alive = {}
+                claimed = []
+                for key in keys:
+                    if key not in known:
+                        claimed.append(key)
+                        continue
+                    state, attempts, owner = known[key][0], known[key][1], \
+                        known[key][2:]
+                    if state == 'done':
+                        continue
+                    if state == 'running':
+                        if owner not in alive:
+                            alive[owner] = self._is_alive(*owner)
+                        if alive[owner]:
+                            continue
+                    if self.attempts is not None and state == 'failed' and \
+                            attempts >= self.attempts:
+                        continue
+                    claimed.append(key)
+
+                db.executemany(
+                    'INSERT OR IGNORE INTO tasks (product, labels, date, state,'
+                    ' updated) VALUES (?, ?, ?, ?, ?)',
+                    [(self.product, self.__key, key, 'planned', now)
+                     for key in keys if key not in known])
+                db.executemany(
+                    'UPDATE tasks SET state = ?, attempts = attempts + 1,'
+                    ' host = ?, pid = ?, run = ?, updated = ?'
+                    ' WHERE product = ? AND labels = ? AND date = ?',
+                    [('running', host, pid, self.__run, now,
+                      self.product, self.__key, key)
+                     for key in claimed])
+            self.__runs.add(self.__run)
+
+        claimed = set(claimed)
+        return [date for date, key in zip(dates, keys) if key in claimed]
+
+    def update(self, item, seconds=0., nbytes=0, is_done=False, error=None):
+        """Record task leaving a stage
+
+        The seconds and bytes of the stages of a task are added up,
+        the task is written when it is done.
+
+        Args:
+          item (dict): Task, with its 'Date'.
+          seconds (float): Seconds spent in the stage.
+          nbytes (int): Number of bytes transferred in the stage.
+          is_done (bool): Task left the last stage, or was dropped.
+          error (object): Error of a failed task, or the 'error' of the task.
+        """
+        if not self.is_enabled:
+            return
+        key = self.get_date(item)
+        if key is None:
+            return
+        if error is None and isinstance(item, dict):
+            error = item.get('error')
+
+        with self.__lock:
+            running = self.__running.setdefault(key, [0., 0])
+            running[0] += seconds
+            running[1] += nbytes
+            if not is_done and error is None:
+                return
+            del self.__running[key]
+            self.__updates.append((
+                'failed' if error is not None else 'done',
+                running[1], running[0],
+                None if error is None else repr(error),
+                time.time(), self.product, self.__key, key))
+            if len(self.__updates) >= self.batch:
+                self._flush()
+
+    def flush(self):
+        """Write updates
+        """
+        if not self.is_enabled:
+            return
+        with self.__lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.__updates:
+            return
+        db = self._connect()
+        with db:
+            db.executemany(
+                'UPDATE tasks SET state = ?, nbytes = ?, seconds = ?, error = ?,'
+                ' updated = ? WHERE product = ? AND labels = ? AND date = ?',
+                self.__updates)
+        self.__updates = []
+
+    def get(self):
+        """Get tasks of the product and labels by state
+
+        Returns:
+          dict: {'planned', 'running', 'done', 'failed', 'nbytes', 'seconds'}.
+
+        :Example:
+
+            >>> from wateraccounting.Collect.ledger import Ledger
+            >>> ledger = Ledger('CHIRPS', file=':memory:')
+            >>> ledger.claim(['2003-01-01', '2003-01-02'])
+            ['2003-01-01', '2003-01-02']
+            >>> ledger.update({'Date': '2003-01-01'}, is_done=True)
+            >>> ledger.flush()
+            >>> ledger.get()['done']
+            1
+        """
+        summary = {state: 0 for state in self.__conf['states']}
+        summary.update({'nbytes': 0, 'seconds': 0.})
+        if not self.is_enabled:
+            return summary
+
+        with self.__lock:
+            self._flush()
+            rows = self._connect().execute(
+                'SELECT state, COUNT(*), SUM(nbytes), SUM(seconds) FROM tasks'
+                ' WHERE product = ? AND labels = ? GROUP BY state',
+                (self.product, self.__key)).fetchall()
+        for state, count, nbytes, seconds in rows:
+            summary[state] = count
+            summary['nbytes'] += nbytes or 0
+            summary['seconds'] += seconds or 0.
+        return summary
+
+    def get_failed(self):
+        """Get failed tasks of the product and labels
+
+        Returns:
+          list: [(date, attempts, error), ...], in order of the dates.
+        """
+        if not self.is_enabled:
+            return []
+
+        with self.__lock:
+            self._flush()
+            return self._connect().execute(
+                'SELECT date, attempts, error FROM tasks'
+                ' WHERE product = ? AND labels = ? AND state = ? ORDER BY date',
+                (self.product, self.__key, 'failed')).fetchall()
+
+    def close(self):
+        """Write updates and close the ledger
+
+        The tasks still running, claimed but not updated, are planned again.
+        """
+        if not self.is_enabled:
+            return
+
+        with self.__lock:
+            self._flush()
+            if self.__db is not None:
+                with self.__db:
+                    self.__db.execute(
+                        'UPDATE tasks SET state = ?, attempts = attempts - 1'
+                        ' WHERE product = ? AND labels = ? AND state = ?'
+                        ' AND run = ?',
+                        ('planned', self.product, self.__key, 'running',
+                         self.__run))
+                self.__db.close()
+                self.__db = None
+            self.__running.clear()
+            self.__runs.discard(self.__run)
+
+
+def main():
+    import tempfile
+    from pprint import pprint
+
+    # Ledger __init__
+    print('\nLedger\n=====')
+    file = os.path.join(tempfile.mkdtemp(), 'collect.sqlite')
+    ledger = Ledger('CHIRPS', {'datatype': 'daily'}, file=file)
+    dates = ['2003-01-{:02d}'.format(i + 1) for i in range(10)]
+
+    # Ledger methods
+    print('\nledger.claim()\n=====')
+    pprint(ledger.claim(dates))
+    for i, date in enumerate(dates):
+        ledger.update({'Date': date}, 0.1, 1024, True,
+                      ValueError('missing') if i % 3 == 0 else None)
+    ledger.close()
+
+    print('\nledger.get()\n=====')
+    ledger = Ledger('CHIRPS', {'datatype': 'daily'}, file=file)
+    pprint(ledger.get())
+    pprint(ledger.claim(dates))
+    ledger.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+**Metrics**
+
+`Restrictions`
+
+The data and this python file may not be distributed to others without
+permission of the WA+ team.
+
+`Description`
+
+Per-file and per-stage metrics of the product downloads, for cron jobs.
+
+The stages of a file are connect, transfer, decompress, decode, clip and write,
+the steps of the ``Pipeline`` stages, download, decode and save,
+and wait, time spent waiting on a lock.
+A stage function times its steps with ``Metrics.timer`` in the task dict,
+together with 'nbytes', 'nbytes_out', 'retries' and 'cache_hit',
+the ``Pipeline`` and ``Download.map`` collect them, also from process workers.
+
+The metrics are exported as JSON lines, one line per file and stage and
+one summary line per run, and as a Prometheus textfile, for the textfile
+collector of the node exporter. The files are set by arguments or by the
+``WA_METRICS_JSONL`` file and the ``WA_METRICS_TEXTFILE`` directory
+environment variables.
+
+**Examples:**
+::
+
+    from wateraccounting.Collect.metrics import Metrics
+    metrics = Metrics('CHIRPS', {'datatype': 'daily'}, jsonl='collect.jsonl')
+    task = {}
+    with Metrics.timer(task, 'transfer'):
+        task['nbytes'] = 1024 ** 2
+    metrics.record(task, 'download', files=1)
+    metrics.close()
+"""
+import os
+# import sys
+# import inspect
+# import shutil
+# import yaml
+
+import json
+import time
+import datetime
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    from .trace import Trace
+except ImportError:
+    from src.wateraccounting.Collect.trace import Trace
+
+
+class Metrics(object):
+    """This Metrics class
+
+    Thread-safe metrics of a run.
+
+    Args:
+      product (str): Product name, 'CHIRPS'.
+      labels (dict): Other labels, {'datatype': 'daily'}.
+      jsonl (str): JSON lines file, appended, default ``WA_METRICS_JSONL``.
+      textfile (str): Prometheus textfile, or a directory to write
+        'wa_collect_<product>_<labels>.prom' in, default ``WA_METRICS_TEXTFILE``.
+    """
+    __conf = {
+        'env': {
+            'jsonl': 'WA_METRICS_JSONL',
+            'textfile': 'WA_METRICS_TEXTFILE'
+        },
+        'prefix': 'wa_collect',
+        'counters': ['files', 'errors', 'retries', 'cache_hits',
+                     'nbytes_in', 'nbytes_out']
+    }
+
+    def __init__(self, product='', labels=None, jsonl=None, textfile=None):
+        """Class instantiation
+        """
+        self.product = product
+        self.labels = dict(labels) if labels is not None else {}
+        self.jsonl = jsonl if jsonl is not None else os.environ.get(
+            self.__conf['env']['jsonl'])
+        self.textfile = textfile if textfile is not None else os.environ.get(
+            self.__conf['env']['textfile'])
+
+        self.counters = {key: 0 for key in self.__conf['counters']}
+        self.stages = {}
+        # Per-file records are only kept to be written as JSON lines
+        self.records = []
+
+        self.__lock = threading.Lock()
+        self.__start = time.time()
+
+    @staticmethod
+    @contextmanager
+    def timer(task, stage):
+        """Time a step of a task
+
+        The seconds are added to ``task['timings'][stage]``,
+        also when the step fails. The step is a span of the active ``Trace``.
+
+        Args:
+          task (dict): Task of a ``Pipeline`` stage function.
+          stage (str): 'connect', 'transfer', 'decompress', 'decode',
+            'clip' or 'write'.
+        """
+        t0 = time.time()
+        try:
+            yield task
+        finally:
+            t1 = time.time()
+            timings = task.setdefault('timings', {})
+            timings[stage] = timings.get(stage, 0.) + t1 - t0
+            Trace.record(stage, t0, t1, task)
+
+    def observe(self, stage, seconds, count=1):
+        """Add duration of stage
+
+        Args:
+          stage (str): Stage name.
+          seconds (float): Seconds spent in the stage.
+          count (int): Number of observations.
+        """
+        with self.__lock:
+            self._observe(stage, seconds, count)
+
+    def _observe(self, stage, seconds, count=1):
+        counter = self.stages.setdefault(
+            stage, {'count': 0, 'seconds': 0., 'max': 0.})
+        counter['count'] += count
+        counter['seconds'] += seconds
+        counter['max'] = max(counter['max'], seconds)
+
+    def count(self, key, value=1):
+        """Add to counter
+
+        Args:
+          key (str): 'files', 'errors', 'retries', 'cache_hits',
+            'nbytes_in' or 'nbytes_out'.
+          value (int): Value.
+        """
+        with self.__lock:
+            self.counters[key] += value
+
+    def record(self, item=None, stage=None, seconds=None, nbytes=0, files=0,
+               errors=0):
+        """Record item leaving a stage
+
+        The keys 'timings', 'nbytes_out', 'retries' and 'cache_hit'
+        are popped from a dict item, so they are counted once.
+
+        Args:
+          item (dict): Task, other items only count files and errors.
+          stage (str): Stage name, 'download'.
+          seconds (float): Seconds spent in the stage.
+          nbytes (int): Number of bytes transferred.
+          files (int): Number of files done.
+          errors (int): Number of files failed.
+        """
+        timings, nbytes_out, retries, cache_hits = {}, 0, 0, 0
+        if isinstance(item, dict):
+            timings = item.pop('timings', {})
+            nbytes_out = item.pop('nbytes_out', 0)
+            retries = item.pop('retries', 0)
+            cache_hits = int(bool(item.pop('cache_hit', False)))
+
+        with self.__lock:
+            self.counters['files'] += files
+            self.counters['errors'] += errors
+            self.counters['retries'] += retries
+            self.counters['cache_hits'] += cache_hits
+            self.counters['nbytes_in'] += nbytes
+            self.counters['nbytes_out'] += nbytes_out
+            if stage is not None and seconds is not None:
+                self._observe(stage, seconds)
+            for key, value in timings.items():
+                self._observe(key, value)
+
+            if self.jsonl:
+                self.records.append({
+                    'type': 'file',
+                    'time': time.time(),
+                    'product': self.product,
+                    'labels': self.labels,
+                    'date': self._get_date(item),
+                    'file': item.get('file') if isinstance(item, dict) else None,
+                    'stage': stage,
+                    'seconds': seconds,
+                    'timings': timings,
+                    'nbytes_in': nbytes,
+                    'nbytes_out': nbytes_out,
+                    'retries': retries,
+                    'cache_hit': bool(cache_hits),
+                    'error': bool(errors)
+                })
+
+    @staticmethod
+    def _get_date(item):
+        if not isinstance(item, dict) or item.get('Date') is None:
+            return None
+        date = item['Date']
+        return date.isoformat() if hasattr(date, 'isoformat') else str(date)
+
+    def get(self):
+        """Get summary of the run
+
+        Returns:
+          dict: {'product', 'labels', 'start', 'seconds', 'files', 'errors',
+          'retries', 'cache_hits', 'nbytes_in', 'nbytes_out', 'mbps',
+          'files_per_hour', 'stages': {stage: {'count', 'seconds', 'max'}}}.
+
+        :Example:
+
+            >>> from wateraccounting.Collect.metrics import Metrics
+            >>> metrics = Metrics('CHIRPS')
+            >>> metrics.record({'timings': {'transfer': 0.5}}, files=1)
+            >>> metrics.get()['stages']['transfer']['seconds']
+            0.5
+        """
+        with self.__lock:
+            seconds = max(time.time() - self.__start, 1.0e-9)
+            summary = {
+                'product': self.product,
+                'labels': dict(self.labels),
+                'start': self.__start,
+                'seconds': seconds
+            }
+            summary.update(self.counters)
+            summary['mbps'] = self.counters['nbytes_in'] / 1024. ** 2 / seconds
+            summary['files_per_hour'] = self.counters['files'] * 3600. / seconds
+            summary['stages'] = {stage: dict(counter)
+                                 for stage, counter in self.stages.items()}
+        return summary
+
+    def to_jsonl(self, file):
+        """Append records and summary to JSON lines file
+
+        Args:
+          file (str): JSON lines file.
+        """
+        with self.__lock:
+            records = self.records
+            self.records = []
+
+        summary = dict(self.get(), type='summary')
+        summary['time'] = time.time()
+        with open(file, 'a') as fp:
+            for record in records + [summary]:
+                fp.write('{}\n'.format(json.dumps(record, default=str)))
+
+    def to_prometheus(self):
+        """Format summary as Prometheus text
+
+        The values are gauges of the last run.
+
+        Returns:
+          str: Prometheus text exposition format.
+        """
+        summary = self.get()
+        prefix = self.__conf['prefix']
+        labels = dict(self.labels, product=self.product)
+
+        lines = []
+
+        def add(name, text, value, **kwargs):
+            metric = '{p}_{n}'.format(p=prefix, n=name)
+            if '# TYPE {} gauge'.format(metric) not in lines:
+                lines.append('# HELP {m} {h}'.format(m=metric, h=text))
+                lines.append('# TYPE {} gauge'.format(metric))
+            lines.append('{m}{{{l}}} {v}'.format(
+                m=metric, l=self._format_labels(dict(labels, **kwargs)),
+                v=repr(float(value))))
+
+        add('last_run_timestamp_seconds', 'End time of the last run.', time.time())
+        add('run_seconds', 'Duration of the last run.', summary['seconds'])
+        add('files', 'Files done in the last run.', summary['files'])
+        add('errors', 'Files failed in the last run.', summary['errors'])
+        add('retries', 'Retries in the last run.', summary['retries'])
+        add('cache_hits', 'Files found locally in the last run.',
+            summary['cache_hits'])
+        add('bytes', 'Bytes in the last run.', summary['nbytes_in'],
+            direction='in')
+        add('bytes', 'Bytes in the last run.', summary['nbytes_out'],
+            direction='out')
+        add('mbps', 'Download MB/s of the last run.', summary['mbps'])
+        add('files_per_hour', 'Files per hour of the last run.',
+            summary['files_per_hour'])
+        for stage, counter in sorted(summary['stages'].items()):
+            add('stage_seconds', 'Seconds spent in stage.', counter['seconds'],
+                stage=stage)
+            add('stage_count', 'Number of observations of stage.',
+                counter['count'], stage=stage)
+            add('stage_max_seconds', 'Longest observation of stage.',
+                counter['max'], stage=stage)
+
+        return '\n'.join(lines) + '\n'
+
+    def to_textfile(self, file):
+        """Write Prometheus textfile
+
+        The file is replaced atomically, the collector never reads half a file.
+
+        Args:
+          file (str): Textfile, or directory.
+
+        Returns:
+          str: Textfile.
+        """
+        if os.path.isdir(file):
+            name = '_'.join([self.__conf['prefix'], self.product] +
+                            [str(self.labels[key]) for key in sorted(self.labels)])
+            file = os.path.join(file, '{}.prom'.format(
+                ''.join(c if c.isalnum() else '_' for c in name)))
+
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp',
+                                   dir=os.path.dirname(os.path.abspath(file)))
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(self.to_prometheus())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, file)
+        return file
+
+    @staticmethod
+    def _format_labels(labels):
+        return ','.join(
+            '{k}="{v}"'.format(k=key, v=str(labels[key]).replace('\\', '\\\\')
+                               .replace('"', '\\"').replace('\n', '\\n'))
+            for key in sorted(labels))
+
+    def close(self):
+        """Export metrics to the configured files
+        """
+        if self.jsonl:
+            self.to_jsonl(self.jsonl)
+        if self.textfile:
+            self.to_textfile(self.textfile)
+
+
+def main():
+    from pprint import pprint
+
+    # Metrics __init__
+    print('\nMetrics\n=====')
+    metrics = Metrics('CHIRPS', {'datatype': 'daily'})
+    for i in range(10):
+        task = {'Date': datetime.date(2003, 1, i + 1)}
+        with Metrics.timer(task, 'transfer'):
+            time.sleep(0.01)
+        metrics.record(task, 'download', 0.01, nbytes=1024 ** 2, files=1)
+
+    # Metrics methods
+    print('\nmetrics.get()\n=====')
+    pprint(metrics.get())
+
+    print('\nmetrics.to_prometheus()\n=====')
+    print(metrics.to_prometheus())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""
+**Planner**
+
+`Restrictions`
+
+The data and this python file may not be distributed to others without
+permission of the WA+ team.
+
+`Description`
+
+Dry run of a download, to size and schedule a job before downloading.
+
+The request, product, dataset, version, datatype, variables, bounding box
+and dates, is expanded from ``base.yml`` into tasks, one per variable
+and date, with the remote file, ``dir`` + ``rmtname``, and the local file,
+``locfile``. The plan reports the tasks already satisfied by a local file,
+the remote bytes to fetch, from FTP ``SIZE`` or HTTP ``HEAD``,
+the output bytes and the expected runtime from the throughput of earlier
+runs, the summary lines of the ``Metrics`` JSON lines file.
+
+**Examples:**
+::
+
+    from wateraccounting.Collect.planner import Planner
+    planner = Planner('CHIRPS', 'Precipitation', 'v2', 'daily',
+                      latlim=[-10, 30], lonlim=[-20, -10],
+                      Startdate='2003-01-01', Enddate='2003-12-31',
+                      folder='C:/Temp/Precipitation/CHIRPS/Daily')
+    print(planner.format(planner.plan()))
+"""
+import os
+# import sys
+# import inspect
+# import shutil
+# import yaml
+
+import json
+import ftplib
+import datetime
+import posixpath
+import urllib.request
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+
+try:
+    from .base import Base
+except ImportError:
+    from src.wateraccounting.Collect.base import Base
+
+try:
+    from .download import Download
+except ImportError:
+    from src.wateraccounting.Collect.download import Download
+
+try:
+    from .grid import Grid
+except ImportError:
+    from src.wateraccounting.Collect.grid import Grid
+
+
+class Planner(object):
+    """This Planner class
+
+    Args:
+      product (str): Product name, 'CHIRPS'.
+      dataset (str): Dataset name, 'Precipitation'.
+      version (str): Version name, 'v2'.
+      datatype (str): Data type, 'daily'.
+      variables (list): Variable names, default all variables of the datatype.
+      latlim (list): [ymin, ymax], default the grid extent.
+      lonlim (list): [xmin, xmax], default the grid extent.
+      Startdate (str): 'yyyy-mm-dd', default the first date of the product.
+      Enddate (str): 'yyyy-mm-dd', default the last date of the product.
+      folder (str): Directory of the local files.
+      history (str): Metrics JSON lines file, default ``WA_METRICS_JSONL``.
+
+    Raises:
+      KeyError: Product not found in ``base.yml``.
+      ValueError: Dates outside the time range of the product.
+    """
+    __conf = {
+        'env': 'WA_METRICS_JSONL',
+        'timeout': 30.
+    }
+
+    def __init__(self, product, dataset, version, datatype, variables=None,
+                 latlim=None, lonlim=None, Startdate=None, Enddate=None,
+                 folder='', history=None):
+        """Class instantiation
+        """
+        key = (product, dataset, version, datatype)
+        conf = Base.check_conf('data', is_status=False)
+        try:
+            self.conf = conf['products'][product]['data'][dataset][version][datatype]
+            names = list(self.conf['variables'])
+        except (KeyError, TypeError):
+            raise KeyError('Product "{k}" not found in "{f}".'
+                           .format(k='.'.join(key), f='base.yml'))
+        if self.conf.get('freq', '-') == '-':
+            raise ValueError('Product "{k}" has no time series, freq "{v}".'
+                             .format(k='.'.join(key), v=self.conf.get('freq')))
+
+        self.key = key
+        self.product, self.dataset, self.version, self.datatype = key
+        self.variables = names if variables is None else list(variables)
+        for variable in self.variables:
+            if variable not in names:
+                raise KeyError('Variable "{v}" not found in "{k}".'
+                               .format(v=variable, k='.'.join(key)))
+
+        self.folder = folder
+        self.history = history if history is not None else os.environ.get(
+            self.__conf['env'])
+
+        # Window of each variable
+        self.windows = {}
+        for variable in self.variables:
+            grid = Grid.from_conf(product, dataset, version, datatype, variable)
+            lat = [grid.lat['s'], grid.lat['n']] if latlim is None else latlim
+            lon = [grid.lon['w'], grid.lon['e']] if lonlim is None else lonlim
+            self.windows[variable] = grid.window(*grid.check_latlon(lat, lon))
+
+        # Dates, checked against the time range of each variable
+        first, last = self.get_time_range()
+        self.Startdate = first if not Startdate else pd.Timestamp(Startdate)
+        self.Enddate = last if not Enddate else pd.Timestamp(Enddate)
+        for date in (self.Startdate, self.Enddate):
+            if date < first or date > last:
+                raise ValueError('Date "{v}" out of range "{s}" - "{e}" of "{k}".'
+                                 .format(v=date.strftime('%Y-%m-%d'),
+                                         s=first.strftime('%Y-%m-%d'),
+                                         e=last.strftime('%Y-%m-%d'),
+                                         k='.'.join(key)))
+        if self.Startdate > self.Enddate:
+            raise ValueError('Startdate "{s}" after Enddate "{e}".'.format(
+                s=self.Startdate.strftime('%Y-%m-%d'),
+                e=self.Enddate.strftime('%Y-%m-%d')))
+
+        self.dates = pd.date_range(self.Startdate, self.Enddate,
+                                   freq=self.conf['freq'])
+
+    def get_time_range(self):
+        """Get time range of the variables
+
+        ``e: '-'`` is today.
+
+        Returns:
+          tuple: (first, last), :obj:`pandas.Timestamp`,
+          the range shared by all variables.
+        """
+        first, last = None, None
+        for variable in self.variables:
+            time = self.conf['variables'][variable]['time']
+            start = pd.Timestamp(time['s'])
+            end = pd.Timestamp('today').normalize() if time['e'] == '-' \
+                else pd.Timestamp(time['e'])
+            first = start if first is None else max(first, start)
+            last = end if last is None else min(last, end)
+        return first, last
+
+    @staticmethod
+    def get_fields(date, variable):
+        """Fields of ``dir``, ``rmtname`` and ``locfile``
+
+        Returns:
+          dict: {'Y', 'm', 'd', 'j', 'var', 'Var', 'VAR'}.
+        """
+        return {
+            'Y': '{:04d}'.format(date.year),
+            'm': '{:02d}'.format(date.month),
+            'd': '{:02d}'.format(date.day),
+            'j': '{:03d}'.format(date.timetuple().tm_yday),
+            'var': variable,
+            'Var': variable,
+            'VAR': variable.upper()
+        }
+
+    def get_tasks(self):
+        """Expand request into tasks
+
+        Returns:
+          list: [{'Date', 'variable', 'remote', 'local', 'exists'}, ...],
+          'remote' is the path on the server, 'local' the output file.
+        """
+        tasks = []
+        for variable in self.variables:
+            for date in self.dates:
+                fields = self.get_fields(date, variable)
+                remote = posixpath.join(self.conf['dir'].format(**fields),
+                                        self.conf['rmtname'].format(**fields))
+                local = os.path.join(self.folder,
+                                     self.conf['locfile'].format(**fields))
+                tasks.append({
+                    'Date': date,
+                    'variable': variable,
+                    'remote': remote,
+                    'local': local,
+                    'exists': os.path.exists(local)
+                })
+        return tasks
+
+    def get_sizes(self, paths):
+        """Get sizes of remote files
+
+        The sizes are requested with one FTP connection, ``SIZE``,
+        or with HTTP ``HEAD`` requests.
+
+        Args:
+          paths (list): Remote paths.
+
+        Returns:
+          dict: {path: bytes}, None when not found or not reported.
+        """
+        url = Download.get_url(*self.key)
+        sizes = {path: None for path in paths}
+        if not paths:
+            return sizes
+
+        parts = urlparse(url)
+        if parts.scheme == 'ftp':
+            ftp = ftplib.FTP()
+            ftp.connect(parts.hostname, parts.port or 21,
+                        timeout=self.__conf['timeout'])
+            ftp.login()
+            ftp.voidcmd('TYPE I')
+            for path in paths:
+                try:
+                    sizes[path] = ftp.size(path)
+                except ftplib.error_perm:
+                    sizes[path] = None
+            ftp.quit()
+        else:
+            for path in paths:
+                request = urllib.request.Request(url + path, method='HEAD')
+                try:
+                    with urllib.request.urlopen(
+                            request, timeout=self.__conf['timeout']) as response:
+                        length = response.headers.get('Content-Length')
+                    sizes[path] = int(length) if length is not None else None
+                except (OSError, ValueError):
+                    sizes[path] = None
+
+        return sizes
+
+    def get_throughput(self):
+        """Get throughput of earlier runs
+
+        Returns:
+          dict: {'runs', 'seconds', 'files', 'nbytes_in', 'nbytes_out'},
+          totals of the summary lines of this product and datatype,
+          None without history.
+        """
+        if not self.history or not os.path.exists(self.history):
+            return None
+
+        total = {'runs': 0, 'seconds': 0., 'files': 0, 'nbytes_in': 0,
+                 'nbytes_out': 0}
+        with open(self.history) as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('type') != 'summary' or \
+                        record.get('product') != self.product:
+                    continue
+                labels = record.get('labels', {})
+                if labels.get('datatype', self.datatype) != self.datatype:
+                    continue
+                total['runs'] += 1
+                for key in ('seconds', 'files', 'nbytes_in', 'nbytes_out'):
+                    total[key] += record.get(key, 0)
+
+        return total if total['files'] > 0 else None
+
+    def plan(self, is_remote=True):
+        """Plan download
+
+        Args:
+          is_remote (bool): Is to request the remote sizes.
+
+        Returns:
+          dict: {'tasks', 'satisfied', 'todo', 'files', 'remote_nbytes',
+          'remote_unknown', 'output_nbytes', 'output_estimate', 'seconds',
+          'todo_tasks'}. 'remote_nbytes' counts each remote file once,
+          files of unknown size count as the mean known size.
+          'output_estimate' is 'history' or 'raw', the uncompressed size.
+          'seconds' is None without history.
+
+        :Example:
+
+            >>> from wateraccounting.Collect.planner import Planner
+            >>> planner = Planner('CHIRPS', 'Precipitation', 'v2', 'daily',
+            ...                   Startdate='2003-01-01', Enddate='2003-01-10')
+            >>> planner.plan(is_remote=False)['todo']
+            10
+        """
+        tasks = self.get_tasks()
+        todo = [task for task in tasks if not task['exists']]
+
+        # A remote file can serve many tasks, CFSR monthly grib files
+        remotes = []
+        for task in todo:
+            if task['remote'] not in remotes:
+                remotes.append(task['remote'])
+
+        sizes = self.get_sizes(remotes) if is_remote else {
+            path: None for path in remotes}
+        known = [size for size in sizes.values() if size is not None]
+        unknown = len(sizes) - len(known)
+        remote_nbytes = sum(known)
+        if known and unknown:
+            remote_nbytes += int(np.mean(known)) * unknown
+
+        history = self.get_throughput()
+        if history is not None and history['nbytes_out'] > 0:
+            output_nbytes = int(history['nbytes_out'] / history['files'] * len(todo))
+            output_estimate = 'history'
+        else:
+            output_nbytes = 0
+            for task in todo:
+                yID, xID = self.windows[task['variable']]
+                output_nbytes += (yID[1] - yID[0]) * (xID[1] - xID[0]) * \
+                    np.dtype(self.conf['dtype']['o']).itemsize
+            output_estimate = 'raw'
+
+        seconds = None
+        if history is not None and history['seconds'] > 0:
+            bps = history['nbytes_in'] / history['seconds']
+            if known and bps > 0:
+                seconds = remote_nbytes / bps
+            else:
+                seconds = len(todo) * history['seconds'] / history['files']
+
+        return {
+            'tasks': len(tasks),
+            'satisfied': len(tasks) - len(todo),
+            'todo': len(todo),
+            'files': len(remotes),
+            'remote_nbytes': remote_nbytes,
+            'remote_unknown': unknown,
+            'output_nbytes': output_nbytes,
+            'output_estimate': output_estimate,
+            'seconds': seconds,
+            'todo_tasks': todo
+        }
+
+    def format(self, plan):
+        """Format plan
+
+        Args:
+          plan (dict): Plan.
+
+        Returns:
+          str: Report.
+        """
+        if plan['seconds'] is None:
+            runtime = 'unknown, no history'
+        else:
+            runtime = str(datetime.timedelta(seconds=int(round(plan['seconds']))))
+
+        return '\n'.join([
+            '{k} {s} - {e}'.format(k='.'.join(self.key),
+                                   s=self.Startdate.strftime('%Y-%m-%d'),
+                                   e=self.Enddate.strftime('%Y-%m-%d')),
+            '  tasks:     {n}, {s} satisfied locally, {t} to do'.format(
+                n=plan['tasks'], s=plan['satisfied'], t=plan['todo']),
+            '  remote:    {n} files, {b:.1f} MB, {u} of unknown size'.format(
+                n=plan['files'], b=plan['remote_nbytes'] / 1024. ** 2,
+                u=plan['remote_unknown']),
+            '  output:    {b:.1f} MB ({e})'.format(
+                b=plan['output_nbytes'] / 1024. ** 2, e=plan['output_estimate']),
+            '  runtime:   {}'.format(runtime)
+        ])
+
+
+def main():
+    from pprint import pprint
+
+    # Planner __init__
+    print('\nPlanner\n=====')
+    planner = Planner('CHIRPS', 'Precipitation', 'v2', 'daily',
+                      latlim=[-10, 30], lonlim=[-20, -10],
+                      Startdate='2003-01-01', Enddate='2003-01-31')
+
+    # Planner methods
+    print('\nplanner.plan()\n=====')
+    plan = planner.plan(is_remote=False)
+    pprint(plan['todo_tasks'][:2])
+    print(planner.format(plan))
+
+
+if __name__ == "__main__":
+    main()
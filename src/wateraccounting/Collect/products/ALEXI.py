@@ -32,12 +32,15 @@ the **total evaporation** in ``mm`` for the period of ``1 January - 7 January``.
 import os
 # import sys
 import glob
+import gzip
 # import shutil
 
 import math
 import datetime
+import functools
 
 from ftplib import FTP
+from urllib.parse import urlparse
 
 import numpy as np
 import pandas as pd
@@ -45,12 +48,23 @@ import pandas as pd
 
 # Water Accounting Modules
 try:
-    from .download import Download
+    from ..download import Download
+    from ..grid import Grid
+    from ..progress import Progress
+    from ..metrics import Metrics
+    from ..trace import Trace
+    from ..transform import Transform
 except ImportError:
     from src.wateraccounting.Collect.download import Download
+    from src.wateraccounting.Collect.grid import Grid
+    from src.wateraccounting.Collect.progress import Progress
+    from src.wateraccounting.Collect.metrics import Metrics
+    from src.wateraccounting.Collect.trace import Trace
+    from src.wateraccounting.Collect.transform import Transform
 
 
-def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, TimeStep, Waitbar):
+def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, TimeStep, Waitbar,
+                 cores=False):
     """Downloads ALEXI ET data
 
     This scripts downloads ALEXI ET data from the UNESCO-IHE ftp server.
@@ -66,6 +80,8 @@ def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, TimeStep, Waitbar):
       TimeStep (str): 'daily' or 'weekly' (by using here monthly,
         an older dataset will be used).
       Waitbar (bool): Waitbar.
+      cores (int): Number of download threads,
+        False runs serial.
 
     Returns:
       str: TimeStep, 'daily' or 'weekly'.
@@ -76,14 +92,12 @@ def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, TimeStep, Waitbar):
         Example
     """
     # Check the latitude and longitude and otherwise set lat or lon on greatest extent
-    if latlim[0] < -60 or latlim[1] > 70:
-        print('Latitude above 70N or below 60S is not possible. Value set to maximum')
-        latlim[0] = np.max(latlim[0], -60)
-        latlim[1] = np.min(latlim[1], 70)
-    if lonlim[0] < -180 or lonlim[1] > 180:
-        print('Longitude must be between 180E and 180W. Now value is set to maximum')
-        lonlim[0] = np.max(lonlim[0], -180)
-        lonlim[1] = np.min(lonlim[1], 180)
+    grid = Grid.from_conf('ALEXI', 'Evaporation', 'v1', TimeStep, 'ETa')
+    latlim, lonlim = grid.check_latlon(latlim, lonlim)
+
+    # Define IDs
+    yID, xID = grid.window(latlim, lonlim)
+    geo = grid.window_geo(yID, xID)
 
     # Check Startdate and Enddate
     if not Startdate:
@@ -141,130 +155,145 @@ def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, TimeStep, Waitbar):
         if not os.path.exists(output_folder):
             os.makedirs(output_folder)
 
-    # Create Waitbar
+    # Amount of files for the progress
     total_amount = len(Dates)
-    if Waitbar == 1:
-        amount = 0
-        collect.WaitBar(amount, total_amount,
-                        prefix='ALEXI:', suffix='Complete',
-                        length=50)
+
+    # FTP account and the outputs
+    download = Download('', 'FTP_WA', is_status=False)
 
     if TimeStep == 'weekly':
-        ALEXI_weekly(Date, Enddate,
-                     output_folder, latlim, lonlim,
+        ALEXI_weekly(download, Date, Enddate,
+                     output_folder, yID, xID, geo,
                      Year,
                      Waitbar,
-                     total_amount, TimeStep)
+                     total_amount, TimeStep, cores)
         return 'weekly'
 
     if TimeStep == 'daily':
-        ALEXI_daily(Dates,
-                    output_folder, latlim, lonlim,
+        ALEXI_daily(download, Dates,
+                    output_folder, yID, xID, geo,
                     Waitbar,
-                    total_amount, TimeStep)
+                    total_amount, TimeStep, cores)
         return 'daily'
 
 
-def Download_ALEXI_from_WA_FTP(local_filename, DirFile, filename,
-                               lonlim, latlim, yID, xID, TimeStep):
+def Download_ALEXI_from_WA_FTP(download, local_filename, DirFile, filename,
+                               geo, yID, xID, TimeStep):
     """Retrieves ALEXI data
 
     This function retrieves ALEXI data for a given date from the
     `<ftp.wateraccounting.unesco-ihe.org>`_ server.
 
     Args:
+      download (:obj:`Download`): Download, with the 'FTP_WA' account.
       local_filename (str): name of the temporary file which contains global ALEXI data.
       DirFile (str): name of the end file with the weekly ALEXI data.
       filename (str): name of the end file.
-      latlim (list): [ymin, ymax] (values must be between -60 and 70).
-      lonlim (list): [xmin, xmax] (values must be between -180 and 180).
-      yID (list): latlim to index.
-      xID (list): lonlim to index.
+      geo (list): Geospatial dataset of the clipped window.
+      yID (tuple): latlim to index.
+      xID (tuple): lonlim to index.
       TimeStep (str): 'daily' or 'weekly'  (by using here monthly,
         an older dataset will be used).
 
+    Returns:
+      int: Number of bytes downloaded.
+
     :Example:
 
         >>> print('Example')
         Example
     """
     # Collect account and FTP information
-    ftpserver = "ftp.wateraccounting.unesco-ihe.org"
-    user = collect.get_user('FTP_WA')
+    url = urlparse(Download.get_url('ALEXI', 'Evaporation', 'v1', TimeStep))
+    user = download.get_user('account')['FTP_WA']
     username = user['username']
     password = user['password']
 
     # Download data from FTP
-    ftp = FTP(ftpserver)
+    ftp = FTP()
+    ftp.connect(url.hostname, url.port or 21)
     ftp.login(username, password)
     if TimeStep == "weekly":
         directory = "/WaterAccounting/Data_Satellite/Evaporation/ALEXI/World/"
     if TimeStep == "daily":
         directory = "/WaterAccounting/Data_Satellite/Evaporation/ALEXI/World_05182018/"
     ftp.cwd(directory)
-    lf = open(local_filename, "wb")
-    ftp.retrbinary("RETR " + filename, lf.write)
-    lf.close()
+    if TimeStep == "daily" and Download.is_vsimem():
+        # Keep the global file in memory
+        local_filename = Download.get_buffer(
+            lambda write: ftp.retrbinary("RETR " + filename, write))
+        nbytes = len(local_filename)
+    else:
+        lf = open(local_filename, "wb")
+        ftp.retrbinary("RETR " + filename, lf.write)
+        lf.close()
+        nbytes = os.path.getsize(local_filename)
 
     if TimeStep == "daily":
-        collect.Extract_Data_gz(local_filename, os.path.splitext(local_filename)[0])
-
-        raw_data = np.fromfile(os.path.splitext(local_filename)[0], dtype="<f4")
-        dataset = np.flipud(np.resize(raw_data, [3000, 7200]))
-        # Values are in MJ/m2d so convert to mm/d
-        data = dataset[yID[0]:yID[1], xID[0]:xID[1]] / 2.45  # mm/d
-        data[data < 0] = -9999
+        data = Decode_ALEXI_daily(local_filename, yID, xID)
+        if not isinstance(local_filename, bytes):
+            os.remove(local_filename)
 
     if TimeStep == "weekly":
         # Open global ALEXI data
-        dataset = collect.Open_tiff_array(local_filename)
+        dataset = download.get_tif(local_filename, 1)
+        download.close_tif(local_filename)
 
-        # Clip extend out of world data
-        data = dataset[yID[0]:yID[1], xID[0]:xID[1]]
-        data[data < 0] = -9999
+        # Clip extend out of world data, the steps of base.yml
+        transform = Transform.from_conf('ALEXI', 'Evaporation', 'v1', 'weekly',
+                                        'ETa')
+        data = transform(dataset, yID, xID)
 
     # make geotiff file
-    geo = [lonlim[0], 0.05, 0, latlim[1], 0, -0.05]
-    collect.Save_as_tiff(name=DirFile, data=data, geo=geo, projection="WGS84")
-    return
-
-
-def ALEXI_daily(Dates, output_folder, latlim, lonlim, Waitbar, total_amount, TimeStep):
-    amount = 0
-    for Date in Dates:
-
-        # Date as printed in filename
-        DirFile = os.path.join(output_folder,
-                               'ETa_ALEXI_CSFR_mm-day-1_daily_%d.%02d.%02d.tif' % (
-                                   Date.year, Date.month, Date.day))
-        DOY = Date.timetuple().tm_yday
-
-        # Define end filename
-        filename = "EDAY_CERES_%d%03d.dat.gz" % (Date.year, DOY)
-
-        # Temporary filename for the downloaded global file
-        local_filename = os.path.join(output_folder, filename)
-
-        # Define IDs
-        yID = 3000 - np.int16(
-            np.array([np.ceil((latlim[1] + 60) * 20), np.floor((latlim[0] + 60) * 20)]))
-        xID = np.int16(
-            np.array([np.floor((lonlim[0]) * 20), np.ceil((lonlim[1]) * 20)]) + 3600)
-
-        # Download the data from FTP server if the file not exists
-        if not os.path.exists(DirFile):
-            try:
-                Download_ALEXI_from_WA_FTP(local_filename, DirFile, filename, lonlim,
-                                           latlim, yID, xID, TimeStep)
-            except BaseException:
-                print("\nWas not able to download file with date %s" % Date)
-
-        # Adjust waitbar
-        if Waitbar == 1:
-            amount += 1
-            collect.WaitBar(amount, total_amount,
-                            prefix='ALEXI:', suffix='Complete',
-                            length=50)
+    encoding = download.get_encoding('ALEXI', 'Evaporation', 'v1', TimeStep, 'ETa')
+    download.save_tif(DirFile, data, geo, "WGS84", encoding,
+                      clip=download.get_clip())
+    return nbytes
+
+
+def Decode_ALEXI_daily(local_filename, yID, xID):
+    """Decodes daily ALEXI data
+
+    This function unzips the global daily ALEXI file in memory,
+    and clips the data.
+
+    Args:
+      local_filename (str): name of the global ALEXI file, '.dat.gz',
+        or the bytes of the file.
+      yID (tuple): latlim to index.
+      xID (tuple): lonlim to index.
+
+    Returns:
+      :obj:`numpy.ndarray`: Clipped ET in mm/d, -9999 as nodata.
+    """
+    if isinstance(local_filename, bytes):
+        raw_data = np.frombuffer(gzip.decompress(local_filename), dtype="<f4")
+    else:
+        with gzip.open(local_filename, 'rb') as fp:
+            raw_data = np.frombuffer(fp.read(), dtype="<f4")
+
+    grid = Grid.from_conf('ALEXI', 'Evaporation', 'v1', 'daily', 'ETa')
+    if raw_data.size == grid.shape[0] * grid.shape[1]:
+        dataset = raw_data.reshape(grid.shape)
+    else:
+        dataset = np.resize(raw_data, grid.shape)
+
+    # North-up, values from MJ/m2d to mm/d, and nodata, the steps of base.yml
+    transform = Transform.from_conf('ALEXI', 'Evaporation', 'v1', 'daily', 'ETa')
+    return transform(dataset, yID, xID)
+
+
+def ALEXI_daily(download, Dates, output_folder, yID, xID, geo, Waitbar, total_amount,
+                TimeStep, cores=False):
+    args = [download, output_folder, yID, xID, geo, TimeStep]
+    progress = Progress(total_amount, prefix='ALEXI:', is_print=Waitbar == 1)
+    metrics = Metrics('ALEXI', {'dataset': 'Evaporation', 'datatype': TimeStep})
+    trace = Trace(metrics.product, metrics.labels).start()
+    Download.map(functools.partial(ALEXI_daily_file, args=args), Dates,
+                 'thread', cores, progress=progress, metrics=metrics)
+    progress.close()
+    metrics.close()
+    trace.stop()
 
     os.chdir(output_folder)
     re = glob.glob("*.dat")
@@ -272,46 +301,59 @@ def ALEXI_daily(Dates, output_folder, latlim, lonlim, Waitbar, total_amount, Tim
         os.remove(os.path.join(output_folder, f))
 
 
-def ALEXI_weekly(Date, Enddate, output_folder, latlim, lonlim, Year, Waitbar,
-                 total_amount, TimeStep):
+def ALEXI_daily_file(Date, args):
+    """Retrieves the ALEXI file of a day
+
+    Args:
+      Date (:obj:`pandas.Timestamp`): Date.
+      args (list): Parameters defined in the DownloadData function.
+
+    Returns:
+      dict: Task, with the bytes downloaded, and the error of a failed date.
+    """
+    # Argument
+    [download, output_folder, yID, xID, geo, TimeStep] = args
+
+    # Date as printed in filename
+    DirFile = os.path.join(output_folder,
+                           'ETa_ALEXI_CSFR_mm-day-1_daily_%d.%02d.%02d.tif' % (
+                               Date.year, Date.month, Date.day))
+    DOY = Date.timetuple().tm_yday
+
+    # Define end filename
+    filename = "EDAY_CERES_%d%03d.dat.gz" % (Date.year, DOY)
+
+    # Temporary filename for the downloaded global file
+    local_filename = os.path.join(output_folder, filename)
+
+    # Download the data from FTP server if the file not exists
+    task = {'Date': Date}
+    if os.path.exists(DirFile):
+        task['cache_hit'] = True
+    else:
+        try:
+            task['nbytes'] = Download_ALEXI_from_WA_FTP(
+                download, local_filename, DirFile, filename, geo, yID, xID, TimeStep)
+            task['output'] = DirFile
+        except Exception as err:
+            print("\nWas not able to download file with date %s: %s" % (Date, err))
+            task['error'] = err
+    return task
+
+
+def ALEXI_weekly(download, Date, Enddate, output_folder, yID, xID, geo, Year,
+                 Waitbar, total_amount, TimeStep, cores=False):
     # Define the stop conditions
     Stop = Enddate.toordinal()
     End_date = 0
-    amount = 0
+    Dates = []
     while End_date == 0:
-
-        # Date as printed in filename
-        Datesname = Date + pd.DateOffset(days=-7)
-        DirFile = os.path.join(output_folder,
-                               'ETa_ALEXI_CSFR_mm-week-1_weekly_%s.%02s.%02s.tif' % (
-                                   Datesname.strftime('%Y'), Datesname.strftime('%m'),
-                                   Datesname.strftime('%d')))
-
-        # Define end filename
-        filename = "ALEXI_weekly_mm_%s_%s.tif" % (
-            Date.strftime('%j'), Date.strftime('%Y'))
-
-        # Temporary filename for the downloaded global file
-        local_filename = os.path.join(output_folder, filename)
+        Dates.append(Date)
 
         # Create the new date for the next download
         Datename = (str(Date.strftime('%Y')) + '-' + str(
             Date.strftime('%m')) + '-' + str(Date.strftime('%d')))
 
-        # Define IDs
-        yID = 3000 - np.int16(
-            np.array([np.ceil((latlim[1] + 60) * 20), np.floor((latlim[0] + 60) * 20)]))
-        xID = np.int16(
-            np.array([np.floor((lonlim[0]) * 20), np.ceil((lonlim[1]) * 20)]) + 3600)
-
-        # Download the data from FTP server if the file not exists
-        if not os.path.exists(DirFile):
-            try:
-                Download_ALEXI_from_WA_FTP(local_filename, DirFile, filename, lonlim,
-                                           latlim, yID, xID, TimeStep)
-            except BaseException:
-                print("\nWas not able to download file with date %s" % Date)
-
         # Current DOY
         DOY = datetime.datetime.strptime(Datename,
                                          '%Y-%m-%d').timetuple().tm_yday
@@ -327,14 +369,59 @@ def ALEXI_weekly(Date, Enddate, output_folder, latlim, lonlim, Year, Waitbar,
         Day = '%02d' % DayNext.day
         Date = (str(Year) + '-' + str(Month) + '-' + str(Day))
 
-        # Adjust waitbar
-        if Waitbar == 1:
-            amount += 1
-            collect.WaitBar(amount, total_amount,
-                            prefix='ALEXI:', suffix='Complete',
-                            length=50)
-
         # Check if this file must be downloaded
         Date = pd.Timestamp(Date)
         if Date.toordinal() > Stop:
             End_date = 1
+
+    args = [download, output_folder, yID, xID, geo, TimeStep]
+    progress = Progress(total_amount, prefix='ALEXI:', is_print=Waitbar == 1)
+    metrics = Metrics('ALEXI', {'dataset': 'Evaporation', 'datatype': TimeStep})
+    trace = Trace(metrics.product, metrics.labels).start()
+    Download.map(functools.partial(ALEXI_weekly_file, args=args), Dates,
+                 'thread', cores, progress=progress, metrics=metrics)
+    progress.close()
+    metrics.close()
+    trace.stop()
+
+
+def ALEXI_weekly_file(Date, args):
+    """Retrieves the ALEXI file of a week
+
+    Args:
+      Date (:obj:`pandas.Timestamp`): Date.
+      args (list): Parameters defined in the DownloadData function.
+
+    Returns:
+      dict: Task, with the bytes downloaded, and the error of a failed date.
+    """
+    # Argument
+    [download, output_folder, yID, xID, geo, TimeStep] = args
+
+    # Date as printed in filename
+    Datesname = Date + pd.DateOffset(days=-7)
+    DirFile = os.path.join(output_folder,
+                           'ETa_ALEXI_CSFR_mm-week-1_weekly_%s.%02s.%02s.tif' % (
+                               Datesname.strftime('%Y'), Datesname.strftime('%m'),
+                               Datesname.strftime('%d')))
+
+    # Define end filename
+    filename = "ALEXI_weekly_mm_%s_%s.tif" % (
+        Date.strftime('%j'), Date.strftime('%Y'))
+
+    # Temporary filename for the downloaded global file
+    local_filename = os.path.join(output_folder, filename)
+
+    # Download the data from FTP server if the file not exists
+    task = {'Date': Date}
+    if os.path.exists(DirFile):
+        task['cache_hit'] = True
+    else:
+        try:
+            task['nbytes'] = Download_ALEXI_from_WA_FTP(
+                download, local_filename, DirFile, filename, geo, yID, xID, TimeStep)
+            task['output'] = DirFile
+        except Exception as err:
+            print("\nWas not able to download file with date %s: %s" % (Date, err))
+            task['error'] = err
+    return task
@@ -36,6 +36,7 @@ import os
 
 # # import math
 # # import datetime
+import functools
 
 import requests
 from requests.auth import HTTPBasicAuth
@@ -46,12 +47,23 @@ from netCDF4 import Dataset
 
 # Water Accounting Modules
 try:
-    from .download import Download
+    from ..download import Download
+    from ..grid import Grid
+    from ..progress import Progress
+    from ..metrics import Metrics
+    from ..trace import Trace
+    from ..transform import Transform
 except ImportError:
     from src.wateraccounting.Collect.download import Download
+    from src.wateraccounting.Collect.grid import Grid
+    from src.wateraccounting.Collect.progress import Progress
+    from src.wateraccounting.Collect.metrics import Metrics
+    from src.wateraccounting.Collect.trace import Trace
+    from src.wateraccounting.Collect.transform import Transform
 
 
-def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, TimeStep, Waitbar):
+def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, TimeStep, Waitbar,
+                 cores=False):
     """Downloads ASCAT SWI data
 
     This scripts downloads ASCAT SWI data from the VITO server.
@@ -66,6 +78,8 @@ def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, TimeStep, Waitbar):
       TimeStep (str): 'daily' or 'weekly' (by using here monthly,
         an older dataset will be used).
       Waitbar (bool): Waitbar.
+      cores (int): Number of download threads,
+        False runs serial.
 
     :Example:
 
@@ -74,16 +88,12 @@ def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, TimeStep, Waitbar):
     """
 
     # Check the latitude and longitude and otherwise reset lat and lon.
-    if latlim[0] < -90 or latlim[1] > 90:
-        print('Latitude above 90N or below 90S is not possible.\
-            Value set to maximum')
-        latlim[0] = np.max(latlim[0], -90)
-        latlim[1] = np.min(latlim[1], 90)
-    if lonlim[0] < -180 or lonlim[1] > 180:
-        print('Longitude must be between 180E and 180W.\
-            Now value is set to maximum')
-        lonlim[0] = np.max(lonlim[0], -180)
-        lonlim[1] = np.min(lonlim[1], 180)
+    grid = Grid.from_conf('ASCAT', 'SoilWaterIndex', 'v3', TimeStep, 'SWI_010')
+    latlim, lonlim = grid.check_latlon(latlim, lonlim)
+
+    # Define IDs
+    yID, xID = grid.window(latlim, lonlim)
+    geo = grid.window_geo(yID, xID)
 
     # Check Startdate and Enddate
     if not Startdate:
@@ -100,13 +110,8 @@ def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, TimeStep, Waitbar):
     # amount of Dates weekly
     Dates = pd.date_range(Startdate, Enddate, freq='D')
 
-    # Create Waitbar
+    # Amount of files for the progress
     total_amount = len(Dates)
-    if Waitbar == 1:
-        amount = 0
-        collect.WaitBar(amount, total_amount,
-                        prefix='ASCAT:', suffix='Complete',
-                        length=50)
 
     # Define directory and create it if not exists
     output_folder = os.path.join(Dir, 'SWI', 'ASCAT', 'Daily')
@@ -118,39 +123,16 @@ def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, TimeStep, Waitbar):
         os.makedirs(output_folder_temp)
 
     # loop over dates
-    for Date in Dates:
-
-        # Define end filename
-        End_filename = os.path.join(output_folder,
-                                    'SWI_ASCAT_V3_Percentage_daily_%d.%02d.%02d.tif'
-                                    % (Date.year, Date.month, Date.day))
-
-        # Define IDs
-        xID = 1800 + np.int16(np.array([np.ceil((lonlim[0]) * 10),
-                                        np.floor((lonlim[1]) * 10)]))
-
-        yID = np.int16(np.array([np.floor((-latlim[1]) * 10),
-                                 np.ceil((-latlim[0]) * 10)])) + 900
-
-        # Download the data from FTP server if the file not exists
-        if not os.path.exists(End_filename):
-            try:
-                data = Download_ASCAT_from_VITO(End_filename,
-                                                output_folder_temp, Date,
-                                                yID, xID)
-                # make geotiff file
-                geo = [lonlim[0], 0.1, 0, latlim[1], 0, -0.1]
-                collect.Save_as_tiff(name=End_filename, data=data,
-                                     geo=geo, projection="WGS84")
-            except BaseException:
-                print("\nWas not able to download file with date %s" % Date)
-
-        # Adjust waitbar
-        if Waitbar == 1:
-            amount += 1
-            collect.WaitBar(amount, total_amount,
-                            prefix='ASCAT:', suffix='Complete',
-                            length=50)
+    download = Download('', 'Copernicus', is_status=False)
+    args = [download, output_folder, output_folder_temp, yID, xID, geo]
+    progress = Progress(total_amount, prefix='ASCAT:', is_print=Waitbar == 1)
+    metrics = Metrics('ASCAT', {'dataset': 'SoilWaterIndex', 'datatype': TimeStep})
+    trace = Trace(metrics.product, metrics.labels).start()
+    Download.map(functools.partial(ASCAT_daily_file, args=args), Dates,
+                 'thread', cores, progress=progress, metrics=metrics)
+    progress.close()
+    metrics.close()
+    trace.stop()
 
     # remove the temporary folder
     # shutil.rmtree(output_folder_temp)
@@ -158,7 +140,47 @@ def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, TimeStep, Waitbar):
     return 'daily'
 
 
-def Download_ASCAT_from_VITO(End_filename, output_folder_temp, Date, yID, xID):
+def ASCAT_daily_file(Date, args):
+    """Retrieves the ASCAT file of a day
+
+    Args:
+      Date (:obj:`pandas.Timestamp`): Date.
+      args (list): Parameters defined in the DownloadData function.
+
+    Returns:
+      dict: Task, and the error of a failed date.
+    """
+    # Argument
+    [download, output_folder, output_folder_temp, yID, xID, geo] = args
+
+    # Define end filename
+    End_filename = os.path.join(output_folder,
+                                'SWI_ASCAT_V3_Percentage_daily_%d.%02d.%02d.tif'
+                                % (Date.year, Date.month, Date.day))
+
+    # Download the data from FTP server if the file not exists
+    task = {'Date': Date}
+    if os.path.exists(End_filename):
+        task['cache_hit'] = True
+    else:
+        try:
+            data = Download_ASCAT_from_VITO(download, End_filename,
+                                            output_folder_temp, Date,
+                                            yID, xID)
+            # make geotiff file, the half percent steps stored as bytes
+            encoding = download.get_encoding('ASCAT', 'SoilWaterIndex', 'v3',
+                                             'daily', 'SWI_010')
+            download.save_tif(End_filename, data, geo, "WGS84", encoding,
+                              clip=download.get_clip())
+            task['output'] = End_filename
+        except Exception as err:
+            print("\nWas not able to download file with date %s: %s" % (Date, err))
+            task['error'] = err
+    return task
+
+
+def Download_ASCAT_from_VITO(download, End_filename, output_folder_temp, Date,
+                             yID, xID):
     """Retrieves ASCAT data
 
     This function retrieves ASCAT data for a given date from the
@@ -172,11 +194,11 @@ def Download_ASCAT_from_VITO(End_filename, output_folder_temp, Date, yID, xID):
 
     """
     # Collect account and FTP information
-    Link = "https://land.copernicus.vgt.vito.be/PDF/datapool" \
+    Link = Download.get_url('ASCAT', 'SoilWaterIndex', 'v3', 'daily') + \
            "/Vegetation/Soil_Water/SWI_V3" \
            "/%s/%s/%s" \
            "/%s/%s"
-    user = collect.get_user('Copernicus')
+    user = download.get_user('account')['Copernicus']
     username = user['username']
     password = user['password']
 
@@ -211,12 +233,31 @@ def Download_ASCAT_from_VITO(End_filename, output_folder_temp, Date, yID, xID):
     z.write(y.content)
     z.close()
 
+    return Decode_ASCAT(output_ncfile_ASCAT, yID, xID)
+
+
+def Decode_ASCAT(output_ncfile_ASCAT, yID, xID):
+    """Decodes ASCAT data
+
+    This function reads the clipped window of the global ASCAT file.
+
+    Args:
+      output_ncfile_ASCAT (str): name of the global ASCAT file, '.nc'.
+      yID (tuple): latlim to index.
+      xID (tuple): lonlim to index.
+
+    Returns:
+      :obj:`numpy.ndarray`: Clipped SWI in percentage, -9999 as nodata.
+    """
     # Open nc file
     fh = Dataset(output_ncfile_ASCAT)
     dataset = fh.variables['SWI_010'][:, yID[0]:yID[1], xID[0]:xID[1]]
     data = np.squeeze(dataset.data, axis=0)
-    data = data * 0.5
-    data[data > 100.] = -9999
     fh.close()
 
+    # Half percent steps and nodata, the steps of base.yml
+    transform = Transform.from_conf('ASCAT', 'SoilWaterIndex', 'v3', 'daily',
+                                    'SWI_010')
+    data = transform(data)
+
     return data
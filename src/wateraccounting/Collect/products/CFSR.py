@@ -19,6 +19,9 @@ The **CFSR** data is available since ``1979-01-01 till 2011-03-31``.
 
 The **CFSRv2** data is available since ``2011-04-01 till now``.
 
+Use the CFSR.CollectVars function to collect many variables in one pass,
+with the monthly means.
+
 
 **Examples:**
 ::
@@ -44,21 +47,41 @@ import os
 # # import datetime
 
 import re
+import functools
+import threading
 import pycurl
-from joblib import Parallel, delayed
 
 import numpy as np
 import pandas as pd
-from netCDF4 import Dataset
 
 # Water Accounting Modules
 try:
-    from .download import Download
+    from ..download import Download, Pipeline
+    from ..grid import Grid
+    from ..aggregate import Accumulator
+    from ..progress import Progress
+    from ..metrics import Metrics
+    from ..trace import Trace
+    from ..ledger import Ledger
+    from ..transform import Transform
 except ImportError:
-    from src.wateraccounting.Collect.download import Download
-
-
-def DownloadData(Date, Version, output_folder, Var):
+    from src.wateraccounting.Collect.download import Download, Pipeline
+    from src.wateraccounting.Collect.grid import Grid
+    from src.wateraccounting.Collect.aggregate import Accumulator
+    from src.wateraccounting.Collect.progress import Progress
+    from src.wateraccounting.Collect.metrics import Metrics
+    from src.wateraccounting.Collect.trace import Trace
+    from src.wateraccounting.Collect.ledger import Ledger
+    from src.wateraccounting.Collect.transform import Transform
+
+# Download locks of the monthly grib files, shared by the download threads
+_locks = {
+    'lock': threading.Lock(),
+    'files': {}
+}
+
+
+def DownloadData(Date, Version, output_folder, Var, task=None):
     """
     This function downloads CFSR data from the FTP server
 
@@ -70,14 +93,10 @@ def DownloadData(Date, Version, output_folder, Var):
     Version -- 1 or 2 (1 = CFSR, 2 = CFSRv2)
     output_folder -- The directory for storing the downloaded files
     Var -- The variable that must be downloaded from the server ('dlwsfc','uswsfc','dswsfc','ulwsfc')
+    task -- Optional task of the pipeline, the number of retries is set in it
     """
     # Define the filename that must be downloaded
-    if Version == 1:
-        filename = Var + '.gdas.' + str(Date.strftime('%Y')) + str(
-            Date.strftime('%m')) + '.grb2'
-    if Version == 2:
-        filename = Var + '.gdas.' + str(Date.strftime('%Y')) + str(
-            Date.strftime('%m')) + '.grib2'
+    filename = Get_gribname(Date, Var, Version)
 
     try:
         # download the file when it not exist
@@ -87,12 +106,13 @@ def DownloadData(Date, Version, output_folder, Var):
             Times = 0
             while Downloaded == 0:
                 # Create the command and run the command in cmd
+                url = Download.get_url('CFSR', 'Radiation', 'v%d' % Version, 'daily')
                 if Version == 1:
-                    FTP_name = 'https://nomads.ncdc.noaa.gov/data/cfsr/' + Date.strftime(
+                    FTP_name = url + '/data/cfsr/' + Date.strftime(
                         '%Y') + Date.strftime('%m') + '/' + filename
 
                 if Version == 2:
-                    FTP_name = 'https://nomads.ncdc.noaa.gov/modeldata/cfsv2_analysis_timeseries/' + Date.strftime(
+                    FTP_name = url + '/modeldata/cfsv2_analysis_timeseries/' + Date.strftime(
                         '%Y') + '/' + Date.strftime('%Y') + Date.strftime(
                         '%m') + '/' + filename
 
@@ -110,6 +130,8 @@ def DownloadData(Date, Version, output_folder, Var):
                     Downloaded = 1
                 else:
                     Times += 1
+                    if task is not None:
+                        task['retries'] = Times
                     if Times == 10:
                         Downloaded = 1
     except:
@@ -118,6 +140,24 @@ def DownloadData(Date, Version, output_folder, Var):
     return (local_filename)
 
 
+def Get_gribname(Date, Var, Version):
+    """
+    This function creates the name of the monthly grib file.
+
+    Keyword arguments:
+    Date -- pandas timestamp day
+    Var -- 'dlwsfc','dswsfc','ulwsfc', or 'uswsfc'
+    Version -- 1 or 2 (1 = CFSR, 2 = CFSRv2)
+    """
+    if Version == 1:
+        filename = Var + '.gdas.' + str(Date.strftime('%Y')) + str(
+            Date.strftime('%m')) + '.grb2'
+    if Version == 2:
+        filename = Var + '.gdas.' + str(Date.strftime('%Y')) + str(
+            Date.strftime('%m')) + '.grib2'
+    return filename
+
+
 def CollectData(Dir, Var, Startdate, Enddate, latlim, lonlim, Waitbar, cores, Version):
     """
     This function collects daily CFSR data in geotiff format
@@ -139,28 +179,8 @@ def CollectData(Dir, Var, Startdate, Enddate, latlim, lonlim, Waitbar, cores, Ve
     # Creates an array of the days of which the ET is taken
     Dates = pd.date_range(Startdate, Enddate, freq='D')
 
-    # Create Waitbar
-    if Waitbar == 1:
-        import watools.Functions.Start.WaitbarConsole as WaitbarConsole
-        total_amount = len(Dates)
-        amount = 0
-        WaitbarConsole.printWaitBar(amount, total_amount, prefix='Progress:',
-                                    suffix='Complete', length=50)
-
     # For collecting CFSR data
     if Version == 1:
-        # Check the latitude and longitude and otherwise set lat or lon on greatest extent
-        if latlim[0] < -89.9171038899 or latlim[1] > 89.9171038899:
-            print(
-                'Latitude above 89.917N or below 89.917S is not possible. Value set to maximum')
-            latlim[0] = np.maximum(latlim[0], -89.9171038899)
-            latlim[1] = np.minimum(latlim[1], 89.9171038899)
-        if lonlim[0] < -180 or lonlim[1] > 179.843249782:
-            print(
-                'Longitude must be between 179.84E and 179.84W. Now value is set to maximum')
-            lonlim[0] = np.maximum(lonlim[0], -180)
-            lonlim[1] = np.minimum(lonlim[1], 179.843249782)
-
         # Make directory for the CFSR data
         output_folder = os.path.join(Dir, 'Radiation', 'CFSR')
         if not os.path.exists(output_folder):
@@ -168,38 +188,72 @@ def CollectData(Dir, Var, Startdate, Enddate, latlim, lonlim, Waitbar, cores, Ve
 
     # For collecting CFSRv2 data
     if Version == 2:
-        # Check the latitude and longitude and otherwise set lat or lon on greatest extent
-        if latlim[0] < -89.9462116040955806 or latlim[1] > 89.9462116040955806:
-            print(
-                'Latitude above 89.917N or below 89.946S is not possible. Value set to maximum')
-            latlim[0] = np.maximum(latlim[0], -89.9462116040955806)
-            latlim[1] = np.minimum(latlim[1], 89.9462116040955806)
-        if lonlim[0] < -180 or lonlim[1] > 179.8977275:
-            print(
-                'Longitude must be between 179.90E and 179.90W. Now value is set to maximum')
-            lonlim[0] = np.maximum(lonlim[0], -180)
-            lonlim[1] = np.minimum(lonlim[1], 179.8977275)
-
         # Make directory for the CFSRv2 data
         output_folder = os.path.join(Dir, 'Radiation', 'CFSRv2')
         if not os.path.exists(output_folder):
             os.makedirs(output_folder)
 
+    # Check the latitude and longitude and otherwise set lat or lon on greatest extent
+    grid = Grid.from_conf('CFSR', 'Radiation', 'v%d' % Version, 'daily', Var)
+    latlim, lonlim = grid.check_latlon(latlim, lonlim)
+
+    # Define IDs of both grids, CFSR switches to the CFSRv2 grid in 2011
+    windows = {}
+    for version in (Version, 2):
+        grid = Grid.from_conf('CFSR', 'Radiation', 'v%d' % version, 'daily', Var)
+        yID, xID = grid.window(latlim, lonlim)
+        windows[version] = (grid.shape, yID, xID, grid.window_geo(yID, xID))
+
+    # Claim the days which are not done in an earlier run
+    metrics = Metrics('CFSR', {'dataset': 'Radiation', 'version': 'v%d' % Version,
+                               'variable': Var})
+    ledger = Ledger(metrics.product, dict(metrics.labels, folder=output_folder,
+                                          latlim=latlim, lonlim=lonlim))
+    Dates = ledger.claim(Dates)
+
+    # Amount of files for the progress
+    total_amount = len(Dates)
+
     # Pass variables to parallel function and run
-    args = [output_folder, latlim, lonlim, Var, Version]
+    download = Download('', '', is_status=False)
+    args = [download, output_folder, windows, Var, Version]
+    progress = Progress(total_amount, prefix='CFSR:', is_print=Waitbar == 1)
+    trace = Trace(metrics.product, metrics.labels).start()
     if not cores:
-        for Date in Dates:
-            RetrieveData(Date, args)
-            if Waitbar == 1:
-                amount += 1
-                WaitbarConsole.printWaitBar(amount, total_amount, prefix='Progress:',
-                                            suffix='Complete', length=50)
+        Download.map(functools.partial(RetrieveData, args=args), Dates,
+                     'serial', cores, progress=progress, metrics=metrics,
+                     ledger=ledger)
         results = True
     else:
-        results = Parallel(n_jobs=cores)(delayed(RetrieveData)(Date, args)
-                                         for Date in Dates)
+        # Download on threads, decode and clip on processes, save on a thread
+        pipeline = Pipeline([('download', Download_file, 'thread', cores),
+                             ('decode', Decode_data, 'process', cores),
+                             ('save', Save_data, 'thread', 1)],
+                            progress=progress, metrics=metrics, ledger=ledger)
+        pipeline.run({'Date': Date, 'args': args} for Date in Dates)
+        for name, task, err in pipeline.errors:
+            print('CFSR {n} failed for {d}: {e}'.format(
+                n=name, d=task['Date'].strftime('%Y-%m-%d'), e=err))
+        results = True
+    progress.close()
+    metrics.close()
+    ledger.close()
+    trace.stop()
 
     # Remove all .nc and .grb2 files
+    Remove_temporary(output_folder)
+
+    return results
+
+
+def Remove_temporary(output_folder):
+    """
+    This function removes the .nc, .grb2 and .grib2 files.
+
+    Keyword arguments:
+    output_folder -- The directory of the downloaded files
+    """
+    Download.close_tif(output_folder)
     for f in os.listdir(output_folder):
         if re.search(".nc", f):
             os.remove(os.path.join(output_folder, f))
@@ -210,13 +264,35 @@ def CollectData(Dir, Var, Startdate, Enddate, latlim, lonlim, Waitbar, cores, Ve
         if re.search(".grib2", f):
             os.remove(os.path.join(output_folder, f))
 
-    return results
-
 
 def RetrieveData(Date, args):
-    # unpack the arguments
-    [output_folder, latlim, lonlim, Var, Version] = args
+    """
+    This function retrieves CFSR data for a given date.
+
+    Keyword arguments:
+    Date -- pandas timestamp day
+    args -- A list of parameters defined in the CollectData function.
 
+    Returns the task, with the bytes downloaded and the timings.
+    """
+    task = {'Date': Date, 'args': args}
+    for stage in (Download_file, Decode_data, Save_data):
+        if stage(task) is None:
+            break
+
+    return task
+
+
+def Get_outputname(Date, output_folder, Var, Version):
+    """
+    This function creates the name of the output file.
+
+    Keyword arguments:
+    Date -- pandas timestamp day
+    output_folder -- The directory for storing the output files
+    Var -- 'dlwsfc','dswsfc','ulwsfc', or 'uswsfc'
+    Version -- 1 or 2 (1 = CFSR, 2 = CFSRv2)
+    """
     # Name of the model
     if Version == 1:
         version_name = 'CFSR'
@@ -242,89 +318,426 @@ def RetrieveData(Date, args):
             Date.strftime('%d')) + '.tif'
 
     # Create the total end output name
-    outputnamePath = os.path.join(output_folder, Outputname)
+    return os.path.join(output_folder, Outputname)
+
+
+def Download_file(task):
+    """
+    This function downloads the monthly grib file of the date, I/O stage.
+    Dates which already have an output are dropped.
+
+    Keyword arguments:
+    task -- {'Date': Date, 'args': args}
+    """
+    # unpack the arguments
+    [download, output_folder, windows, Var, Version] = task['args']
+    Date = task['Date']
 
     # If the output name not exists than create this output
-    if not os.path.exists(outputnamePath):
-
-        local_filename = Download_data(Date, Version, output_folder, Var)
-
-        # convert grb2 to netcdf (wgrib2 module is needed)
-        for i in range(0, 4):
-            nameNC = 'Output' + str(Date.strftime('%Y')) + str(
-                Date.strftime('%m')) + str(Date.strftime('%d')) + '-' + str(
-                i + 1) + '.nc'
-
-            # Total path of the output
-            FileNC6hour = os.path.join(output_folder, nameNC)
-
-            # Band number of the grib data which is converted in .nc
-            band = (int(Date.strftime('%d')) - 1) * 28 + (i + 1) * 7
-
-            # Convert the data
-            DC.Convert_grb2_to_nc(local_filename, FileNC6hour, band)
-
-        if Version == 1:
-
-            if Date < pd.Timestamp(pd.datetime(2011, 1, 1)):
-
-                # Convert the latlim and lonlim into array
-                Xstart = np.floor((lonlim[0] + 180.1562497) / 0.3125)
-                Xend = np.ceil((lonlim[1] + 180.1562497) / 0.3125) + 1
-                Ystart = np.floor((latlim[0] + 89.9171038899) / 0.3122121663)
-                Yend = np.ceil((latlim[1] + 89.9171038899) / 0.3122121663)
-
-                # Create a new dataset
-                Datatot = np.zeros([576, 1152])
-
-            else:
-                Version = 2
-
-        if Version == 2:
-            # Convert the latlim and lonlim into array
-            Xstart = np.floor((lonlim[0] + 180.102272725) / 0.204545)
-            Xend = np.ceil((lonlim[1] + 180.102272725) / 0.204545) + 1
-            Ystart = np.floor((latlim[0] + 89.9462116040955806) / 0.204423)
-            Yend = np.ceil((latlim[1] + 89.9462116040955806) / 0.204423)
-
-            # Create a new dataset
-            Datatot = np.zeros([880, 1760])
-
-        # Open 4 times 6 hourly dataset
-        for i in range(0, 4):
-            nameNC = 'Output' + str(Date.strftime('%Y')) + str(
-                Date.strftime('%m')) + str(Date.strftime('%d')) + '-' + str(
-                i + 1) + '.nc'
-            FileNC6hour = os.path.join(output_folder, nameNC)
-            f = Dataset(FileNC6hour, mode='r')
-            Data = f.variables['Band1'][
-                   0:int(Datatot.shape[0]),
-                   0:int(Datatot.shape[1])]
-            f.close()
-            data = np.array(Data)
-            Datatot = Datatot + data
-
-        # Calculate the average in W/m^2 over the day
-        DatatotDay = Datatot / 4
-        DatatotDayEnd = np.zeros([int(Datatot.shape[0]), int(Datatot.shape[1])])
-        DatatotDayEnd[:, 0:int(Datatot.shape[0])] = DatatotDay[:,
-                                                    int(Datatot.shape[0]):int(
-                                                        Datatot.shape[1])]
-        DatatotDayEnd[:, int(Datatot.shape[0]):int(Datatot.shape[1])] = DatatotDay[:,
-                                                                        0:int(
-                                                                            Datatot.shape[
-                                                                                0])]
-
-        # clip the data to the extent difined by the user
-        DatasetEnd = DatatotDayEnd[int(Ystart):int(Yend), int(Xstart):int(Xend)]
-
-        # save file
-        if Version == 1:
-            pixel_size = 0.3125
-        if Version == 2:
-            pixel_size = 0.204545
-        geo = [lonlim[0], pixel_size, 0, latlim[1], 0, -pixel_size]
-        DC.Save_as_tiff(data=np.flipud(DatasetEnd), name=outputnamePath, geo=geo,
-                        projection="WGS84")
-
-    return ()
+    if os.path.exists(Get_outputname(Date, output_folder, Var, Version)):
+        task['cache_hit'] = True
+        return None
+
+    task['file'] = Download_grib(task, output_folder, Var, Version)
+    return task
+
+
+def Download_grib(task, output_folder, Var, Version):
+    """
+    This function downloads the monthly grib file of a variable, the first
+    thread of the month downloads it, the other threads wait for it.
+
+    Keyword arguments:
+    task -- {'Date': Date, ...}, the bytes downloaded are added to 'nbytes'
+    output_folder -- The directory for storing the downloaded files
+    Var -- 'dlwsfc','dswsfc','ulwsfc', or 'uswsfc'
+    Version -- 1 or 2 (1 = CFSR, 2 = CFSRv2)
+    """
+    Date = task['Date']
+
+    # One month file for many days, the first thread downloads it
+    key = (output_folder, Var, Version, Date.strftime('%Y%m'))
+    with _locks['lock']:
+        lock = _locks['files'].setdefault(key, threading.Lock())
+    with Metrics.timer(task, 'wait'):
+        lock.acquire()
+    try:
+        # Only the day which downloads the month file counts its bytes
+        is_new = not os.path.exists(
+            os.path.join(output_folder, Get_gribname(Date, Var, Version)))
+        with Metrics.timer(task, 'transfer'):
+            local_filename = DownloadData(Date, Version, output_folder, Var, task)
+        if is_new and os.path.exists(local_filename):
+            task['nbytes'] = task.get('nbytes', 0) + os.path.getsize(local_filename)
+    finally:
+        lock.release()
+
+    return local_filename
+
+
+def Decode_data(task):
+    """
+    This function decodes the 6-hourly grib bands of the date, calculates the
+    daily average and clips the data, CPU stage.
+
+    Keyword arguments:
+    task -- {'Date': Date, 'args': args, 'file': local_filename}
+    """
+    # unpack the arguments
+    [download, output_folder, windows, Var, Version] = task['args']
+
+    task['data'], task['geo'] = Decode_grib(task, task['file'], output_folder,
+                                            windows, Var, Version, download)
+    return task
+
+
+def Get_window(Date, windows, Version):
+    """
+    This function returns the grid window of the date, CFSR switches to the
+    CFSRv2 grid in 2011.
+
+    Keyword arguments:
+    Date -- pandas timestamp day
+    windows -- {Version: (shape, yID, xID, geo)}
+    Version -- 1 or 2 (1 = CFSR, 2 = CFSRv2)
+    """
+    if Version == 1:
+        if Date >= pd.Timestamp(2011, 1, 1):
+            Version = 2
+
+    return windows[Version]
+
+
+def Decode_grib(task, local_filename, output_folder, windows, Var, Version,
+                download=None):
+    """
+    This function reads the 6-hourly grib bands of the date in place,
+    calculates the daily average and clips the data.
+
+    Keyword arguments:
+    task -- {'Date': Date, ...}, the timings are added to it
+    local_filename -- The monthly grib file
+    output_folder -- The directory of the downloaded files
+    windows -- {Version: (shape, yID, xID, geo)}
+    Var -- 'dlwsfc','dswsfc','ulwsfc', or 'uswsfc'
+    Version -- 1 or 2 (1 = CFSR, 2 = CFSRv2)
+    download -- Download, the cache of the grib file handles
+
+    Returns the clipped daily average and its geo.
+    """
+    if download is None:
+        download = Download('', '', is_status=False)
+
+    Date = task['Date']
+    transform = Transform.from_conf('CFSR', 'Radiation', 'v%d' % Version, 'daily',
+                                    Var)
+
+    # Grid shape, IDs and geo of the clipped window
+    shape, yID, xID, geo = Get_window(Date, windows, Version)
+
+    # Band numbers of the 4 times 6 hourly data of the day
+    bands = [(int(Date.strftime('%d')) - 1) * 28 + (i + 1) * 7
+             for i in range(0, 4)]
+    with Metrics.timer(task, 'decode'):
+        data = Read_6hourly(download, local_filename, bands, shape, yID, xID,
+                            transform)
+
+    return data, geo
+
+
+def Read_6hourly(download, local_filename, bands, shape, yID, xID, transform):
+    """
+    This function calculates the daily average of the 6-hourly grib bands,
+    read in place, and clips the data. Only the rows of the window are read.
+    The handle is closed after reading, the decode workers outlive the grib
+    files, which are removed by Remove_temporary.
+
+    Keyword arguments:
+    download -- Download, the cache of the file handles
+    local_filename -- The monthly grib file
+    bands -- The 4 band numbers of the day
+    shape -- The shape of the global grid
+    yID -- latlim to index
+    xID -- lonlim to index
+    transform -- Transform, the decode steps of base.yml
+    """
+    f, lock = download.open_tif(local_filename)
+
+    # The grib rows are north-up, read the rows of the window
+    Datatot = np.zeros((yID[1] - yID[0], shape[1]))
+    with lock:
+        for band in bands:
+            Datatot += f.GetRasterBand(band).ReadAsArray(
+                0, int(yID[0]), int(shape[1]), int(yID[1] - yID[0]))
+    f = None
+    download.close_tif(local_filename)
+
+    # Calculate the average in W/m^2 over the day
+    Datatot /= 4
+
+    # Longitude from 0 - 360 to -180 - 180, and clip the data to the extent
+    # difined by the user
+    return transform(Datatot, None, xID)
+
+
+def Save_data(task):
+    """
+    This function saves the daily average as geotiff, I/O stage.
+
+    Keyword arguments:
+    task -- {'Date': Date, 'args': args, 'data': data, 'geo': geo}
+    """
+    # unpack the arguments
+    [download, output_folder, windows, Var, Version] = task['args']
+    outputnamePath = Get_outputname(task['Date'], output_folder, Var, Version)
+
+    # save file
+    with Metrics.timer(task, 'write'):
+        download.save_tif(outputnamePath, task.pop('data'), task['geo'], "WGS84",
+                          clip=download.get_clip())
+
+    task['output'] = outputnamePath
+    task['nbytes_out'] = os.path.getsize(outputnamePath)
+    return task
+
+
+def CollectVars(Dir, Vars, Startdate, Enddate, latlim, lonlim, Waitbar, cores,
+                Version):
+    """
+    This function collects daily CFSR data of many variables in one pass,
+    and the monthly means of the months inside Startdate - Enddate.
+
+    The grib files of all variables of a month are downloaded together,
+    each day is decoded for all variables at once, and the daily arrays
+    are added to the monthly means in memory when they are saved.
+    Days with an output are read from the output for the monthly mean.
+
+    Keyword arguments:
+    Dir -- 'C:/file/to/path/'
+    Vars -- ['dlwsfc','dswsfc','ulwsfc','uswsfc']
+    Startdate -- 'yyyy-mm-dd'
+    Enddate -- 'yyyy-mm-dd'
+    latlim -- [ymin, ymax] (values must be between -50 and 50)
+    lonlim -- [xmin, xmax] (values must be between -180 and 180)
+    Waitbar -- 1 (Default) will print a wait bar
+    cores -- The number of cores used to run the routine.
+             It can be 'False' to avoid using parallel computing
+             routines.
+    Version -- 1 or 2 (1 = CFSR, 2 = CFSRv2)
+    """
+    Vars = list(Vars)
+
+    # Creates an array of the days of which the ET is taken
+    Dates = pd.date_range(Startdate, Enddate, freq='D')
+
+    # Make directories for the daily and monthly data
+    output_folder = os.path.join(Dir, 'Radiation', 'CFSR' if Version == 1 else 'CFSRv2')
+    monthly_folder = os.path.join(output_folder, 'Monthly')
+    if not os.path.exists(monthly_folder):
+        os.makedirs(monthly_folder)
+
+    # Check the latitude and longitude, all variables share the grid
+    grid = Grid.from_conf('CFSR', 'Radiation', 'v%d' % Version, 'daily', Vars[0])
+    latlim, lonlim = grid.check_latlon(latlim, lonlim)
+
+    # Define IDs of both grids, CFSR switches to the CFSRv2 grid in 2011
+    windows = {}
+    for version in (Version, 2):
+        grid = Grid.from_conf('CFSR', 'Radiation', 'v%d' % version, 'daily', Vars[0])
+        yID, xID = grid.window(latlim, lonlim)
+        windows[version] = (grid.shape, yID, xID, grid.window_geo(yID, xID))
+
+    # Months inside the dates, which miss a monthly mean, with their days
+    months = {}
+    for Month in pd.date_range(Dates[0], Dates[-1], freq='MS'):
+        if Month + pd.offsets.MonthEnd(0) > Dates[-1]:
+            continue
+        if all(os.path.exists(Get_outputname(Month, monthly_folder, Var, Version))
+               for Var in Vars):
+            continue
+        months[Month.strftime('%Y%m')] = {
+            'days': Month.days_in_month,
+            'count': 0,
+            'geo': Get_window(Month, windows, Version)[3],
+            'means': {}
+        }
+
+    # Claim the days which are not done in an earlier run,
+    # the done days of the months are read for the monthly means
+    metrics = Metrics('CFSR', {'dataset': 'Radiation', 'version': 'v%d' % Version,
+                               'variable': ','.join(Vars)})
+    ledger = Ledger(metrics.product, dict(metrics.labels, folder=output_folder,
+                                          latlim=latlim, lonlim=lonlim))
+    claimed = set(ledger.claim(Dates))
+    Dates = [Date for Date in Dates
+             if Date in claimed or Date.strftime('%Y%m') in months]
+
+    # Amount of files for the progress
+    total_amount = len(Dates)
+
+    # Pass variables to parallel function and run
+    download = Download('', '', is_status=False)
+    args = [download, output_folder, windows, Vars, Version, set(months)]
+    save = functools.partial(Save_vars, months=months)
+    progress = Progress(total_amount, prefix='CFSR:', is_print=Waitbar == 1)
+    trace = Trace(metrics.product, metrics.labels).start()
+    if not cores:
+        Download.map(functools.partial(RetrieveVars, args=args, save=save), Dates,
+                     'serial', cores, progress=progress, metrics=metrics,
+                     ledger=ledger)
+    else:
+        # Download on threads, decode and clip on processes,
+        # save and average on one thread
+        pipeline = Pipeline([('download', Download_vars, 'thread', cores),
+                             ('decode', Decode_vars, 'process', cores),
+                             ('save', save, 'thread', 1)],
+                            progress=progress, metrics=metrics, ledger=ledger)
+        pipeline.run({'Date': Date, 'args': args} for Date in Dates)
+        for name, task, err in pipeline.errors:
+            print('CFSR {n} failed for {d}: {e}'.format(
+                n=name, d=task['Date'].strftime('%Y-%m-%d'), e=err))
+    progress.close()
+    metrics.close()
+    ledger.close()
+    trace.stop()
+
+    # Months with a failed day have no monthly mean
+    for month in sorted(months):
+        if months[month]['count'] < months[month]['days']:
+            print('CFSR monthly mean of {m} not complete, {n} of {d} days'.format(
+                m=month, n=months[month]['count'], d=months[month]['days']))
+
+    # Remove all .nc and .grb2 files
+    Remove_temporary(output_folder)
+
+    return True
+
+
+def RetrieveVars(Date, args, save):
+    """
+    This function retrieves CFSR data of all variables for a given date.
+
+    Keyword arguments:
+    Date -- pandas timestamp day
+    args -- A list of parameters defined in the CollectVars function.
+    save -- The save stage defined in the CollectVars function.
+
+    Returns the task, with the bytes downloaded and the timings.
+    """
+    task = {'Date': Date, 'args': args}
+    for stage in (Download_vars, Decode_vars, save):
+        if stage(task) is None:
+            break
+
+    return task
+
+
+def Download_vars(task):
+    """
+    This function downloads the monthly grib files of all variables of the
+    date, I/O stage. Dates which already have the outputs are only read
+    for the monthly mean, or dropped.
+
+    Keyword arguments:
+    task -- {'Date': Date, 'args': args}
+    """
+    # unpack the arguments
+    [download, output_folder, windows, Vars, Version, months] = task['args']
+    Date = task['Date']
+
+    # Dates with all outputs
+    if all(os.path.exists(Get_outputname(Date, output_folder, Var, Version))
+           for Var in Vars):
+        task['cache_hit'] = True
+        if Date.strftime('%Y%m') not in months:
+            return None
+        task['files'] = None
+        return task
+
+    task['files'] = {}
+    for Var in Vars:
+        task['files'][Var] = Download_grib(task, output_folder, Var, Version)
+
+    return task
+
+
+def Decode_vars(task):
+    """
+    This function decodes the 6-hourly grib bands of all variables of the date,
+    calculates the daily averages and clips the data, CPU stage.
+
+    Keyword arguments:
+    task -- {'Date': Date, 'args': args, 'files': {Var: local_filename}}
+    """
+    # unpack the arguments
+    [download, output_folder, windows, Vars, Version, months] = task['args']
+
+    if task['files'] is not None:
+        task['data'] = {}
+        for Var in Vars:
+            task['data'][Var], task['geo'] = Decode_grib(
+                task, task['files'][Var], output_folder, windows, Var, Version,
+                download)
+
+    return task
+
+
+def Save_vars(task, months):
+    """
+    This function saves the daily averages of all variables as geotiff,
+    and adds them to the monthly means, I/O stage with one thread.
+    The monthly mean is saved with the last day of the month.
+    The days are clipped to the WA_CLIP polygons before they are added to the
+    monthly mean, as the outputs of earlier runs.
+
+    Keyword arguments:
+    task -- {'Date': Date, 'args': args, 'data': {Var: data}, 'geo': geo}
+    months -- {'yyyymm': {'days', 'count', 'geo', 'means': {Var: Accumulator}}}
+    """
+    # unpack the arguments
+    [download, output_folder, windows, Vars, Version, _] = task['args']
+    Date = task['Date']
+    datas = task.pop('data', None)
+    month = months.get(Date.strftime('%Y%m'))
+    clip = download.get_clip()
+
+    task['output'] = []
+    task['nbytes_out'] = 0
+    for Var in Vars:
+        outputnamePath = Get_outputname(Date, output_folder, Var, Version)
+        if datas is None:
+            # Output of an earlier run, only needed for the monthly mean
+            if month is None:
+                continue
+            data = download.get_tif(outputnamePath, 1)
+            geo = download.get_tif_geo(outputnamePath)
+        else:
+            data, geo = datas[Var], task['geo']
+            if clip is not None:
+                data, geo = clip.clip(data, geo)
+            with Metrics.timer(task, 'write'):
+                download.save_tif(outputnamePath, data, geo, "WGS84")
+            task['output'].append(outputnamePath)
+            task['nbytes_out'] += os.path.getsize(outputnamePath)
+
+        if month is not None:
+            month['geo'] = geo
+            mean = month['means'].setdefault(Var, Accumulator(data.shape))
+            mean.add(data)
+
+    # Save the monthly means with the last day of the month
+    if month is not None:
+        month['count'] += 1
+    if month is not None and month['count'] == month['days']:
+        for Var in Vars:
+            outputnamePath = Get_outputname(
+                Date.replace(day=1), os.path.join(output_folder, 'Monthly'),
+                Var, Version)
+            with Metrics.timer(task, 'write'):
+                download.save_tif(outputnamePath, month['means'][Var].get('mean'),
+                                  month['geo'], "WGS84")
+            task['output'].append(outputnamePath)
+            task['nbytes_out'] += os.path.getsize(outputnamePath)
+        month['means'].clear()
+
+    return task
@@ -38,8 +38,10 @@ import os
 # # import math
 # # import datetime
 
+import functools
+
 from ftplib import FTP
-from joblib import Parallel, delayed
+from urllib.parse import urlparse
 
 import numpy as np
 import pandas as pd
@@ -47,9 +49,21 @@ from netCDF4 import Dataset
 
 # Water Accounting Modules
 try:
-    from .download import Download
+    from ..download import Download, Pipeline
+    from ..grid import Grid
+    from ..progress import Progress
+    from ..metrics import Metrics
+    from ..trace import Trace
+    from ..ledger import Ledger
+    from ..transform import Transform
 except ImportError:
-    from src.wateraccounting.Collect.download import Download
+    from src.wateraccounting.Collect.download import Download, Pipeline
+    from src.wateraccounting.Collect.grid import Grid
+    from src.wateraccounting.Collect.progress import Progress
+    from src.wateraccounting.Collect.metrics import Metrics
+    from src.wateraccounting.Collect.trace import Trace
+    from src.wateraccounting.Collect.ledger import Ledger
+    from src.wateraccounting.Collect.transform import Transform
 
 
 def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, Waitbar, cores, TimeCase):
@@ -90,45 +104,48 @@ def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, Waitbar, cores, TimeCa
     # Create days
     Dates = pd.date_range(Startdate, Enddate, freq=TimeFreq)
 
-    # Create Waitbar
-    if Waitbar == 1:
-        import watools.Functions.Start.WaitbarConsole as WaitbarConsole
-        total_amount = len(Dates)
-        amount = 0
-        WaitbarConsole.printWaitBar(amount, total_amount, prefix='Progress:',
-                                    suffix='Complete', length=50)
-
     # Check space variables
-    if latlim[0] < -50 or latlim[1] > 50:
-        print('Latitude above 50N or below 50S is not possible.'
-              ' Value set to maximum')
-        latlim[0] = np.max(latlim[0], -50)
-        latlim[1] = np.min(lonlim[1], 50)
-    if lonlim[0] < -180 or lonlim[1] > 180:
-        print('Longitude must be between 180E and 180W.'
-              ' Now value is set to maximum')
-        lonlim[0] = np.max(latlim[0], -180)
-        lonlim[1] = np.min(lonlim[1], 180)
+    grid = Grid.from_conf('CHIRPS', 'Precipitation', 'v2', TimeCase, 'P')
+    latlim, lonlim = grid.check_latlon(latlim, lonlim)
+
+    # Claim the days which are not done in an earlier run
+    metrics = Metrics('CHIRPS', {'dataset': 'Precipitation', 'datatype': TimeCase})
+    ledger = Ledger(metrics.product, dict(metrics.labels, folder=output_folder,
+                                          latlim=latlim, lonlim=lonlim))
+    Dates = ledger.claim(Dates)
+
+    # Amount of files for the progress
+    total_amount = len(Dates)
 
     # Define IDs
-    yID = 2000 - np.int16(np.array([np.ceil((latlim[1] + 50) * 20),
-                                    np.floor((latlim[0] + 50) * 20)]))
-    xID = np.int16(np.array([np.floor((lonlim[0] + 180) * 20),
-                             np.ceil((lonlim[1] + 180) * 20)]))
+    yID, xID = grid.window(latlim, lonlim)
+    geo = grid.window_geo(yID, xID)
 
     # Pass variables to parallel function and run
-    args = [output_folder, TimeCase, xID, yID, lonlim, latlim]
+    download = Download('', '', is_status=False)
+    args = [download, output_folder, TimeCase, xID, yID, geo]
+    progress = Progress(total_amount, prefix='CHIRPS:', is_print=Waitbar == 1)
+    trace = Trace(metrics.product, metrics.labels).start()
     if not cores:
-        for Date in Dates:
-            RetrieveData(Date, args)
-            if Waitbar == 1:
-                amount += 1
-                WaitbarConsole.printWaitBar(amount, total_amount, prefix='Progress:',
-                                            suffix='Complete', length=50)
+        Download.map(functools.partial(RetrieveData, args=args), Dates,
+                     'serial', cores, progress=progress, metrics=metrics,
+                     ledger=ledger)
         results = True
     else:
-        results = Parallel(n_jobs=cores)(delayed(RetrieveData)(Date, args)
-                                         for Date in Dates)
+        # Download on threads, unzip and clip on processes, save on a thread
+        pipeline = Pipeline([('download', Download_from_FTP, 'thread', cores),
+                             ('decode', Decode_data, 'process', cores),
+                             ('save', Save_data, 'thread', 1)],
+                            progress=progress, metrics=metrics, ledger=ledger)
+        pipeline.run({'Date': Date, 'args': args} for Date in Dates)
+        for name, task, err in pipeline.errors:
+            print('CHIRPS {n} failed for {d}: {e}'.format(
+                n=name, d=task['Date'].strftime('%Y-%m-%d'), e=err))
+        results = True
+    progress.close()
+    metrics.close()
+    ledger.close()
+    trace.stop()
     return results
 
 
@@ -140,14 +157,32 @@ def RetrieveData(Date, args):
     Keyword arguments:
     Date -- 'yyyy-mm-dd'
     args -- A list of parameters defined in the DownloadData function.
+
+    Returns the task, with the bytes downloaded and the timings,
+    and the error of a failed date.
     """
-    # Argument
-    [output_folder, TimeCase, xID, yID, lonlim, latlim] = args
+    task = {'Date': Date, 'args': args}
+    try:
+        for stage in (Download_from_FTP, Decode_data, Save_data):
+            if stage(task) is None:
+                break
+    except Exception as err:
+        print('CHIRPS {n} failed for {d}: {e}'.format(
+            n=stage.__name__, d=Date.strftime('%Y-%m-%d'), e=err))
+        task['error'] = err
+    return task
 
-    # open ftp server
-    ftp = FTP("chg-ftpout.geog.ucsb.edu", "", "")
-    ftp.login()
 
+def Get_filenames(Date, output_folder, TimeCase):
+    """
+    This function creates the FTP path, the FTP file name, and the names of the
+    unzipped and the final file.
+
+    Keyword arguments:
+    Date -- 'yyyy-mm-dd'
+    output_folder -- 'C:/file/to/path/'
+    TimeCase -- String equal to 'daily' or 'monthly'
+    """
     # Define FTP path to directory
     if TimeCase == 'daily':
         pathFTP = 'pub/org/chg/products/CHIRPS-2.0/global_daily/tifs/p05/%s/' % Date.strftime(
@@ -157,13 +192,6 @@ def RetrieveData(Date, args):
     else:
         raise KeyError("The input time interval is not supported")
 
-    # find the document name in this directory
-    ftp.cwd(pathFTP)
-    listing = []
-
-    # read all the file names in the directory
-    ftp.retrlines("LIST", listing.append)
-
     # create all the input name (filename) and output (outfilename, filetif, DiFileEnd) names
     if TimeCase == 'daily':
         filename = 'chirps-v2.0.%s.%02s.%02s.tif.gz' % (
@@ -186,31 +214,107 @@ def RetrieveData(Date, args):
     else:
         raise KeyError("The input time interval is not supported")
 
-    # download the global rainfall file
-    try:
-        local_filename = os.path.join(output_folder, filename)
-        lf = open(local_filename, "wb")
-        ftp.retrbinary("RETR " + filename, lf.write, 8192)
-        lf.close()
+    return pathFTP, filename, outfilename, DirFileEnd
 
-        # unzip the file
-        zip_filename = os.path.join(output_folder, filename)
-        DC.Extract_Data_gz(zip_filename, outfilename)
 
-        # open tiff file
-        dataset = RC.Open_tiff_array(outfilename)
+def Download_from_FTP(task):
+    """
+    This function downloads the global rainfall file, I/O stage.
+    Dates which already have an output are dropped.
 
-        # clip dataset to the given extent
-        data = dataset[yID[0]:yID[1], xID[0]:xID[1]]
-        data[data < 0] = -9999
+    Keyword arguments:
+    task -- {'Date': Date, 'args': args}
+    """
+    # Argument
+    [download, output_folder, TimeCase, xID, yID, geo] = task['args']
+    pathFTP, filename, outfilename, DirFileEnd = Get_filenames(
+        task['Date'], output_folder, TimeCase)
+
+    if os.path.exists(DirFileEnd):
+        task['cache_hit'] = True
+        return None
+
+    # open ftp server
+    with Metrics.timer(task, 'connect'):
+        url = urlparse(Download.get_url('CHIRPS', 'Precipitation', 'v2', TimeCase))
+        ftp = FTP()
+        ftp.connect(url.hostname, url.port or 21)
+        ftp.login()
+        ftp.cwd(pathFTP)
+
+    # download the global rainfall file, in memory or on disk
+    local_filename = os.path.join(output_folder, filename)
+    with Metrics.timer(task, 'transfer'):
+        if Download.is_vsimem():
+            task['buffer'] = Download.get_buffer(
+                lambda write: ftp.retrbinary("RETR " + filename, write, 8192))
+        else:
+            with open(local_filename, "wb") as lf:
+                ftp.retrbinary("RETR " + filename, lf.write, 8192)
+        ftp.quit()
+
+    task['file'] = local_filename
+    task['nbytes'] = len(task['buffer']) if 'buffer' in task \
+        else os.path.getsize(local_filename)
+    return task
+
+
+def Decode_data(task):
+    """
+    This function clips the global rainfall file, CPU stage.
+    The .tif.gz is opened in place through /vsigzip/, only the rows up to the
+    window are decompressed, and no unzipped copy is written.
+
+    Keyword arguments:
+    task -- {'Date': Date, 'args': args, 'file': local_filename},
+            and 'buffer', the bytes of the file, when it is in memory
+    """
+    # Argument
+    [download, output_folder, TimeCase, xID, yID, geo] = task['args']
 
-        # save dataset as geotiff file
-        geo = [lonlim[0], 0.05, 0, latlim[1], 0, -0.05]
-        DC.Save_as_tiff(name=DirFileEnd, data=data, geo=geo, projection="WGS84")
+    # the gz file, in memory when the download is in memory
+    local_filename = task['file']
+    if 'buffer' in task:
+        local_filename = download.get_temp(local_filename, True)
+        download.put_temp(local_filename, task.pop('buffer'))
 
-        # delete old tif file
-        os.remove(outfilename)
+    # read the window of the tiff file
+    vsifile = '/vsigzip/' + local_filename
+    with Metrics.timer(task, 'decode'):
+        data = download.get_tif(vsifile, 1, (xID[0], yID[0], xID[1] - xID[0],
+                                             yID[1] - yID[0]))
 
-    except:
-        print("file not exists")
-    return True
+    # nodata of the clipped dataset, the steps of base.yml
+    transform = Transform.from_conf('CHIRPS', 'Precipitation', 'v2', TimeCase, 'P')
+    with Metrics.timer(task, 'clip'):
+        data = transform(data)
+
+    # delete the gz file
+    download.close_tif(vsifile)
+    download.remove_temp(local_filename)
+
+    task['data'] = data
+    return task
+
+
+def Save_data(task):
+    """
+    This function saves the clipped rainfall data as geotiff, I/O stage.
+
+    Keyword arguments:
+    task -- {'Date': Date, 'args': args, 'data': data}
+    """
+    # Argument
+    [download, output_folder, TimeCase, xID, yID, geo] = task['args']
+    pathFTP, filename, outfilename, DirFileEnd = Get_filenames(
+        task['Date'], output_folder, TimeCase)
+
+    # save dataset as geotiff file, scaled integers of base.yml
+    encoding = download.get_encoding('CHIRPS', 'Precipitation', 'v2', TimeCase, 'P')
+    with Metrics.timer(task, 'write'):
+        download.save_tif(DirFileEnd, task.pop('data'), geo, "WGS84", encoding,
+                          clip=download.get_clip())
+
+    task['output'] = DirFileEnd
+    task['nbytes_out'] = os.path.getsize(DirFileEnd)
+    return task
@@ -36,8 +36,10 @@ import os
 
 # # import math
 # # import datetime
+import functools
 
 from ftplib import FTP
+from urllib.parse import urlparse
 # from joblib import Parallel, delayed
 
 import numpy as np
@@ -46,12 +48,22 @@ import pandas as pd
 
 # Water Accounting Modules
 try:
-    from .download import Download
+    from ..accounts import Accounts
+    from ..download import Download
+    from ..grid import Grid
+    from ..progress import Progress
+    from ..metrics import Metrics
+    from ..trace import Trace
 except ImportError:
+    from src.wateraccounting.Collect.accounts import Accounts
     from src.wateraccounting.Collect.download import Download
+    from src.wateraccounting.Collect.grid import Grid
+    from src.wateraccounting.Collect.progress import Progress
+    from src.wateraccounting.Collect.metrics import Metrics
+    from src.wateraccounting.Collect.trace import Trace
 
 
-def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, Waitbar):
+def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, Waitbar, cores=False):
     """
     This scripts downloads CMRSET ET data from the UNESCO-IHE ftp server.
     The output files display the total ET in mm for a period of one month.
@@ -63,16 +75,17 @@ def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, Waitbar):
     Enddate -- 'yyyy-mm-dd'
     lonlim -- [ymin, ymax] (values must be between -90 and 90)
     latlim -- [xmin, xmax] (values must be between -180 and 180)
+    Waitbar -- 1 (Default) will print a waitbar
+    cores -- The number of download threads. It can be 'False'
+             to download the files one by one.
     """
     # Check the latitude and longitude and otherwise set lat or lon on greatest extent
-    if latlim[0] < -90 or latlim[1] > 90:
-        print('Latitude above 90N or below -90S is not possible. Value set to maximum')
-        latlim[0] = np.max(latlim[0], -90)
-        latlim[1] = np.min(latlim[1], 90)
-    if lonlim[0] < -180 or lonlim[1] > 180:
-        print('Longitude must be between 180E and 180W. Now value is set to maximum')
-        lonlim[0] = np.max(lonlim[0], -180)
-        lonlim[1] = np.min(lonlim[1], 180)
+    grid = Grid.from_conf('CMRSET', 'Evaporation', 'v1', 'monthly', 'ETa')
+    latlim, lonlim = grid.check_latlon(latlim, lonlim)
+
+    # Define IDs
+    yID, xID = grid.window(latlim, lonlim)
+    geo = grid.window_geo(yID, xID)
 
     # Check Startdate and Enddate
     if not Startdate:
@@ -83,56 +96,81 @@ def DownloadData(Dir, Startdate, Enddate, latlim, lonlim, Waitbar):
     # Creates dates library
     Dates = pd.date_range(Startdate, Enddate, freq="MS")
 
-    # Create Waitbar
-    if Waitbar == 1:
-        import watools.Functions.Start.WaitbarConsole as WaitbarConsole
-        total_amount = len(Dates)
-        amount = 0
-        WaitbarConsole.printWaitBar(amount, total_amount, prefix='Progress:',
-                                    suffix='Complete', length=50)
+    # Amount of files for the progress
+    total_amount = len(Dates)
 
     # Define directory and create it if not exists
     output_folder = os.path.join(Dir, 'Evaporation', 'CMRSET', 'Monthly')
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    for Date in Dates:
-
-        # Define year and month
-        year = Date.year
-        month = Date.month
-
-        # Date as printed in filename
-        Filename_out = os.path.join(output_folder,
-                                    'ETa_CMRSET_mm-month-1_monthly_%s.%02s.%02s.tif' % (
-                                    Date.strftime('%Y'), Date.strftime('%m'),
-                                    Date.strftime('%d')))
+    download = Download('', '', is_status=False)
+    args = [download, output_folder, yID, xID, geo]
+    progress = Progress(total_amount, prefix='CMRSET:', is_print=Waitbar == 1)
+    metrics = Metrics('CMRSET', {'dataset': 'Evaporation', 'datatype': 'monthly'})
+    trace = Trace(metrics.product, metrics.labels).start()
+    Download.map(functools.partial(CMRSET_monthly_file, args=args), Dates,
+                 'thread', cores, progress=progress, metrics=metrics)
+    progress.close()
+    metrics.close()
+    trace.stop()
 
-        # Define end filename
-        Filename_in = os.path.join("M01CMRSETGlobalY%dM%02d.tif" % (year, month))
-
-        # Temporary filename for the downloaded global file
-        local_filename = os.path.join(output_folder, Filename_in)
-
-        # Download the data from FTP server if the file not exists
-        if not os.path.exists(Filename_out):
-            try:
-                Download_CMRSET_from_WA_FTP(local_filename, Filename_in)
+    return
 
-                # Clip dataset
-                RC.Clip_Dataset_GDAL(local_filename, Filename_out, latlim, lonlim)
-                os.remove(local_filename)
 
-            except:
-                print("Was not able to download file with date %s" % Date)
+def CMRSET_monthly_file(Date, args):
+    """
+    This function downloads and clips the CMRSET file of a month.
 
-        # Adjust waitbar
-        if Waitbar == 1:
-            amount += 1
-            WaitbarConsole.printWaitBar(amount, total_amount, prefix='Progress:',
-                                        suffix='Complete', length=50)
+    Keyword arguments:
+    Date -- pandas timestamp month
+    args -- A list of parameters defined in the DownloadData function.
 
-    return
+    Returns the task, with the bytes downloaded, and the error of a failed month.
+    """
+    # Argument
+    [download, output_folder, yID, xID, geo] = args
+
+    # Define year and month
+    year = Date.year
+    month = Date.month
+
+    # Date as printed in filename
+    Filename_out = os.path.join(output_folder,
+                                'ETa_CMRSET_mm-month-1_monthly_%s.%02s.%02s.tif' % (
+                                Date.strftime('%Y'), Date.strftime('%m'),
+                                Date.strftime('%d')))
+
+    # Define end filename
+    Filename_in = os.path.join("M01CMRSETGlobalY%dM%02d.tif" % (year, month))
+
+    # Temporary filename for the downloaded global file
+    local_filename = os.path.join(output_folder, Filename_in)
+
+    # Download the data from FTP server if the file not exists
+    task = {'Date': Date}
+    if os.path.exists(Filename_out):
+        task['cache_hit'] = True
+    else:
+        try:
+            task['nbytes'] = Download_CMRSET_from_WA_FTP(local_filename, Filename_in)
+
+            # Clip dataset
+            data = download.get_tif(local_filename, 1, (xID[0], yID[0],
+                                                        xID[1] - xID[0],
+                                                        yID[1] - yID[0]))
+            download.close_tif(local_filename)
+            encoding = download.get_encoding('CMRSET', 'Evaporation', 'v1',
+                                             'monthly', 'ETa')
+            download.save_tif(Filename_out, data, geo, "WGS84", encoding,
+                              clip=download.get_clip())
+            os.remove(local_filename)
+            task['output'] = Filename_out
+
+        except Exception as err:
+            print("Was not able to download file with date %s: %s" % (Date, err))
+            task['error'] = err
+    return task
 
 
 def Download_CMRSET_from_WA_FTP(local_filename, Filename_in):
@@ -150,11 +188,14 @@ def Download_CMRSET_from_WA_FTP(local_filename, Filename_in):
     """
 
     # Collect account and FTP information
-    username, password = WebAccounts.Accounts(Type='FTP_WA')
-    ftpserver = "ftp.wateraccounting.unesco-ihe.org"
+    user = Accounts('', 'FTP_WA', is_status=False).get_user('account')['FTP_WA']
+    username = user['username']
+    password = user['password']
+    url = urlparse(Download.get_url('CMRSET', 'Evaporation', 'v1', 'monthly'))
 
     # Download data from FTP
-    ftp = FTP(ftpserver)
+    ftp = FTP()
+    ftp.connect(url.hostname, url.port or 21)
     ftp.login(username, password)
     directory = "/WaterAccounting/Data_Satellite/Evaporation/CMRSET/Global/"
     ftp.cwd(directory)
@@ -162,4 +203,4 @@ def Download_CMRSET_from_WA_FTP(local_filename, Filename_in):
     ftp.retrbinary("RETR " + Filename_in, lf.write)
     lf.close()
 
-    return
+    return os.path.getsize(local_filename)
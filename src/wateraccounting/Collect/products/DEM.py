@@ -14,6 +14,10 @@ This module downloads DEM data from
 
 Use the DEM functions to download and create DEM images in Gtiff format.
 
+The 15s and 30s continents are converted once into tiled GeoTIFF files,
+in the ``WA_DEM_CACHE`` folder, default ``Cache`` in the output folder.
+The next requests read their window from the cache, without downloading.
+
 **Examples:**
 ::
 
@@ -28,6 +32,7 @@ import shutil
 
 # # import math
 # # import datetime
+import functools
 
 import urllib
 # from ftplib import FTP
@@ -37,14 +42,23 @@ import numpy as np
 import pandas as pd
 # from netCDF4 import Dataset
 
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
 # Water Accounting Modules
 try:
-    from .download import Download
+    from ..download import Download
+    from ..gis import GIS
+    from ..grid import Grid
 except ImportError:
     from src.wateraccounting.Collect.download import Download
+    from src.wateraccounting.Collect.gis import GIS
+    from src.wateraccounting.Collect.grid import Grid
 
 
-def DownloadData(output_folder, latlim, lonlim, parameter, resolution):
+def DownloadData(output_folder, latlim, lonlim, parameter, resolution, cores=False):
     """
     This function downloads DEM data from HydroSHED
 
@@ -56,6 +70,8 @@ def DownloadData(output_folder, latlim, lonlim, parameter, resolution):
                     resolution
              -- 0 = The data will have the same pixel size as the data obtained
                     from the internet
+    cores -- The number of download threads. It can be 'False'
+             to download the tiles one by one.
     """
     # Define parameter depedent variables
     if parameter == "dir_3s":
@@ -103,30 +119,42 @@ def DownloadData(output_folder, latlim, lonlim, parameter, resolution):
         size_X_tot = 0
         size_Y_tot = 0
 
+    nameResults = []
     if resolution == '15s' or resolution == '30s':
         name = Find_Document_names_15s_30s(latlim, lonlim, parameter, resolution)
 
-    nameResults = []
+        # Continents in the cache are read in place, only the others are
+        # downloaded and converted
+        output_folder_cache = Get_Cache_Folder(output_folder)
+        cache_files = [Get_Cache_Name(output_folder_cache, nameFile)
+                       for nameFile in name]
+        nameResults = [f for f in cache_files if os.path.exists(f)]
+        name = [nameFile for nameFile, f in zip(name, cache_files)
+                if not os.path.exists(f)]
+
     # Create a temporary folder for processing
     output_folder_trash = os.path.join(output_folder, "Temp")
     if not os.path.exists(output_folder_trash):
         os.makedirs(output_folder_trash)
+    # Folder of the temporary tiff files, in memory when WA_VSIMEM is set
+    output_folder_temp = Download.get_temp(output_folder_trash)
 
-    # Download, extract, and converts all the files to tiff files
-    for nameFile in name:
+    # Download the data from
+    # http://earlywarning.usgs.gov/hydrodata/
+    args = [output_folder_trash, parameter, para_name, resolution]
+    downloads = Download.map(functools.partial(Download_tile, args=args), name,
+                             'thread', cores)
 
-        try:
-            # Download the data from
-            # http://earlywarning.usgs.gov/hydrodata/
-            output_file, file_name = Download_Data(nameFile,
-                                                   output_folder_trash, parameter,
-                                                   para_name, resolution)
+    # Open the files in the zip files in place, without extracting
+    gis = GIS('', is_status=False)
+    for nameFile, download in zip(name, downloads):
 
-            # extract zip data
-            DC.Extract_Data(output_file, output_folder_trash)
+        try:
+            if download is None:
+                raise IOError('%s not found.' % nameFile)
+            output_file, file_name = download
 
-            # Converts the data with a adf extention to a tiff extension.
-            # The input is the file name and in which directory the data must be stored
+            # Name of the temporary tiff file
             file_name_tiff = file_name.split('.')[0] + '_trans_temporary.tif'
             file_name_extract = file_name.split('_')[0:3]
             if resolution == '3s':
@@ -140,21 +168,18 @@ def DownloadData(output_folder, latlim, lonlim, parameter, resolution):
                 file_name_extract2 = file_name_extract[0] + '_' + file_name_extract[
                     1] + '_30s'
 
-            output_tiff = os.path.join(output_folder_trash, file_name_tiff)
+            output_tiff = os.path.join(output_folder_temp, file_name_tiff)
 
-            # convert data from adf to a tiff file
+            # adf grid in the zip file, read in place through /vsizip/
             if (resolution == "15s" or resolution == "3s"):
-                input_adf = os.path.join(output_folder_trash, file_name_extract2,
-                                         file_name_extract2, 'hdr.adf')
-                output_tiff = DC.Convert_adf_to_tiff(input_adf, output_tiff)
+                input_file = '/vsizip/%s/%s/%s/hdr.adf' % (
+                    output_file, file_name_extract2, file_name_extract2)
 
-            # convert data from adf to a tiff file
+            # bil file in the zip file, read in place through /vsizip/
             if resolution == "30s":
-                input_bil = os.path.join(output_folder_trash,
-                                         '%s.bil' % file_name_extract2)
-                output_tiff = DC.Convert_bil_to_tiff(input_bil, output_tiff)
+                input_file = '/vsizip/%s/%s.bil' % (output_file, file_name_extract2)
 
-            geo_out, proj, size_X, size_Y = RC.Open_array_info(output_tiff)
+            geo_out, proj, size_X, size_Y = gis.get_tif_info(input_file)
             if (resolution == "3s" and (
                     int(size_X) != int(6000) or int(size_Y) != int(6000))):
                 data = np.ones((6000, 6000)) * -9999
@@ -178,19 +203,14 @@ def DownloadData(output_folder, latlim, lonlim, parameter, resolution):
                     SignHor = -1
                 Bound1 = int(SignHor) * int(Hfile)
 
-                Expected_X_min = Bound1
-                Expected_Y_max = Bound2 + 5
-
-                Xid_start = int(np.round((geo_out[0] - Expected_X_min) / geo_out[1]))
-                Xid_end = int(np.round(
-                    ((geo_out[0] + size_X * geo_out[1]) - Expected_X_min) / geo_out[1]))
-                Yid_start = int(np.round((Expected_Y_max - geo_out[3]) / (-geo_out[5])))
-                Yid_end = int(np.round(
-                    (Expected_Y_max - (geo_out[3] + (size_Y * geo_out[5]))) / (
-                        -geo_out[5])))
+                # Position of the tile in the expected 5x5 degree tile
+                tile = Grid.from_geo(geo_out, (size_Y, size_X))
+                grid = Grid.from_geo([Bound1, geo_out[1], 0, Bound2 + 5, 0, geo_out[5]],
+                                     (6000, 6000))
+                Yid, Xid = grid.window([tile.lat['s'], tile.lat['n']],
+                                       [tile.lon['w'], tile.lon['e']])
 
-                data[Yid_start:Yid_end, Xid_start:Xid_end] = RC.Open_tiff_array(
-                    output_tiff)
+                data[Yid[0]:Yid[1], Xid[0]:Xid[1]] = gis.get_tif(input_file, 1)
                 if np.max(data) == 255:
                     data[data == 255] = -9999
                 data[data < -9999] = -9999
@@ -199,15 +219,20 @@ def DownloadData(output_folder, latlim, lonlim, parameter, resolution):
                           0.0, -0.0008333333333333333333]
 
                 # save chunk as tiff file
-                DC.Save_as_tiff(name=output_tiff, data=data, geo=geo_in,
-                                projection="WGS84")
+                gis.save_tif(output_tiff, data, geo_in, "WGS84")
+                input_file = output_tiff
+
+            if resolution == '15s' or resolution == '30s':
+                cache_file = Get_Cache_Name(output_folder_cache, nameFile)
+                Save_Cache(gis, input_file, cache_file)
+                nameResults.append(cache_file)
 
         except:
 
             if resolution == '3s':
                 # If tile not exist create a replacing zero tile (sea tiles)
                 output = nameFile.split('.')[0] + "_trans_temporary.tif"
-                output_tiff = os.path.join(output_folder_trash, output)
+                output_tiff = os.path.join(output_folder_temp, output)
                 file_name = nameFile
                 data = np.ones((6000, 6000)) * -9999
                 data = data.astype(np.float32)
@@ -235,16 +260,21 @@ def DownloadData(output_folder, latlim, lonlim, parameter, resolution):
                           0.0, -0.0008333333333333333333]
 
                 # save chunk as tiff file
-                DC.Save_as_tiff(name=output_tiff, data=data, geo=geo_in,
-                                projection="WGS84")
+                gis.save_tif(output_tiff, data, geo_in, "WGS84")
+                input_file = output_tiff
 
             if resolution == '15s':
                 print('no 15s data is in dataset')
 
         if resolution == '3s':
 
-            # clip data
-            Data, Geo_data = RC.clip_data(output_tiff, latlim, lonlim)
+            # clip data, only the window of the tile is read
+            geo_in, proj, size_X, size_Y = gis.get_tif_info(input_file)
+            tile = Grid.from_geo(geo_in, (size_Y, size_X))
+            Yid, Xid = tile.window(latlim, lonlim)
+            Data = gis.get_tif(input_file, 1, (Xid[0], Yid[0], Xid[1] - Xid[0],
+                                               Yid[1] - Yid[0]))
+            Geo_data = tile.window_geo(Yid, Xid)
             size_Y_out = int(np.shape(Data)[0])
             size_X_out = int(np.shape(Data)[1])
 
@@ -261,12 +291,11 @@ def DownloadData(output_folder, latlim, lonlim, parameter, resolution):
 
             # create name for chunk
             FileNameEnd = "%s_temporary.tif" % (nameFile)
-            nameForEnd = os.path.join(output_folder_trash, FileNameEnd)
+            nameForEnd = os.path.join(output_folder_temp, FileNameEnd)
             nameResults.append(str(nameForEnd))
 
             # save chunk as tiff file
-            DC.Save_as_tiff(name=nameForEnd, data=Data, geo=Geo_data,
-                            projection="WGS84")
+            gis.save_tif(nameForEnd, Data, Geo_data, "WGS84")
 
     if resolution == '3s':
         # size_X_end = int(size_X_tot) #!
@@ -288,32 +317,107 @@ def DownloadData(output_folder, latlim, lonlim, parameter, resolution):
         datasetTot[datasetTot < -9999] = -9999
 
     if resolution == '15s':
-        output_file_merged = os.path.join(output_folder_trash, 'merged.tif')
-        datasetTot, geo_out = Merge_DEM_15s_30s(output_folder_trash, output_file_merged,
-                                                latlim, lonlim, resolution)
+        output_file_merged = os.path.join(output_folder_temp, 'merged.tif')
+        datasetTot, geo_out = Merge_DEM_15s_30s(output_folder_temp, output_file_merged,
+                                                latlim, lonlim, resolution,
+                                                nameResults)
 
     if resolution == '30s':
-        output_file_merged = os.path.join(output_folder_trash, 'merged.tif')
-        datasetTot, geo_out = Merge_DEM_15s_30s(output_folder_trash, output_file_merged,
-                                                latlim, lonlim, resolution)
+        output_file_merged = os.path.join(output_folder_temp, 'merged.tif')
+        datasetTot, geo_out = Merge_DEM_15s_30s(output_folder_temp, output_file_merged,
+                                                latlim, lonlim, resolution,
+                                                nameResults)
 
     # name of the end result
     output_DEM_name = "%s_HydroShed_%s_%s.tif" % (para_name, unit, resolution)
 
     Save_name = os.path.join(output_folder, output_DEM_name)
 
-    # Make geotiff file
-    DC.Save_as_tiff(name=Save_name, data=datasetTot, geo=geo_out, projection="WGS84")
+    # Make geotiff file, the DEM in metres as int16
+    encoding = None
+    if para_name == "DEM":
+        encoding = gis.get_encoding('DEM', para_name, 'v1', resolution)
+    gis.save_tif(Save_name, datasetTot, geo_out, "WGS84", encoding,
+                 clip=gis.get_clip())
     os.chdir(output_folder)
 
     # Delete the temporary folder
+    gis.close_tif(output_folder_trash)
+    Download.remove_temp(output_folder_temp)
     shutil.rmtree(output_folder_trash)
 
 
+def Get_Cache_Folder(output_folder):
+    """
+    This function returns the folder of the continent cache, the
+    ``WA_DEM_CACHE`` environment variable, default output_folder/Cache
+
+    Keyword arguments:
+    output_folder -- directory of the result
+    """
+    output_folder_cache = os.environ.get('WA_DEM_CACHE', '')
+    if output_folder_cache == '':
+        output_folder_cache = os.path.join(output_folder, 'Cache')
+    if not os.path.exists(output_folder_cache):
+        os.makedirs(output_folder_cache)
+    return output_folder_cache
+
+
+def Get_Cache_Name(output_folder_cache, nameFile):
+    """
+    This function returns the cache file of a continent zip file,
+    af_dem_15s_grid.zip is cached as af_dem_15s.tif
+
+    Keyword arguments:
+    output_folder_cache -- directory of the cache
+    nameFile -- name of the zip file, continent_parameter_resolution_*.zip
+    """
+    return os.path.join(output_folder_cache,
+                        '%s.tif' % '_'.join(str(nameFile).split('_')[0:3]))
+
+
+def Save_Cache(gis, input_file, cache_file):
+    """
+    This function converts a continent once into a tiled geotiff, read by
+    windows in the next requests. The file is renamed when complete, an
+    interrupted conversion leaves no cache file.
+
+    Keyword arguments:
+    gis -- GIS
+    input_file -- the continent, in place in the zip file
+    cache_file -- the tiled geotiff
+    """
+    geo, proj, size_X, size_Y = gis.get_tif_info(input_file)
+    cache_file_temp = '%s.%d.temporary.tif' % (cache_file, os.getpid())
+    blocks = ((window, np.where(data < -9999, -9999, data))
+              for window, data in gis.get_tif_blocks(input_file, 1,
+                                                     size=(1024, 1024)))
+    gis.save_tif_blocks(cache_file_temp, blocks, (size_Y, size_X), geo, "WGS84")
+    gis.close_tif(input_file)
+    os.replace(cache_file_temp, cache_file)
+
+
 def Merge_DEM_15s_30s(output_folder_trash, output_file_merged, latlim, lonlim,
-                      resolution):
-    os.chdir(output_folder_trash)
-    tiff_files = glob.glob('*.tif')
+                      resolution, tiff_files=None):
+    """
+    This function merges the windows of the tiles, only the windows are read
+
+    Keyword arguments:
+    output_folder_trash -- directory of the tiff files
+    output_file_merged -- name of the merged file, not written
+    latlim -- [ymin, ymax]
+    lonlim -- [xmin, xmax]
+    resolution -- '15s' or '30s'
+    tiff_files -- ['string'], the files of the tiles, in place in the zip
+                  files, default the tiff files in output_folder_trash
+    """
+    if tiff_files is None:
+        if output_folder_trash.startswith('/vsimem/'):
+            tiff_files = [output_folder_trash + '/' + f
+                          for f in gdal.ReadDir(output_folder_trash) or []
+                          if f.endswith('.tif')]
+        else:
+            tiff_files = glob.glob(os.path.join(output_folder_trash, '*.tif'))
     resolution_geo = []
     lonmin = lonlim[0]
     lonmax = lonlim[1]
@@ -329,58 +433,32 @@ def Merge_DEM_15s_30s(output_folder_trash, output_file_merged, latlim, lonlim,
 
     data_tot = np.ones([size_y_tot, size_x_tot]) * -9999.
 
-    for tiff_file in tiff_files:
-        inFile = os.path.join(output_folder_trash, tiff_file)
-        geo, proj, size_X, size_Y = RC.Open_array_info(inFile)
+    gis = GIS('', is_status=False)
+    for inFile in tiff_files:
+        geo, proj, size_X, size_Y = gis.get_tif_info(inFile)
         resolution_geo = geo[1]
 
-        lonmin_one = geo[0]
-        lonmax_one = geo[0] + size_X * geo[1]
-        latmin_one = geo[3] + size_Y * geo[5]
-        latmax_one = geo[3]
-
-        if lonmin_one < lonmin:
-            lonmin_clip = lonmin
-        else:
-            lonmin_clip = lonmin_one
-
-        if lonmax_one > lonmax:
-            lonmax_clip = lonmax
-        else:
-            lonmax_clip = lonmax_one
+        # Overlap of the tile and the end dataset
+        tile = Grid.from_geo(geo, (size_Y, size_X))
+        grid = Grid.from_geo([lonmin, resolution_geo, 0, latmax, 0, -resolution_geo],
+                             data_tot.shape)
+        latlim_clip = [max(latmin, tile.lat['s']), min(latmax, tile.lat['n'])]
+        lonlim_clip = [max(lonmin, tile.lon['w']), min(lonmax, tile.lon['e'])]
+        if latlim_clip[0] >= latlim_clip[1] or lonlim_clip[0] >= lonlim_clip[1]:
+            continue
 
-        if latmin_one < latmin:
-            latmin_clip = latmin
-        else:
-            latmin_clip = latmin_one
+        yID_tiff, xID_tiff = tile.window(latlim_clip, lonlim_clip)
+        yID_tot, xID_tot = grid.window(latlim_clip, lonlim_clip)
+        size_y_clip = min(yID_tiff[1] - yID_tiff[0], yID_tot[1] - yID_tot[0])
+        size_x_clip = min(xID_tiff[1] - xID_tiff[0], xID_tot[1] - xID_tot[0])
 
-        if latmax_one > latmax:
-            latmax_clip = latmax
-        else:
-            latmax_clip = latmax_one
-
-        size_x_clip = int(np.round((lonmax_clip - lonmin_clip) / resolution_geo))
-        size_y_clip = int(np.round((latmax_clip - latmin_clip) / resolution_geo))
-
-        inFile = os.path.join(output_folder_trash, tiff_file)
-        geo, proj, size_X, size_Y = RC.Open_array_info(inFile)
-        Data = RC.Open_tiff_array(inFile)
-        lonmin_tiff = geo[0]
-        latmax_tiff = geo[3]
-        lon_tiff_position = int(np.round((lonmin_clip - lonmin_tiff) / resolution_geo))
-        lat_tiff_position = int(np.round((latmax_tiff - latmax_clip) / resolution_geo))
-        lon_data_tot_position = int(np.round((lonmin_clip - lonmin) / resolution_geo))
-        lat_data_tot_position = int(np.round((latmax - latmax_clip) / resolution_geo))
-
-        Data[Data < -9999.] = -9999.
-        data_tot[lat_data_tot_position:lat_data_tot_position + size_y_clip,
-        lon_data_tot_position:lon_data_tot_position + size_x_clip][
-            data_tot[lat_data_tot_position:lat_data_tot_position + size_y_clip,
-            lon_data_tot_position:lon_data_tot_position + size_x_clip] == -9999] = \
-            Data[lat_tiff_position:lat_tiff_position + size_y_clip,
-            lon_tiff_position:lon_tiff_position + size_x_clip][
-                data_tot[lat_data_tot_position:lat_data_tot_position + size_y_clip,
-                lon_data_tot_position:lon_data_tot_position + size_x_clip] == -9999]
+        data_tiff = gis.get_tif(inFile, 1, (xID_tiff[0], yID_tiff[0],
+                                            size_x_clip, size_y_clip))
+        data_tiff[data_tiff < -9999.] = -9999.
+        data_clip = data_tot[yID_tot[0]:yID_tot[0] + size_y_clip,
+                             xID_tot[0]:xID_tot[0] + size_x_clip]
+        nodata = data_clip == -9999
+        data_clip[nodata] = data_tiff[nodata]
 
     geo_out = [lonmin, resolution_geo, 0.0, latmax, 0.0, -1 * resolution_geo]
     geo_out = tuple(geo_out)
@@ -405,19 +483,23 @@ def Merge_DEM(latlim, lonlim, nameResults, size_Y_tot, size_X_tot):
     datasetTot = np.ones([size_Y_tot, size_X_tot]) * -9999.
 
     # Put all the files in the datasetTot (1 by 1)
+    grid = None
+    gis = GIS('', is_status=False)
     for nameTot in nameResults:
-        f = gdal.Open(nameTot)
-        dataset = np.array(f.GetRasterBand(1).ReadAsArray())
-        dataset = np.flipud(dataset)
-        geo_out = f.GetGeoTransform()
-        BoundChunk1 = int(round((geo_out[0] - lonlim[0]) / geo_out[1]))
+        dataset = gis.get_tif(nameTot, 1)
+        geo_out = gis.get_tif_geo(nameTot)
+        if grid is None:
+            grid = Grid.from_geo([lonlim[0], geo_out[1], 0, latlim[1], 0, geo_out[5]],
+                                 datasetTot.shape)
+
+        # Position of the upper left pixel of the chunk
+        row, col = grid.to_index(geo_out[3] + 0.5 * geo_out[5],
+                                 geo_out[0] + 0.5 * geo_out[1])
+        BoundChunk1 = int(col)
         BoundChunk2 = BoundChunk1 + int(dataset.shape[1])
-        BoundChunk4 = size_Y_tot + int(round((geo_out[3] -
-                                              latlim[1]) / geo_out[1]))
-        BoundChunk3 = BoundChunk4 - int(dataset.shape[0])
+        BoundChunk3 = int(row)
+        BoundChunk4 = BoundChunk3 + int(dataset.shape[0])
         datasetTot[BoundChunk3:BoundChunk4, BoundChunk1:BoundChunk2] = dataset
-        f = None
-    datasetTot = np.flipud(datasetTot)
     return (datasetTot)
 
 
@@ -459,6 +541,22 @@ def Find_Document_Names(latlim, lonlim, parameter):
     return (name, rangeLon, rangeLat)
 
 
+def Download_tile(nameFile, args):
+    """
+    This function downloads one tile, None if the tile does not exist
+
+    Keyword Arguments:
+    nameFile -- name, name of the file that must be downloaded
+    args -- A list of parameters defined in the DownloadData function.
+    """
+    [output_folder_trash, parameter, para_name, resolution] = args
+    try:
+        return Download_Data(nameFile, output_folder_trash, parameter,
+                             para_name, resolution)
+    except:
+        return None
+
+
 def Download_Data(nameFile, output_folder_trash, parameter, para_name, resolution):
     """
     This function downloads the DEM data from the HydroShed website
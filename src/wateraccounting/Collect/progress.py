@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+**Progress**
+
+`Restrictions`
+
+The data and this python file may not be distributed to others without
+permission of the WA+ team.
+
+`Description`
+
+Throughput-aware progress of the product downloads.
+
+The counters are shared by all workers, threads update them directly,
+process stages are counted by the ``Pipeline`` thread waiting on them.
+The line reports files, bytes, MB/s, ETA and for each stage the rate and
+the busy time per wall time. A stage busy near its number of workers is
+the bottleneck, network for the download stage, CPU for the decode stage.
+
+The line is printed at most once per ``interval`` seconds,
+so reporting costs a few microseconds per file.
+
+**Examples:**
+::
+
+    from wateraccounting.Collect.progress import Progress
+    progress = Progress(365, prefix='CHIRPS:')
+    for i in range(365):
+        progress.update(stage='download', seconds=0.5, nbytes=1024 ** 2)
+        progress.update(files=1, stage='decode', seconds=0.1)
+    progress.close()
+"""
+# import os
+import sys
+# import inspect
+# import shutil
+# import yaml
+
+import time
+import threading
+
+
+class Progress(object):
+    """This Progress class
+
+    Thread-safe progress counters, with throttled printing.
+
+    Args:
+      total (int): Total number of files.
+      prefix (str): Prefix of the line.
+      interval (float): Minimum seconds between two printed lines.
+      is_print (bool): Is to print the line.
+      stream (file): Output stream, default ``sys.stdout``.
+    """
+    __conf = {
+        'interval': 1.0,
+        'length': 30,
+        'fill': '█'
+    }
+
+    def __init__(self, total, prefix='Progress:', interval=None, is_print=True,
+                 stream=None):
+        """Class instantiation
+        """
+        self.total = int(total)
+        self.prefix = prefix
+        self.interval = self.__conf['interval'] if interval is None else interval
+        self.is_print = is_print
+        self.stream = sys.stdout if stream is None else stream
+
+        self.files = 0
+        self.nbytes = 0
+        self.stages = {}
+
+        self.__lock = threading.Lock()
+        self.__start = time.time()
+        self.__printed = 0.
+
+    def update(self, files=0, nbytes=0, stage=None, seconds=0.):
+        """Update counters
+
+        Args:
+          files (int): Number of files done.
+          nbytes (int): Number of bytes transferred.
+          stage (str): Stage name, the counters of the stage are updated.
+          seconds (float): Seconds spent in the stage.
+        """
+        with self.__lock:
+            self.files += files
+            self.nbytes += nbytes
+            if stage is not None:
+                counter = self.stages.setdefault(
+                    stage, {'count': 0, 'seconds': 0., 'nbytes': 0})
+                counter['count'] += 1
+                counter['seconds'] += seconds
+                counter['nbytes'] += nbytes
+
+            now = time.time()
+            is_report = self.is_print and (
+                now - self.__printed >= self.interval or self.files >= self.total)
+            if is_report:
+                self.__printed = now
+
+        if is_report:
+            self.report()
+
+    def get(self):
+        """Get progress
+
+        Returns:
+          dict: {'files', 'total', 'nbytes', 'seconds', 'mbps', 'eta',
+          'stages': {stage: {'count', 'seconds', 'nbytes', 'rate', 'busy'}}}.
+          'rate' is items per second, 'busy' is stage seconds per second,
+          'eta' is None before the first file.
+
+        :Example:
+
+            >>> from wateraccounting.Collect.progress import Progress
+            >>> progress = Progress(4, is_print=False)
+            >>> progress.update(files=1, nbytes=1024 ** 2)
+            >>> progress.get()['files']
+            1
+        """
+        with self.__lock:
+            seconds = max(time.time() - self.__start, 1.0e-9)
+            stages = {}
+            for stage, counter in self.stages.items():
+                stages[stage] = dict(counter)
+                stages[stage]['rate'] = counter['count'] / seconds
+                stages[stage]['busy'] = counter['seconds'] / seconds
+
+            eta = None
+            if self.files > 0:
+                eta = max(self.total - self.files, 0) * seconds / self.files
+
+            return {
+                'files': self.files,
+                'total': self.total,
+                'nbytes': self.nbytes,
+                'seconds': seconds,
+                'mbps': self.nbytes / 1024. ** 2 / seconds,
+                'eta': eta,
+                'stages': stages
+            }
+
+    def format(self):
+        """Format progress line
+
+        Returns:
+          str: Progress line.
+        """
+        info = self.get()
+        length = self.__conf['length']
+
+        ratio = min(float(info['files']) / self.total, 1.) if self.total > 0 else 1.
+        filled = int(length * ratio)
+        bar = self.__conf['fill'] * filled + '-' * (length - filled)
+
+        if info['eta'] is None:
+            eta = '--:--:--'
+        else:
+            eta = time.strftime('%H:%M:%S', time.gmtime(info['eta']))
+
+        stages = ' | '.join(
+            '{k} {r:.1f}/s {b:.0%}'.format(k=stage, r=counter['rate'],
+                                           b=counter['busy'])
+            for stage, counter in info['stages'].items())
+
+        line = '{p} |{b}| {r:.1%} {n}/{t} files {s:.1f} MB {m:.2f} MB/s ETA {e}'.format(
+            p=self.prefix, b=bar, r=ratio, n=info['files'], t=info['total'],
+            s=info['nbytes'] / 1024. ** 2, m=info['mbps'], e=eta)
+        if stages:
+            line += ' [{}]'.format(stages)
+
+        return line
+
+    def report(self):
+        """Print progress line
+        """
+        self.stream.write('\r{}'.format(self.format()))
+        self.stream.flush()
+
+    def close(self):
+        """Print last progress line
+        """
+        if self.is_print:
+            self.report()
+            self.stream.write('\n')
+            self.stream.flush()
+
+
+def main():
+    from pprint import pprint
+
+    # Progress __init__
+    print('\nProgress\n=====')
+    progress = Progress(10, prefix='Progress:')
+    for i in range(10):
+        progress.update(files=1, nbytes=1024 ** 2, stage='download', seconds=0.1)
+    progress.close()
+
+    # Progress methods
+    print('\nprogress.get()\n=====')
+    pprint(progress.get())
+
+
+if __name__ == "__main__":
+    main()
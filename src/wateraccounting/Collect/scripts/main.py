@@ -2,11 +2,110 @@
 """
 Main command group for WaterAccounting Collect's CLI.
 
+**Examples:**
+::
+
+    wa-collect plan job.yml
+    wa-collect run job.yml --cores 8
+    wa-collect sync job.yml
+    wa-collect serve C:/Temp --port 8080
+    wa-collect zonal basins.geojson C:/Temp/Zonal C:/Temp/CHIRPS/Daily/*.tif
+
 """
 # import logging
 # from pkg_resources import iter_entry_points
 # import sys
 #
 # from click_plugins import with_plugins
-# import click
+import click
 # import cligj
+
+try:
+    from ..job import Job
+except ImportError:
+    from src.wateraccounting.Collect.job import Job
+
+try:
+    from ..serve import SubsetServer
+except ImportError:
+    from src.wateraccounting.Collect.serve import SubsetServer
+
+try:
+    from ..zonal import Zonal, Zones
+except ImportError:
+    from src.wateraccounting.Collect.zonal import Zonal, Zones
+
+
+@click.group()
+def cli():
+    """WaterAccounting Collect, download products from a YAML job file."""
+
+
+@cli.command()
+@click.argument('jobfile', type=click.Path(exists=True, dir_okay=False))
+@click.option('--remote/--no-remote', default=False,
+              help='Request the sizes of the remote files.')
+def plan(jobfile, remote):
+    """Plan a job, without downloading."""
+    job = Job.from_yaml(jobfile)
+    click.echo(job.format(job.plan(remote)))
+
+
+@cli.command()
+@click.argument('jobfile', type=click.Path(exists=True, dir_okay=False))
+@click.option('--cores', type=int, default=None,
+              help='Workers of the job, 0 runs serial, default the job file.')
+@click.option('--waitbar/--no-waitbar', default=False,
+              help='Print a wait bar per product.')
+def run(jobfile, cores, waitbar):
+    """Plan and run a job, and print the throughput."""
+    job = Job.from_yaml(jobfile)
+    groups = job.plan()
+    click.echo(job.format(groups))
+    summaries = job.run(groups, cores, int(waitbar))
+    click.echo(Job.format_summary(summaries))
+
+
+@cli.command()
+@click.argument('jobfile', type=click.Path(exists=True, dir_okay=False))
+@click.option('--cores', type=int, default=None,
+              help='Workers of the job, 0 runs serial, default the job file.')
+@click.option('--waitbar/--no-waitbar', default=False,
+              help='Print a wait bar per product.')
+def sync(jobfile, cores, waitbar):
+    """Fetch only the dates published since the last sync."""
+    job = Job.from_yaml(jobfile)
+    summaries = job.sync(cores, int(waitbar))
+    click.echo(Job.format_summary(summaries))
+
+
+@cli.command()
+@click.argument('root', type=click.Path(exists=True, file_okay=False))
+@click.option('--host', default='127.0.0.1', help='Host address.')
+@click.option('--port', type=int, default=8080, help='Port.')
+@click.option('--size', type=int, default=None,
+              help='Maximum number of open file handles.')
+def serve(root, host, port, size):
+    """Serve subsets of a collected archive over HTTP."""
+    server = SubsetServer(root, host, port, size)
+    click.echo('Serving {r} on {u}'.format(r=root, u=server.url))
+    server.serve_forever()
+
+
+@cli.command()
+@click.argument('zonefile', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output', type=click.Path(file_okay=False))
+@click.argument('files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--field', default=None, help='Property of the zone names.')
+@click.option('--stat', 'stats', multiple=True, default=('sum', 'mean', 'count'),
+              type=click.Choice(['sum', 'mean', 'count']),
+              help='Statistic, repeatable, default all.')
+def zonal(zonefile, output, files, field, stats):
+    """Zonal statistics of product files over polygons, a CSV per statistic."""
+    zones = Zones.from_file(zonefile, field)
+    for file in Zonal('', is_status=False).run(list(files), zones, output, stats):
+        click.echo(file)
+
+
+if __name__ == "__main__":
+    cli()
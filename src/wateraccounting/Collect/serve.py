@@ -0,0 +1,565 @@
+# -*- coding: utf-8 -*-
+"""
+**Serve**
+
+`Restrictions`
+
+The data and this python file may not be distributed to others without
+permission of the WA+ team.
+
+`Description`
+
+Local subset server of a collected archive, the ``Dir`` of ``DownloadData``,
+so several teams share one copy of the products.
+
+The server answers bounding box, time and variable queries from the local
+files, and streams the subset as a multi-band GeoTIFF, one band per date,
+or as a NetCDF with a time dimension.
+The files are found with ``Planner``, the same names as the products write,
+and only the window of the bounding box is read from each file,
+one date at a time, into the compressed output.
+Queries of more dates than the limit, or of windows which differ in shape,
+the CFSR grid of 2011, are rejected, to be split by the client.
+The open GDAL handles are kept in the bounded LRU of ``GIS.open_tif``,
+a file rewritten by a running collection is opened again.
+
+The server only uses the standard library and runs in threads.
+
+**Examples:**
+::
+
+    from wateraccounting.Collect.serve import SubsetServer
+    server = SubsetServer('C:/Temp', port=8080).start()
+
+    GET /products
+    GET /subset?product=CHIRPS&datatype=daily&variable=P
+               &latlim=-10,30&lonlim=-20,-10
+               &Startdate=2019-01-01&Enddate=2019-01-31&format=nc
+"""
+import os
+# import sys
+# import inspect
+# import shutil
+# import yaml
+
+import json
+import uuid
+import itertools
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+try:
+    from .gis import GIS
+except ImportError:
+    from src.wateraccounting.Collect.gis import GIS
+
+try:
+    from .grid import Grid
+except ImportError:
+    from src.wateraccounting.Collect.grid import Grid
+
+try:
+    from .planner import Planner
+except ImportError:
+    from src.wateraccounting.Collect.planner import Planner
+
+
+class Archive(object):
+    """This Archive class
+
+    Thread-safe reader of the subsets of a collected archive.
+
+    Args:
+      root (str): Archive directory, the ``Dir`` of the products.
+      size (int): Maximum number of open file handles,
+        default the size of the ``GIS`` cache.
+    """
+    __conf = {
+        'folders': {
+            ('CHIRPS', 'Precipitation', 'v2', 'daily'):
+                ['Precipitation', 'CHIRPS', 'Daily'],
+            ('CHIRPS', 'Precipitation', 'v2', 'monthly'):
+                ['Precipitation', 'CHIRPS', 'Monthly'],
+            ('ALEXI', 'Evaporation', 'v1', 'daily'):
+                ['Evaporation', 'ALEXI', 'Daily'],
+            ('ALEXI', 'Evaporation', 'v1', 'weekly'):
+                ['Evaporation', 'ALEXI', 'Weekly'],
+            ('CMRSET', 'Evaporation', 'v1', 'monthly'):
+                ['Evaporation', 'CMRSET', 'Monthly'],
+            ('CFSR', 'Radiation', 'v1', 'daily'):
+                ['Radiation', 'CFSR'],
+            ('CFSR', 'Radiation', 'v2', 'daily'):
+                ['Radiation', 'CFSRv2'],
+            ('ASCAT', 'SoilWaterIndex', 'v3', 'daily'):
+                ['SWI', 'ASCAT', 'Daily']
+        },
+        'nodata': -9999.,
+        'chunk': 64 * 1024,
+        # Maximum number of dates of a query
+        'dates': 3660
+    }
+
+    def __init__(self, root, size=None):
+        """Class instantiation
+        """
+        self.root = str(root)
+        self.gis = GIS(self.root, is_status=False)
+        if size is not None:
+            GIS.set_tif_cache(size)
+
+    def get_key(self, product, datatype, version=None):
+        """Get product key
+
+        Args:
+          product (str): Product name, 'CHIRPS'.
+          datatype (str): Data type, 'daily'.
+          version (str): Version name, 'v2', default the only
+            or the last version.
+
+        Returns:
+          tuple: (product, dataset, version, datatype).
+
+        Raises:
+          KeyError: Product not in the archive.
+        """
+        keys = sorted(key for key in self.__conf['folders']
+                      if key[0] == product and key[3] == datatype and
+                      version in (None, key[2]))
+        if not keys:
+            raise KeyError('Product "{p}" "{t}" not found in the archive.'
+                           .format(p=product, t=datatype))
+        return keys[-1]
+
+    def get_folder(self, key):
+        """Get folder of a product
+
+        Returns:
+          str: Folder of the local files.
+        """
+        return os.path.join(self.root, *self.__conf['folders'][tuple(key)])
+
+    def get_products(self):
+        """Get products in the archive
+
+        Returns:
+          list: [{'product', 'dataset', 'version', 'datatype', 'folder'}, ...],
+          the products with a folder.
+        """
+        products = []
+        for key in self.__conf['folders']:
+            folder = self.get_folder(key)
+            if os.path.isdir(folder):
+                products.append(dict(zip(('product', 'dataset', 'version',
+                                          'datatype'), key), folder=folder))
+        return products
+
+    def get_files(self, key, variable=None, Startdate=None, Enddate=None):
+        """Get local files of a query
+
+        Args:
+          key (tuple): (product, dataset, version, datatype).
+          variable (str): Variable name, default the first variable.
+          Startdate (str): 'yyyy-mm-dd', default the first date of the product.
+          Enddate (str): 'yyyy-mm-dd', default the last date of the product.
+
+        Returns:
+          list: [(Date, file), ...], the dates with a local file.
+        """
+        planner = Planner(*key, variables=None if variable is None else [variable],
+                          Startdate=Startdate, Enddate=Enddate,
+                          folder=self.get_folder(key))
+        variable = planner.variables[0]
+        return [(task['Date'], task['local']) for task in planner.get_tasks()
+                if task['variable'] == variable and task['exists']]
+
+    def clear(self):
+        """Close the handles of the archive files
+        """
+        self.gis.close_tif(self.root)
+
+    def check(self, files, latlim=None, lonlim=None):
+        """Check files of a query, before any window is read
+
+        Args:
+          files (list): [(Date, file), ...], of ``get_files``.
+          latlim (list): [ymin, ymax], default the file extent.
+          lonlim (list): [xmin, xmax], default the file extent.
+
+        Raises:
+          ValueError: More dates than the limit, or windows of different shape
+            or geo, the query is to be split.
+        """
+        if len(files) > self.__conf['dates']:
+            raise ValueError('{n} dates, more than {m}, split the query.'
+                             .format(n=len(files), m=self.__conf['dates']))
+
+        first = None
+        for date, file in files:
+            yID, xID, geo = self.get_window(file, latlim, lonlim)
+            window = (yID[1] - yID[0], xID[1] - xID[0], tuple(geo))
+            if first is None:
+                first = window
+            elif window != first:
+                raise ValueError('Window of {d} differs in shape, split the '
+                                 'query at {d}.'
+                                 .format(d=date.strftime('%Y-%m-%d')))
+
+    def get_window(self, file, latlim=None, lonlim=None):
+        """Get window of a file, from its metadata
+
+        Args:
+          file (str): Local file.
+          latlim (list): [ymin, ymax], default the file extent.
+          lonlim (list): [xmin, xmax], default the file extent.
+
+        Returns:
+          tuple: (yID, xID, geo), rows and columns of the window, and its geo.
+        """
+        f, lock = self.gis.open_tif(file)
+        with lock:
+            return self._get_window(f, latlim, lonlim)
+
+    @staticmethod
+    def _get_window(f, latlim, lonlim):
+        """Window of an open file, read it under its lock
+        """
+        grid = Grid.from_geo(list(f.GetGeoTransform()),
+                             (f.RasterYSize, f.RasterXSize))
+        lat = [grid.lat['s'], grid.lat['n']] if latlim is None else latlim
+        lon = [grid.lon['w'], grid.lon['e']] if lonlim is None else lonlim
+        yID, xID = grid.window(lat, lon)
+        return yID, xID, grid.window_geo(yID, xID)
+
+    def read(self, file, latlim=None, lonlim=None):
+        """Read window of a file
+
+        Args:
+          file (str): Local file.
+          latlim (list): [ymin, ymax], default the file extent.
+          lonlim (list): [xmin, xmax], default the file extent.
+
+        Returns:
+          tuple: (data, geo), float32 window, nodata is ``nan``.
+        """
+        f, lock = self.gis.open_tif(file)
+        with lock:
+            yID, xID, geo = self._get_window(f, latlim, lonlim)
+
+            band = f.GetRasterBand(1)
+            data = band.ReadAsArray(xID[0], yID[0],
+                                    xID[1] - xID[0], yID[1] - yID[0])
+            nodata = band.GetNoDataValue()
+
+            # encoded integers are decoded, with nodata as -9999
+            data = self.gis.decode(data, band.GetScale(), band.GetOffset(), nodata)
+
+        data = np.asarray(data, dtype=np.float32)
+        data[data == self.__conf['nodata']] = np.nan
+        if nodata is not None:
+            data[data == nodata] = np.nan
+        return data, geo
+
+    def subset(self, key, variable=None, latlim=None, lonlim=None,
+               Startdate=None, Enddate=None):
+        """Subset of a query
+
+        The files are checked, then read one window at a time.
+
+        Args:
+          Arguments of ``get_files`` and ``read``.
+
+        Yields:
+          tuple: (Date, data, geo), one window per date.
+        """
+        files = self.get_files(key, variable, Startdate, Enddate)
+        self.check(files, latlim, lonlim)
+        for date, file in files:
+            data, geo = self.read(file, latlim, lonlim)
+            yield date, data, geo
+
+    def to_tif(self, windows, count=None):
+        """Stream subset as GeoTIFF
+
+        The GeoTIFF is written in ``/vsimem/``, one band per date, band by band,
+        the band description is the date.
+
+        Args:
+          windows (iterable): (Date, data, geo) of the same shape and geo,
+            of ``subset``.
+          count (int): Number of windows, default ``len(windows)``.
+
+        Yields:
+          bytes: Chunks of the GeoTIFF.
+
+        Raises:
+          ValueError: Windows of different shape or geo.
+        """
+        if count is None:
+            windows = list(windows)
+            count = len(windows)
+        windows = iter(windows)
+        first = next(windows)
+        date, data, geo = first
+        shape = data.shape
+        name = '/vsimem/wa_subset_{}.tif'.format(uuid.uuid4().hex)
+
+        driver = gdal.GetDriverByName("GTiff")
+        dst_ds = driver.Create(name, int(shape[1]), int(shape[0]), int(count),
+                               gdal.GDT_Float32, ['COMPRESS=LZW'])
+        dst_ds.SetProjection(GIS._get_srs())
+        dst_ds.SetGeoTransform(geo)
+        try:
+            for i, (date, data, geo_i) in enumerate(
+                    itertools.chain([first], windows)):
+                if data.shape != shape or list(geo_i) != list(geo):
+                    raise ValueError('Window of {d} differs in shape.'
+                                     .format(d=date.strftime('%Y-%m-%d')))
+                self._write_band(dst_ds.GetRasterBand(i + 1), date, data)
+        except BaseException:
+            dst_ds = None
+            gdal.Unlink(name)
+            raise
+        dst_ds = None
+
+        fp = gdal.VSIFOpenL(name, 'rb')
+        try:
+            while True:
+                chunk = gdal.VSIFReadL(1, self.__conf['chunk'], fp)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            gdal.VSIFCloseL(fp)
+            gdal.Unlink(name)
+
+    def _write_band(self, dst_band, date, data):
+        """Write a window as a band of the GeoTIFF
+        """
+        dst_band.SetNoDataValue(self.__conf['nodata'])
+        dst_band.SetDescription(date.strftime('%Y-%m-%d'))
+        dst_band.WriteArray(np.where(np.isnan(data), self.__conf['nodata'], data))
+
+    def to_netcdf(self, windows, variable='data'):
+        """Stream subset as NetCDF
+
+        The NetCDF is written in memory, with time, lat and lon dimensions,
+        one date at a time.
+
+        Args:
+          windows (iterable): (Date, data, geo) of the same shape and geo,
+            of ``subset``.
+          variable (str): Variable name.
+
+        Yields:
+          bytes: Chunks of the NetCDF.
+
+        Raises:
+          ValueError: Windows of different shape or geo.
+        """
+        from netCDF4 import Dataset
+
+        windows = iter(windows)
+        first = next(windows)
+        date, data, geo = first
+        shape = data.shape
+        grid = Grid.from_geo(geo, shape)
+        lat, lon = grid.to_latlon(np.arange(shape[0]), np.arange(shape[1]))
+
+        fh = Dataset('wa_subset.nc', mode='w', memory=self.__conf['chunk'],
+                     format='NETCDF4')
+        fh.createDimension('time', None)
+        fh.createDimension('lat', shape[0])
+        fh.createDimension('lon', shape[1])
+
+        time = fh.createVariable('time', 'f8', ('time',))
+        time.units = 'days since 1900-01-01'
+        time.calendar = 'standard'
+        var = fh.createVariable('lat', 'f8', ('lat',))
+        var.units = 'degrees_north'
+        var[:] = lat
+        var = fh.createVariable('lon', 'f8', ('lon',))
+        var.units = 'degrees_east'
+        var[:] = lon
+
+        var = fh.createVariable(variable, 'f4', ('time', 'lat', 'lon'),
+                                zlib=True, fill_value=self.__conf['nodata'])
+        try:
+            for i, (date, data, geo_i) in enumerate(
+                    itertools.chain([first], windows)):
+                if data.shape != shape or list(geo_i) != list(geo):
+                    raise ValueError('Window of {d} differs in shape.'
+                                     .format(d=date.strftime('%Y-%m-%d')))
+                time[i] = (date - pd.Timestamp('1900-01-01')).days
+                var[i, :, :] = np.ma.masked_invalid(data)
+        finally:
+            buf = fh.close()
+
+        for start in range(0, len(buf), self.__conf['chunk']):
+            yield bytes(buf[start:start + self.__conf['chunk']])
+
+
+class SubsetHandler(BaseHTTPRequestHandler):
+    """HTTP GET of the products and the subsets of the archive
+    """
+    __conf = {
+        'formats': {
+            'tif': 'image/tiff',
+            'nc': 'application/x-netcdf'
+        }
+    }
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+        if url.path == '/products':
+            self.send_json(self.server.archive.get_products())
+        elif url.path == '/subset':
+            self.send_subset(query)
+        else:
+            self.send_error(404, 'Not Found')
+
+    def send_json(self, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_subset(self, query):
+        """Send subset, streamed until the connection closes
+
+        Query: product, datatype, version, variable, latlim 's,n',
+        lonlim 'w,e', Startdate, Enddate and format 'tif' or 'nc'.
+        A query of more dates than the limit, or of windows which differ in
+        shape, is a 400 error.
+        """
+        archive = self.server.archive
+        fmt = query.get('format', 'tif')
+        try:
+            if fmt not in self.__conf['formats']:
+                raise ValueError('Unknown format: {v}'.format(v=fmt))
+            key = archive.get_key(query['product'], query.get('datatype', 'daily'),
+                                  query.get('version'))
+            latlim = [float(v) for v in query['latlim'].split(',')] \
+                if 'latlim' in query else None
+            lonlim = [float(v) for v in query['lonlim'].split(',')] \
+                if 'lonlim' in query else None
+            files = archive.get_files(key, query.get('variable'),
+                                      query.get('Startdate'), query.get('Enddate'))
+            archive.check(files, latlim, lonlim)
+        except (KeyError, ValueError) as err:
+            self.send_error(400, str(err).strip('"\''))
+            return
+        if not files:
+            self.send_error(404, 'No files found.')
+            return
+
+        # One window at a time, checked above
+        windows = ((date,) + archive.read(file, latlim, lonlim)
+                   for date, file in files)
+        if fmt == 'nc':
+            chunks = archive.to_netcdf(windows, query.get('variable') or 'data')
+        else:
+            chunks = archive.to_tif(windows, len(files))
+
+        self.send_response(200)
+        self.send_header('Content-Type', self.__conf['formats'][fmt])
+        self.send_header('Content-Disposition',
+                         'attachment; filename="{p}_{t}.{f}"'.format(
+                             p=key[0], t=key[3], f=fmt))
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(chunk)
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        return
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SubsetServer(object):
+    """This SubsetServer class
+
+    Subset server of an archive, in a thread.
+
+    Args:
+      root (str): Archive directory, the ``Dir`` of the products.
+      host (str): Host address.
+      port (int): Port, 0 is a free port.
+      size (int): Maximum number of open file handles.
+    """
+
+    def __init__(self, root, host='127.0.0.1', port=0, size=None):
+        """Class instantiation
+        """
+        self.server = ThreadingHTTPServer((host, port), SubsetHandler)
+        self.server.archive = Archive(root, size)
+        self.__thread = None
+
+    @property
+    def archive(self):
+        return self.server.archive
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return 'http://{h}:{p}'.format(h=host, p=port)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.server.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def serve_forever(self):
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.__thread.join()
+        self.archive.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def main():
+    from pprint import pprint
+
+    # Archive __init__
+    print('\nArchive\n=====')
+    archive = Archive(os.getcwd())
+
+    # Archive methods
+    print('\narchive.get_key()\n=====')
+    pprint(archive.get_key('CHIRPS', 'daily'))
+
+    print('\narchive.get_products()\n=====')
+    pprint(archive.get_products())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+**Sync**
+
+`Restrictions`
+
+The data and this python file may not be distributed to others without
+permission of the WA+ team.
+
+`Description`
+
+Incremental sync of the near-real-time products, fetch only the newly
+published dates.
+
+A high-water mark is kept per product, variable and region, the last date
+up to which all outputs exist. A sync plans the dates after the mark with
+``Planner``, and lists the remote directories of these dates, one FTP
+``NLST`` or HTTP index per directory, to find the published files.
+The listings are cached, a directory is only listed again when a wanted file
+is not in its listing and the listing is older than ``ttl``.
+After the run, the mark moves to the last date with all outputs,
+a failed date stops the mark and is retried by the next sync.
+
+The marks and listings are saved in a JSON state file, set by an argument or
+the ``WA_SYNC`` environment variable.
+
+**Examples:**
+::
+
+    from wateraccounting.Collect.sync import Sync
+    sync = Sync('wa_sync.json')
+    planner = sync.get_planner('CHIRPS', 'Precipitation', 'v2', 'daily', None,
+                               [-10, 30], [-20, -10], '2019-01-01',
+                               folder='C:/Temp/Precipitation/CHIRPS/Daily')
+    tasks = sync.discover(planner)
+    sync.update(planner)
+    sync.save()
+"""
+import os
+# import sys
+# import inspect
+# import shutil
+# import yaml
+
+import re
+import json
+import time
+import ftplib
+import tempfile
+import posixpath
+import threading
+import urllib.request
+from urllib.parse import urlparse, unquote
+
+import pandas as pd
+
+try:
+    from .planner import Planner
+except ImportError:
+    from src.wateraccounting.Collect.planner import Planner
+
+try:
+    from .download import Download
+except ImportError:
+    from src.wateraccounting.Collect.download import Download
+
+
+class Sync(object):
+    """This Sync class
+
+    Args:
+      file (str): JSON state file, default ``WA_SYNC``,
+        None keeps the state in memory.
+      ttl (float): Seconds a directory listing is reused
+        for files not in the listing.
+    """
+    __conf = {
+        'env': 'WA_SYNC',
+        'ttl': 3600.,
+        'timeout': 30.,
+        'href': re.compile(r'href="([^"?#]+)"', re.IGNORECASE)
+    }
+
+    def __init__(self, file=None, ttl=None):
+        """Class instantiation
+        """
+        self.file = file if file is not None else os.environ.get(self.__conf['env'])
+        self.ttl = self.__conf['ttl'] if ttl is None else float(ttl)
+
+        self.state = {'marks': {}, 'listings': {}}
+        if self.file and os.path.exists(self.file):
+            with open(self.file) as fp:
+                self.state.update(json.load(fp))
+
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def get_key(planner):
+        """High-water mark key of a plan, product, variables and region
+
+        Returns:
+          str: 'CHIRPS.Precipitation.v2.daily:P:<yID>:<xID>:<folder>'.
+        """
+        windows = [planner.windows[variable] for variable in planner.variables]
+        return ':'.join(['.'.join(planner.key), ','.join(planner.variables),
+                         json.dumps(windows), os.path.abspath(planner.folder)])
+
+    def get_mark(self, key):
+        """Get high-water mark
+
+        Returns:
+          :obj:`pandas.Timestamp`: Last date with all outputs, None before
+          the first sync.
+        """
+        with self.__lock:
+            mark = self.state['marks'].get(key)
+        return None if mark is None else pd.Timestamp(mark)
+
+    def set_mark(self, key, date):
+        """Set high-water mark
+        """
+        with self.__lock:
+            self.state['marks'][key] = pd.Timestamp(date).isoformat()
+
+    def get_planner(self, product, dataset, version, datatype, variables=None,
+                    latlim=None, lonlim=None, Startdate=None, folder='',
+                    history=None):
+        """Planner of the dates after the high-water mark, up to today
+
+        Args:
+          Startdate (str): 'yyyy-mm-dd', first date of the first sync,
+            default the first date of the product.
+          Other arguments of ``Planner``.
+
+        Returns:
+          :obj:`Planner`: Planner, None when there are no dates after the mark.
+        """
+        planner = Planner(product, dataset, version, datatype, variables,
+                          latlim, lonlim, Startdate, None, folder, history)
+        mark = self.get_mark(self.get_key(planner))
+        if mark is None or mark < planner.Startdate:
+            return planner
+
+        Startdate = pd.date_range(mark, periods=2, freq=planner.conf['freq'])[1]
+        if Startdate > planner.Enddate:
+            return None
+        return Planner(product, dataset, version, datatype, variables,
+                       latlim, lonlim, Startdate, None, folder, history)
+
+    def list_dir(self, url, path, names=()):
+        """List remote directory, from the cached listing
+
+        Args:
+          url (str): Server url, 'ftp://chg-ftpout.geog.ucsb.edu'.
+          path (str): Directory.
+          names (iterable): Wanted file names, the cached listing is used
+            when it has all of them, or when it is younger than ``ttl``.
+
+        Returns:
+          set: File names, empty when the directory does not exist.
+        """
+        key = url + path
+        with self.__lock:
+            cached = self.state['listings'].get(key)
+        if cached is not None:
+            listing = set(cached['names'])
+            if set(names) <= listing or time.time() - cached['time'] < self.ttl:
+                return listing
+
+        parts = urlparse(url)
+        if parts.scheme == 'ftp':
+            ftp = ftplib.FTP()
+            ftp.connect(parts.hostname, parts.port or 21,
+                        timeout=self.__conf['timeout'])
+            ftp.login()
+            try:
+                listing = set(posixpath.basename(name.rstrip('/'))
+                              for name in ftp.nlst(path))
+            except ftplib.error_perm:
+                listing = set()
+            ftp.quit()
+        else:
+            try:
+                with urllib.request.urlopen(url + path,
+                                            timeout=self.__conf['timeout']) as fp:
+                    html = fp.read().decode('utf-8', 'replace')
+                listing = set(posixpath.basename(unquote(name).rstrip('/'))
+                              for name in self.__conf['href'].findall(html))
+            except OSError:
+                listing = set()
+
+        with self.__lock:
+            self.state['listings'][key] = {'time': time.time(),
+                                           'names': sorted(listing)}
+        return listing
+
+    def discover(self, planner):
+        """Discover newly published files of a plan
+
+        Args:
+          planner (:obj:`Planner`): Planner, of ``get_planner``.
+
+        Returns:
+          list: Tasks of ``Planner.get_tasks``, published and without output.
+        """
+        tasks = [task for task in planner.get_tasks() if not task['exists']]
+        url = Download.get_url(*planner.key)
+
+        # One listing per directory
+        dirs = {}
+        for task in tasks:
+            path, name = posixpath.split(task['remote'])
+            dirs.setdefault(path + '/', set()).add(name)
+        listings = {path: self.list_dir(url, path, names)
+                    for path, names in dirs.items()}
+
+        return [task for task in tasks
+                if posixpath.basename(task['remote']) in listings[
+                    posixpath.dirname(task['remote']) + '/']]
+
+    def update(self, planner):
+        """Move the high-water mark to the last date with all outputs
+
+        Args:
+          planner (:obj:`Planner`): Planner, of ``get_planner``.
+
+        Returns:
+          :obj:`pandas.Timestamp`: High-water mark.
+        """
+        key = self.get_key(planner)
+        exists = {}
+        for task in planner.get_tasks():
+            exists[task['Date']] = exists.get(task['Date'], True) and task['exists']
+
+        mark = None
+        for date in sorted(exists):
+            if not exists[date]:
+                break
+            mark = date
+        if mark is not None:
+            self.set_mark(key, mark)
+        return self.get_mark(key)
+
+    def save(self):
+        """Save state, replaced atomically
+
+        Returns:
+          str: State file, None when the state is in memory.
+        """
+        if not self.file:
+            return None
+
+        with self.__lock:
+            text = json.dumps(self.state, sort_keys=True)
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp',
+                                   dir=os.path.dirname(os.path.abspath(self.file)))
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(text)
+        os.replace(tmp, self.file)
+        return self.file
+
+
+def main():
+    from pprint import pprint
+
+    # Sync __init__
+    print('\nSync\n=====')
+    sync = Sync()
+
+    # Sync methods
+    print('\nsync.get_planner()\n=====')
+    planner = sync.get_planner('CHIRPS', 'Precipitation', 'v2', 'daily', None,
+                               [-10, 30], [-20, -10], '2019-01-01')
+    pprint((planner.Startdate, planner.Enddate))
+    pprint(sync.get_key(planner))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+**Trace**
+
+`Restrictions`
+
+The data and this python file may not be distributed to others without
+permission of the WA+ team.
+
+`Description`
+
+Span tracing of the product downloads, saved as Chrome trace-event JSON,
+to open in `Perfetto <https://ui.perfetto.dev>`_ or ``chrome://tracing``.
+
+Each task of a ``Pipeline`` stage or of ``Download.map`` is a span on the
+lane of its worker thread or process, with the product, labels, date and
+stage in its args. The steps timed by ``Metrics.timer`` are nested spans,
+also in the process workers, which send their spans back with the result.
+Gaps in a lane are workers waiting on a queue, 'wait' spans are workers
+waiting on a lock.
+
+Tracing is enabled by a file, an argument or the ``WA_TRACE`` environment
+variable. When disabled, a span is one dictionary lookup.
+
+**Examples:**
+::
+
+    from wateraccounting.Collect.trace import Trace
+    trace = Trace('CHIRPS', {'datatype': 'daily'}, file='chirps.json').start()
+    with Trace.span('download', date='2003-01-01'):
+        pass
+    trace.stop()
+"""
+import os
+# import sys
+# import inspect
+# import shutil
+# import yaml
+
+import json
+import time
+import asyncio
+import functools
+import threading
+from contextlib import contextmanager
+
+
+class Trace(object):
+    """This Trace class
+
+    Trace of a run, one trace is active per process.
+
+    Args:
+      product (str): Product name, 'CHIRPS'.
+      labels (dict): Other labels, {'variable': 'dlwsfc'}.
+      file (str): Trace file, or a directory to write
+        'wa_trace_<product>_<labels>_<time>.json' in, default ``WA_TRACE``.
+    """
+    __conf = {
+        'env': 'WA_TRACE',
+        'prefix': 'wa_trace'
+    }
+    # Active trace of this process, None is disabled
+    __active = {'trace': None}
+
+    def __init__(self, product='', labels=None, file=None):
+        """Class instantiation
+        """
+        self.product = product
+        self.labels = dict(labels) if labels is not None else {}
+        self.file = file if file is not None else os.environ.get(self.__conf['env'])
+
+        self.events = []
+        self.threads = {}
+        self.__lock = threading.Lock()
+
+    @property
+    def is_enabled(self):
+        return bool(self.file)
+
+    @classmethod
+    def get_active(cls):
+        """Get active trace
+
+        Returns:
+          :obj:`Trace`: Active trace, None when tracing is disabled.
+        """
+        return cls.__active['trace']
+
+    def start(self):
+        """Start trace, when enabled
+
+        Returns:
+          :obj:`Trace`: self.
+        """
+        if self.is_enabled:
+            self.__active['trace'] = self
+        return self
+
+    def stop(self):
+        """Stop and save trace
+
+        Returns:
+          str: Trace file, None when disabled.
+        """
+        if self.__active['trace'] is self:
+            self.__active['trace'] = None
+        if self.is_enabled:
+            return self.save(self.file)
+        return None
+
+    @classmethod
+    @contextmanager
+    def _span(cls, trace, name, args):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            trace.add_span(name, t0, time.time(), args)
+
+    @classmethod
+    def span(cls, name, item=None, **args):
+        """Span of the active trace
+
+        Args:
+          name (str): Span name, the stage.
+          item (dict): Task, its 'Date' and 'file' are added to the args.
+          args (dict): Other args of the span.
+
+        Returns:
+          Context manager.
+        """
+        trace = cls.__active['trace']
+        if trace is None:
+            return _null
+        return cls._span(trace, name, dict(cls.get_args(item), **args))
+
+    @classmethod
+    def record(cls, name, t0, t1, item=None):
+        """Add span to the active trace, when enabled
+
+        Args:
+          name (str): Span name.
+          t0 (float): Start time, ``time.time()``.
+          t1 (float): End time, ``time.time()``.
+          item (dict): Task, its 'Date' and 'file' are added to the args.
+        """
+        trace = cls.__active['trace']
+        if trace is not None:
+            trace.add_span(name, t0, t1, cls.get_args(item))
+
+    @staticmethod
+    def get_args(item):
+        """Span args of a task
+
+        Returns:
+          dict: {'date', 'file'}, of the keys in the task.
+        """
+        args = {}
+        if isinstance(item, dict):
+            if item.get('Date') is not None:
+                date = item['Date']
+                args['date'] = date.isoformat() if hasattr(date, 'isoformat') \
+                    else str(date)
+            if item.get('file') is not None:
+                args['file'] = item['file']
+        elif item is not None and hasattr(item, 'isoformat'):
+            args['date'] = item.isoformat()
+        return args
+
+    @staticmethod
+    def get_name(func):
+        """Span name of a function, also of a partial function
+        """
+        func = getattr(func, 'func', func)
+        return getattr(func, '__name__', 'call')
+
+    @classmethod
+    def wrap(cls, func):
+        """Wrap function of one item in a span, for threads and the event loop
+
+        Args:
+          func (function): Function or coroutine function of one item.
+
+        Returns:
+          function: Function of the same kind.
+        """
+        name = cls.get_name(func)
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(item):
+                with cls.span(name, item):
+                    return await func(item)
+        else:
+            @functools.wraps(func)
+            def wrapper(item):
+                with cls.span(name, item):
+                    return func(item)
+
+        return wrapper
+
+    def add_span(self, name, t0, t1, args=None):
+        """Add span of the calling thread
+        """
+        pid, thread = os.getpid(), threading.current_thread()
+        self.add([{
+            'name': name,
+            'ph': 'X',
+            'ts': t0 * 1.0e6,
+            'dur': (t1 - t0) * 1.0e6,
+            'pid': pid,
+            'tid': thread.ident,
+            'args': dict(args) if args else {}
+        }], {(pid, thread.ident): thread.name})
+
+    def add(self, events, threads=None):
+        """Add events, of this process or of a worker process
+
+        Args:
+          events (list): Trace events.
+          threads (dict): Thread names, {(pid, tid): name}.
+        """
+        labels = dict(self.labels, product=self.product)
+        with self.__lock:
+            for event in events:
+                event['cat'] = self.product
+                event['args'].update(labels)
+                self.events.append(event)
+            if threads:
+                self.threads.update(threads)
+
+    def to_json(self):
+        """Chrome trace-event JSON
+
+        Returns:
+          dict: {'traceEvents': [...], 'displayTimeUnit': 'ms', 'otherData': {}}.
+        """
+        with self.__lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+
+        pids = sorted(set(pid for pid, tid in threads))
+        meta = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                 'args': {'name': 'main' if pid == os.getpid() else 'worker'}}
+                for pid in pids]
+        meta += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                  'args': {'name': name}}
+                 for (pid, tid), name in sorted(threads.items())]
+
+        return {
+            'traceEvents': meta + sorted(events, key=lambda event: event['ts']),
+            'displayTimeUnit': 'ms',
+            'otherData': dict(self.labels, product=self.product)
+        }
+
+    def save(self, file):
+        """Save trace
+
+        Args:
+          file (str): Trace file, or directory.
+
+        Returns:
+          str: Trace file.
+        """
+        if os.path.isdir(file):
+            name = '_'.join([self.__conf['prefix'], self.product] +
+                            [str(self.labels[key]) for key in sorted(self.labels)] +
+                            [time.strftime('%Y%m%d%H%M%S')])
+            file = os.path.join(file, '{}.json'.format(
+                ''.join(c if c.isalnum() else '_' for c in name)))
+
+        with open(file, 'w') as fp:
+            json.dump(self.to_json(), fp, default=str)
+        return file
+
+    @classmethod
+    def call(cls, func, item):
+        """Call function in a worker process, with tracing
+
+        The spans of the call are sent back with the result,
+        add them to the trace of the calling process with ``add``.
+
+        Args:
+          func (function): Module level function of one item.
+          item (object): Item.
+
+        Returns:
+          tuple: (result, events, threads).
+        """
+        trace = Trace(file='')
+        cls.__active['trace'] = trace
+        try:
+            with cls.span(cls.get_name(func), item):
+                result = func(item)
+        finally:
+            cls.__active['trace'] = None
+        return result, trace.events, trace.threads
+
+
+class _Null(object):
+    """Reusable no-op context manager of disabled spans
+    """
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        return False
+
+
+_null = _Null()
+
+
+def main():
+    from pprint import pprint
+
+    # Trace __init__
+    print('\nTrace\n=====')
+    trace = Trace('CHIRPS', {'datatype': 'daily'}, file=os.devnull).start()
+    for i in range(3):
+        with Trace.span('download', date='2003-01-0{}'.format(i + 1)):
+            time.sleep(0.01)
+
+    # Trace methods
+    print('\ntrace.to_json()\n=====')
+    pprint(trace.to_json())
+    trace.stop()
+
+
+if __name__ == "__main__":
+    main()
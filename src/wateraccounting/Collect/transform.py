@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+**Transform**
+
+`Restrictions`
+
+The data and this python file may not be distributed to others without
+permission of the WA+ team.
+
+`Description`
+
+Decode steps of a product variable, declared by the ``transform`` list of
+the variable in ``base.yml``, and compiled into one chain of in-place numpy
+operations, applied to each decoded block.
+
+Layout steps, ``flipud`` and ``lon180``, come first and act on the whole
+block, then the block is clipped to the window, then the value steps,
+``scale``, ``offset``, ``unit`` and ``nodata``, work in place on the window.
+An integer or read-only window is copied once to float32.
+
+**Examples:**
+::
+
+    from wateraccounting.Collect.transform import Transform
+    transform = Transform.from_conf('ALEXI', 'Evaporation', 'v1', 'daily', 'ETa')
+    data = transform(raw, yID, xID)
+"""
+# import os
+# import sys
+# import inspect
+# import shutil
+# import yaml
+
+import numpy as np
+
+try:
+    from .base import Base
+except ImportError:
+    from src.wateraccounting.Collect.base import Base
+
+
+class Transform(object):
+    """This Transform class
+
+    Chain of decode steps, in the order of ``base.yml``::
+
+        transform:
+          - flipud                  # rows to north-up
+          - lon180                  # longitude from 0 - 360 to -180 - 180
+          - scale: 0.5              # data * 0.5
+          - offset: -273.15         # data + -273.15
+          - unit                    # data / unit.m, unit.f to unit.t
+          - nodata: {below: 0.0}    # data < 0 is -9999, also above and equal
+
+    Args:
+      steps (list): Steps, a name or a {name: argument} dict.
+      unit (dict): {'f': from unit, 't': to unit, 'm': divisor}, of ``unit``.
+    """
+    __conf = {
+        'nodata': -9999.,
+        'layout': ('flipud', 'lon180'),
+        'values': ('scale', 'offset', 'unit', 'nodata'),
+        'nodata_ops': {
+            'below': np.less,
+            'above': np.greater,
+            'equal': np.equal
+        },
+        'chains': {}
+    }
+
+    def __init__(self, steps=(), unit=None):
+        """Class instantiation
+        """
+        self.steps = []
+        self.__layout = []
+        self.__values = []
+        self.__is_mask = False
+
+        for step in steps:
+            name, arg = self._parse(step)
+            if name in self.__conf['layout']:
+                if self.__values:
+                    raise ValueError('Layout step "{s}" after a value step.'
+                                     .format(s=name))
+                self.__layout.append(getattr(self, '_' + name))
+            else:
+                func = self._compile(name, arg, unit)
+                if func is None:
+                    continue
+                self.__values.append(func)
+                self.__is_mask |= name == 'nodata'
+            self.steps.append((name, arg))
+
+    def __repr__(self):
+        return 'Transform(steps={s})'.format(s=self.steps)
+
+    def __call__(self, data, yID=None, xID=None):
+        """Apply the chain
+
+        Args:
+          data (:obj:`numpy.ndarray`): Decoded block.
+          yID (tuple): Rows of the window, default the whole block.
+          xID (tuple): Columns of the window, default the whole block.
+
+        Returns:
+          :obj:`numpy.ndarray`: Window, -9999 as nodata, a view of the block
+          changed in place, when the block is writable float.
+
+        :Example:
+
+            >>> import numpy as np
+            >>> from wateraccounting.Collect.transform import Transform
+            >>> transform = Transform(['flipud', {'scale': 0.5},
+            ...                        {'nodata': {'above': 100.}}])
+            >>> data = np.array([[0, 1], [100, 255]], dtype=np.uint8)
+            >>> transform(data).tolist()
+            [[50.0, -9999.0], [0.0, 0.5]]
+        """
+        data = np.asarray(data)
+        for func in self.__layout:
+            data = func(data)
+
+        if yID is not None:
+            data = data[yID[0]:yID[1], :]
+        if xID is not None:
+            data = data[:, xID[0]:xID[1]]
+
+        if self.__values:
+            if data.dtype.kind != 'f' or not data.flags.writeable:
+                data = data.astype(np.float32)
+            mask = np.empty(data.shape, dtype=bool) if self.__is_mask else None
+            for func in self.__values:
+                func(data, mask)
+
+        return data
+
+    @classmethod
+    def from_conf(cls, product, dataset, version, datatype, variable):
+        """Transform from configuration
+
+        This function compiles the ``transform`` and ``unit`` of a product
+        variable from ``base.yml``. Chains are cached.
+
+        Args:
+          product (str): Product name, 'ALEXI'.
+          dataset (str): Dataset name, 'Evaporation'.
+          version (str): Version name, 'v1'.
+          datatype (str): Data type, 'daily'.
+          variable (str): Variable name, 'ETa'.
+
+        Returns:
+          :obj:`Transform`: Chain of the variable, empty without ``transform``.
+
+        :Example:
+
+            >>> from wateraccounting.Collect.transform import Transform
+            >>> Transform.from_conf('CHIRPS', 'Precipitation', 'v2', 'daily', 'P')
+            Transform(steps=[('nodata', {'below': 0.0})])
+        """
+        key = (product, dataset, version, datatype, variable)
+
+        if key not in cls.__conf['chains']:
+            conf = Base.check_conf('data', is_status=False)
+            try:
+                var = conf['products'][product]['data'][dataset][version][
+                    datatype]['variables'][variable]
+                chain = cls(var.get('transform') or [], var.get('unit'))
+            except (KeyError, TypeError, AttributeError):
+                raise KeyError('Transform "{k}" not found in "{f}".'
+                               .format(k='.'.join(key), f='base.yml'))
+            cls.__conf['chains'][key] = chain
+
+        return cls.__conf['chains'][key]
+
+    @classmethod
+    def _parse(cls, step):
+        """Step to (name, argument)
+        """
+        if isinstance(step, dict) and len(step) == 1:
+            name, arg = list(step.items())[0]
+        else:
+            name, arg = step, None
+
+        if name not in cls.__conf['layout'] + cls.__conf['values']:
+            raise ValueError('Unknown transform step: {v}'.format(v=step))
+        return name, arg
+
+    @classmethod
+    def _compile(cls, name, arg, unit):
+        """Value step to an in-place function of (data, mask)
+
+        Returns:
+          function: None for a step without effect, a unit divisor of 1.
+        """
+        nodata = cls.__conf['nodata']
+
+        if name == 'scale':
+            value = float(arg)
+            return lambda data, mask: np.multiply(data, value, out=data)
+
+        if name == 'offset':
+            value = float(arg)
+            return lambda data, mask: np.add(data, value, out=data)
+
+        if name == 'unit':
+            if unit is None:
+                raise ValueError('Transform step "unit" without "unit.m".')
+            value = float(unit['m'])
+            if value == 1.:
+                return None
+            return lambda data, mask: np.divide(data, value, out=data)
+
+        # nodata, thresholds share the one mask buffer of the call
+        limits = [(cls.__conf['nodata_ops'][key], float(value))
+                  for key, value in sorted(arg.items())]
+
+        def func(data, mask):
+            for op, value in limits:
+                op(data, value, out=mask)
+                np.copyto(data, nodata, where=mask)
+        return func
+
+    @staticmethod
+    def _flipud(data):
+        """Rows to north-up, a view
+        """
+        return data[::-1]
+
+    @staticmethod
+    def _lon180(data):
+        """Longitude from 0 - 360 to -180 - 180
+
+        The halves are swapped in place, through a buffer of half the block.
+        """
+        half = data.shape[-1] // 2
+        if data.shape[-1] % 2 or not data.flags.writeable:
+            return np.roll(data, half, axis=-1)
+
+        buffer = data[..., half:].copy()
+        data[..., half:] = data[..., :half]
+        data[..., :half] = buffer
+        return data
+
+
+def main():
+    from pprint import pprint
+
+    # Transform from_conf
+    print('\nTransform\n=====')
+    transform = Transform.from_conf('ALEXI', 'Evaporation', 'v1', 'daily', 'ETa')
+    pprint(transform)
+
+    # Transform __call__
+    print('\ntransform()\n=====')
+    pprint(transform(np.arange(-2., 10.).reshape(3, 4) * 2.45, (0, 2), (1, 3)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+"""
+**Zonal**
+
+`Restrictions`
+
+The data and this python file may not be distributed to others without
+permission of the WA+ team.
+
+`Description`
+
+Zonal statistics of product outputs over basin polygons,
+the sum, mean and count of valid values of each zone, per date.
+
+The polygons are rasterized once per product grid, at the pixel centres,
+into a zone index of the window that covers all zones.
+Each date is then a windowed read and one ``np.bincount`` per statistic
+over the pixels of the zones, so thousands of zones cost about one pass.
+The time series are appended to one CSV file per statistic,
+dates already in the files are skipped.
+
+**Examples:**
+::
+
+    import glob
+    from wateraccounting.Collect.zonal import Zonal, Zones
+    zones = Zones.from_file('C:/Temp/basins.geojson', field='name')
+    zonal = Zonal('', is_status=True)
+    zonal.run(glob.glob('C:/Temp/Precipitation/CHIRPS/Daily/*.tif'), zones,
+              'C:/Temp/Precipitation/CHIRPS/Zonal')
+"""
+import os
+# import sys
+import inspect
+# import shutil
+# import yaml
+
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    from osgeo import ogr
+except ImportError:
+    import ogr
+
+try:
+    from .gis import GIS
+    from .aggregate import Aggregate
+except ImportError:
+    from src.wateraccounting.Collect.gis import GIS
+    from src.wateraccounting.Collect.aggregate import Aggregate
+
+
+class Zones(object):
+    """This Zones class
+
+    Polygons in WGS84, one zone each, rasterized once per grid.
+    A pixel is in a zone when its centre is inside the polygon, holes
+    excluded, a pixel of overlapping zones belongs to the last zone.
+
+    Args:
+      polygons (list): Rings of each zone, a ring is a list of (lon, lat).
+      names (list): Zone names, default '0', '1', ...
+    """
+    __conf = {
+        # Maximum number of cached grids
+        'size': 16
+    }
+
+    def __init__(self, polygons, names=None):
+        """Class instantiation
+        """
+        self.polygons = [[np.asarray(ring, dtype=np.float64)[:, :2] for ring in rings]
+                         for rings in polygons]
+        if names is None:
+            names = range(len(self.polygons))
+        self.names = [str(name) for name in names]
+        if len(self.names) != len(self.polygons):
+            raise ValueError('{n} names for {p} zones.'
+                             .format(n=len(self.names), p=len(self.polygons)))
+
+        self.__index = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Zones(names={n})'.format(n=self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_geojson(cls, geojson, field=None):
+        """Zones from GeoJSON
+
+        Polygon and MultiPolygon features are zones, other geometries are
+        skipped.
+
+        Args:
+          geojson (dict): FeatureCollection, Feature or geometry.
+          field (str): Property of the zone names, default the feature id,
+            or the order of the features.
+
+        Returns:
+          :obj:`Zones`: Zones.
+
+        :Example:
+
+            >>> from wateraccounting.Collect.zonal import Zones
+            >>> Zones.from_geojson({'type': 'Polygon',
+            ...                     'coordinates': [[[0, 0], [1, 0], [1, 1]]]})
+            Zones(names=['0'])
+        """
+        if geojson.get('type') == 'FeatureCollection':
+            features = geojson['features']
+        elif geojson.get('type') == 'Feature':
+            features = [geojson]
+        else:
+            features = [{'type': 'Feature', 'geometry': geojson}]
+
+        polygons = []
+        names = []
+        for i, feature in enumerate(features):
+            geometry = feature.get('geometry') or {}
+            if geometry.get('type') == 'Polygon':
+                rings = geometry['coordinates']
+            elif geometry.get('type') == 'MultiPolygon':
+                rings = [ring for polygon in geometry['coordinates']
+                         for ring in polygon]
+            else:
+                continue
+
+            polygons.append(rings)
+            if field is None:
+                names.append(feature.get('id', i))
+            else:
+                names.append((feature.get('properties') or {})[field])
+
+        return cls(polygons, names)
+
+    @classmethod
+    def from_file(cls, file, field=None):
+        """Zones from file
+
+        Args:
+          file (str): 'C:/file/to/path/basins.geojson', '.json' is read as
+            GeoJSON, other files, '.shp', with OGR.
+          field (str): Property of the zone names.
+
+        Returns:
+          :obj:`Zones`: Zones.
+        """
+        if os.path.splitext(file)[1].lower() in ('.geojson', '.json'):
+            with open(file) as fp:
+                return cls.from_geojson(json.load(fp), field)
+
+        ds = ogr.Open(file)
+        if ds is None:
+            raise IOError('{} not found.'.format(file))
+        features = [json.loads(feature.ExportToJson())
+                    for feature in ds.GetLayer(0)]
+        ds = None
+
+        return cls.from_geojson({'type': 'FeatureCollection', 'features': features},
+                                field)
+
+    def rasterize(self, geo, shape):
+        """Rasterize the zones on a grid
+
+        The zone index of a grid is computed once, and cached.
+
+        Args:
+          geo (list): Geospatial dataset of the grid, [minimum lon, pixelsize,
+            rotation, maximum lat, rotation, pixelsize].
+          shape (tuple): Shape of the grid, (rows, cols).
+
+        Returns:
+          dict: {'window': (xoff, yoff, xsize, ysize) around the zones,
+          'index': int32 zone of the window pixels, -1 outside the zones,
+          'pixels': flat positions in the window of the pixels in zones,
+          'zones': zone of these pixels}.
+
+        :Example:
+
+            >>> from wateraccounting.Collect.zonal import Zones
+            >>> zones = Zones([[[(1, 3), (3, 3), (3, 1), (1, 1)]]])
+            >>> index = zones.rasterize([0., 1., 0., 4., 0., -1.], (4, 4))
+            >>> index['window']
+            (1, 1, 2, 2)
+            >>> index['zones']
+            array([0, 0, 0, 0], dtype=int32)
+        """
+        key = (tuple(float(v) for v in geo), tuple(int(v) for v in shape))
+        with self.__lock:
+            if key in self.__index:
+                self.__index.move_to_end(key)
+                return self.__index[key]
+
+        masks = []
+        for i, rings in enumerate(self.polygons):
+            window, mask = self._rasterize(rings, geo, shape)
+            if mask is not None:
+                masks.append((i, window, mask))
+
+        # Window around all zones
+        if masks:
+            x0 = min(window[0] for i, window, mask in masks)
+            y0 = min(window[1] for i, window, mask in masks)
+            x1 = max(window[0] + window[2] for i, window, mask in masks)
+            y1 = max(window[1] + window[3] for i, window, mask in masks)
+        else:
+            x0, y0, x1, y1 = 0, 0, 0, 0
+
+        index = np.full((y1 - y0, x1 - x0), -1, dtype=np.int32)
+        for i, (xoff, yoff, xsize, ysize), mask in masks:
+            index[yoff - y0:yoff - y0 + ysize, xoff - x0:xoff - x0 + xsize][mask] = i
+
+        # Crop to the pixels in zones, crossings of empty spans widen the window
+        if index.size:
+            rows = np.flatnonzero((index >= 0).any(axis=1))
+            cols = np.flatnonzero((index >= 0).any(axis=0))
+            index = index[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+            x0, y0 = int(x0 + cols[0]), int(y0 + rows[0])
+            x1, y1 = x0 + index.shape[1], y0 + index.shape[0]
+        index = np.ascontiguousarray(index)
+
+        pixels = np.flatnonzero(index.ravel() >= 0)
+        result = {
+            'window': (x0, y0, x1 - x0, y1 - y0),
+            'index': index,
+            'pixels': pixels,
+            'zones': index.ravel()[pixels]
+        }
+
+        with self.__lock:
+            self.__index[key] = result
+            while len(self.__index) > self.__conf['size']:
+                self.__index.popitem(last=False)
+
+        return result
+
+    def clip(self, data, geo, nodata=-9999.):
+        """Clip to the zones
+
+        Pixels outside the zones are nodata, and the data is cropped to the
+        window around the zones. The mask is the zone index of the grid,
+        from ``rasterize``, so it is computed once for all dates.
+
+        Args:
+          data (:obj:`numpy.ndarray`): Data of the grid.
+          geo (list): Geospatial dataset of the grid, [minimum lon, pixelsize,
+            rotation, maximum lat, rotation, pixelsize].
+          nodata (float): Nodata value.
+
+        Returns:
+          tuple: (data, geo), a copy of the window, float, and its geo.
+
+        Raises:
+          ValueError: Zones outside the grid.
+
+        :Example:
+
+            >>> import numpy as np
+            >>> from wateraccounting.Collect.zonal import Zones
+            >>> zones = Zones([[[(1, 3), (3, 3), (1, 0.5)]]])
+            >>> data, geo = zones.clip(np.ones((4, 4)), [0., 1., 0., 4., 0., -1.])
+            >>> data.tolist()
+            [[1.0, 1.0], [1.0, -9999.0]]
+            >>> geo
+            [1.0, 1.0, 0.0, 3.0, 0.0, -1.0]
+        """
+        index = self.rasterize(geo, data.shape)
+        if not index['pixels'].size:
+            raise ValueError('Zones outside the grid "{g}".'.format(g=list(geo)))
+
+        xoff, yoff, xsize, ysize = index['window']
+        data = data[yoff:yoff + ysize, xoff:xoff + xsize]
+        data = np.array(data, dtype=data.dtype if data.dtype.kind == 'f'
+                        else np.float32)
+        data[index['index'] < 0] = nodata
+
+        geo = [float(geo[0] + xoff * geo[1] + yoff * geo[2]), float(geo[1]),
+               float(geo[2]), float(geo[3] + xoff * geo[4] + yoff * geo[5]),
+               float(geo[4]), float(geo[5])]
+
+        return data, geo
+
+    @staticmethod
+    def _rasterize(rings, geo, shape):
+        """Rasterize one polygon, even-odd rule at the pixel centres
+
+        The crossings of all edges with the rows are computed at once,
+        pixels between pairs of crossings of a row are inside.
+
+        Returns:
+          tuple: (window, mask), (xoff, yoff, xsize, ysize) and the bool mask
+          of the window, (None, None) outside the grid.
+        """
+        rows, cols = int(shape[0]), int(shape[1])
+
+        # Edges in pixel coordinates, the centre of pixel (r, c) is at (r, c)
+        u0, u1, v0, v1 = [], [], [], []
+        for ring in rings:
+            if len(ring) < 3:
+                continue
+            if not np.array_equal(ring[0], ring[-1]):
+                ring = np.vstack([ring, ring[:1]])
+            u = (ring[:, 0] - geo[0]) / geo[1] - 0.5
+            v = (ring[:, 1] - geo[3]) / geo[5] - 0.5
+            u0.append(u[:-1])
+            u1.append(u[1:])
+            v0.append(v[:-1])
+            v1.append(v[1:])
+        if not u0:
+            return None, None
+        u0, u1 = np.concatenate(u0), np.concatenate(u1)
+        v0, v1 = np.concatenate(v0), np.concatenate(v1)
+
+        # Rows r crossed by each edge, min(v) <= r < max(v)
+        r0 = np.clip(np.ceil(np.minimum(v0, v1)), 0, rows).astype(np.int64)
+        r1 = np.clip(np.ceil(np.maximum(v0, v1)), 0, rows).astype(np.int64)
+        count = r1 - r0
+        if count.sum() == 0:
+            return None, None
+
+        edge = np.repeat(np.arange(len(count)), count)
+        row = np.repeat(r0, count) + (np.arange(count.sum()) -
+                                      np.repeat(np.cumsum(count) - count, count))
+        col = u0[edge] + (row - v0[edge]) * (u1[edge] - u0[edge]) / (v1[edge] -
+                                                                     v0[edge])
+
+        # Pairs of crossings of each row, first pixel at or after the crossing
+        order = np.lexsort((col, row))
+        row = row[order][0::2]
+        col = np.clip(np.ceil(col[order]), 0, cols).astype(np.int64)
+        start, end = col[0::2], col[1::2]
+
+        y0, y1 = row.min(), row.max() + 1
+        x0, x1 = start.min(), end.max()
+        if x1 <= x0:
+            return None, None
+
+        diff = np.zeros((y1 - y0, x1 - x0 + 1), dtype=np.int32)
+        np.add.at(diff, (row - y0, start - x0), 1)
+        np.add.at(diff, (row - y0, end - x0), -1)
+        mask = np.cumsum(diff, axis=1)[:, :-1] > 0
+        if not mask.any():
+            return None, None
+
+        return (int(x0), int(y0), int(x1 - x0), int(y1 - y0)), mask
+
+
+class Zonal(GIS):
+    """This Zonal class
+
+    Description
+
+    Args:
+      workspace (str): Directory to accounts.yml.
+      is_status (bool): Is to print status message.
+      kwargs (dict): Other arguments.
+    """
+    __conf = {
+        'path': '',
+        'file': '',
+        'data': {
+            'stats': ['sum', 'mean', 'count'],
+            'locfile': '{stat}_zonal.csv'
+        }
+    }
+
+    def __init__(self, workspace='', is_status=True, **kwargs):
+        """Class instantiation
+        """
+        GIS.__init__(self, workspace, is_status, **kwargs)
+
+        self.stmsg = {
+            0: 'S: WA.Zonal "{f}" status {c}: {m}',
+            1: 'E: WA.Zonal "{f}" status {c}: {m}',
+            2: 'W: WA.Zonal "{f}" status {c}: {m}',
+        }
+        self.stcode = 0
+        self.status = 'Zonal status.'
+
+        if self.stcode == 0:
+            message = ''
+
+        self._status(
+            inspect.currentframe().f_code.co_name,
+            prt=self.is_status,
+            ext=message)
+
+    @staticmethod
+    def get_stats(data, index, size, nodata=-9999):
+        """Get zonal statistics of one date
+
+        Args:
+          data (:obj:`numpy.ndarray`): Data of the window of ``index``.
+          index (dict): Zone index, from ``Zones.rasterize``.
+          size (int): Number of zones.
+          nodata (float): Nodata value.
+
+        Returns:
+          dict: {'sum', 'mean', 'count'}, arrays of the zones,
+          the mean is ``nan`` without valid values.
+
+        :Example:
+
+            >>> import numpy as np
+            >>> from wateraccounting.Collect.zonal import Zonal, Zones
+            >>> zones = Zones([[[(0, 2), (1, 2), (1, 0), (0, 0)]],
+            ...                [[(1, 2), (2, 2), (2, 0), (1, 0)]]])
+            >>> index = zones.rasterize([0., 1., 0., 2., 0., -1.], (2, 2))
+            >>> data = np.array([[1., 2.], [3., -9999.]])
+            >>> Zonal.get_stats(data, index, len(zones))['mean']
+            array([2., 2.])
+        """
+        values = np.asarray(data).ravel()[index['pixels']]
+        valid = np.isfinite(values) & (values != nodata)
+        zones = index['zones'][valid]
+
+        total = np.bincount(zones, weights=values[valid], minlength=size)
+        count = np.bincount(zones, minlength=size)
+        mean = np.full(size, np.nan)
+        np.divide(total, count, out=mean, where=count > 0)
+
+        return {'sum': total, 'mean': mean, 'count': count}
+
+    def run(self, files, zones, output_folder, stats=('sum', 'mean', 'count'),
+            nodata=-9999):
+        """Zonal statistics of files
+
+        This function streams the files, the date ``yyyy.mm.dd.tif`` in the
+        name, through ``get_stats``, only the window of the zones is read.
+        Each statistic is a CSV file, a row per date and a column per zone,
+        dates already in a file are not computed again.
+
+        Args:
+          files (list): Files, the date ``yyyy.mm.dd.tif`` in the name.
+          zones (:obj:`Zones`): Zones.
+          output_folder (str): Directory of the outputs.
+          stats (tuple): 'sum', 'mean' and/or 'count'.
+          nodata (float): Nodata value.
+
+        Returns:
+          list: Files written.
+        """
+        for stat in stats:
+            if stat not in self.__conf['data']['stats']:
+                raise ValueError('Unknown stat: {v}'.format(v=stat))
+
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+
+        outputs = OrderedDict(
+            (stat, os.path.join(output_folder,
+                                self.__conf['data']['locfile'].format(stat=stat)))
+            for stat in stats)
+        dates = {stat: self._get_dates(file, zones.names)
+                 for stat, file in outputs.items()}
+
+        files = sorted((Aggregate.get_date(file), file) for file in files)
+
+        fps = {}
+        try:
+            for date, file in files:
+                todo = [stat for stat in stats
+                        if date.isoformat() not in dates[stat]]
+                if not todo:
+                    continue
+
+                geo, proj, size_X, size_Y = self.get_tif_info(file)
+                index = zones.rasterize(geo, (size_Y, size_X))
+                if index['pixels'].size:
+                    data = self.get_tif(file, 1, index['window'])
+                else:
+                    data = np.empty(0)
+                result = self.get_stats(data, index, len(zones), nodata)
+
+                for stat in todo:
+                    if stat not in fps:
+                        fps[stat] = self._open(outputs[stat], zones.names)
+                    fps[stat].write('{d},{v}\n'.format(
+                        d=date.isoformat(),
+                        v=','.join('{:.7g}'.format(value)
+                                   for value in result[stat])))
+                    dates[stat].add(date.isoformat())
+        finally:
+            for fp in fps.values():
+                fp.close()
+
+        results = [outputs[stat] for stat in stats if stat in fps]
+
+        self.stcode = 0
+        self._status(
+            inspect.currentframe().f_code.co_name,
+            prt=self.is_status,
+            ext='{n} files written.'.format(n=len(results)))
+
+        return results
+
+    @staticmethod
+    def _get_dates(file, names):
+        """Dates in a CSV file
+
+        Returns:
+          set: Dates, iso format.
+        """
+        dates = set()
+        if not os.path.exists(file):
+            return dates
+
+        with open(file) as fp:
+            header = fp.readline().rstrip('\n').split(',')
+            if header[1:] != list(names):
+                raise ValueError('"{f}" zones differ from "{z}".'
+                                 .format(f=file, z=names))
+            for line in fp:
+                dates.add(line.split(',', 1)[0])
+
+        return dates
+
+    @staticmethod
+    def _open(file, names):
+        """Open a CSV file to append, with the header when new
+        """
+        is_new = not os.path.exists(file)
+        fp = open(file, 'a')
+        if is_new:
+            fp.write('date,{}\n'.format(','.join(names)))
+        return fp
+
+
+def main():
+    from pprint import pprint
+
+    # Zones rasterize
+    print('\nZones\n=====')
+    zones = Zones([[[(1, 3), (3, 3), (3, 1), (1, 1)]]], ['basin'])
+    pprint(zones.rasterize([0., 1., 0., 4., 0., -1.], (4, 4)))
+
+    # Zonal __init__
+    print('\nZonal\n=====')
+    zonal = Zonal('', is_status=True)
+
+    # Zonal attributes
+    print('\nzonal._Zonal__conf\n=====')
+    pprint(zonal._Zonal__conf)
+
+
+if __name__ == "__main__":
+    main()
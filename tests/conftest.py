@@ -1,9 +1,31 @@
 # -*- coding: utf-8 -*-
 """
-    Dummy conftest.py for wateraccounting.
+    conftest.py for wateraccounting.
 
-    If you don't know what this is for, just leave it empty.
+    Stand-in servers of the product downloads, see ``servers.py``.
     Read more about conftest.py under:
     https://pytest.org/latest/plugins.html
 """
-# import pytest
+import pytest
+
+from servers import Server
+
+
+@pytest.fixture
+def ftp_server(tmp_path):
+    """Stand-in FTP server, serving ``tmp_path/ftp``, no faults
+    """
+    root = tmp_path / 'ftp'
+    root.mkdir()
+    with Server(str(root), 'ftp') as server:
+        yield server
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """Stand-in HTTP server, serving ``tmp_path/http``, no faults
+    """
+    root = tmp_path / 'http'
+    root.mkdir()
+    with Server(str(root), 'http') as server:
+        yield server
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+**Servers**
+
+`Description`
+
+Local stand-in FTP and HTTP servers, serving the remote layouts of the
+products from ``base.yml``, ``dir`` + ``rmtname``, with fault injection:
+latency, bandwidth caps, dropped connections and missing files.
+
+The servers run in threads and only use the standard library.
+Point a product at a server with the ``WA_URL_<PRODUCT>`` environment variable,
+see ``Download.get_url``.
+
+**Examples:**
+::
+
+    from servers import Faults, Server, populate
+    populate(root, 'CHIRPS', 'Precipitation', 'v2', 'daily', dates, b'...')
+    with Server(root, 'ftp', Faults(latency=0.05, bandwidth=1024 ** 2)) as server:
+        os.environ['WA_URL_CHIRPS'] = server.url
+"""
+import os
+import time
+import zlib
+import random
+import socket
+import posixpath
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, unquote
+
+from wateraccounting.Collect.base import Base
+
+
+class Faults(object):
+    """This Faults class
+
+    Args:
+      latency (float): Seconds of delay of each command or request.
+      bandwidth (float): Bytes per second of each transfer, None is no cap.
+      drop (float): Probability that a transfer is cut after half of the file.
+      missing (float): Fraction of the files reported as not found,
+        the same files for every request.
+      seed (int): Random seed.
+    """
+
+    def __init__(self, latency=0., bandwidth=None, drop=0., missing=0., seed=0):
+        """Class instantiation
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drop = drop
+        self.missing = missing
+        self.seed = seed
+
+        self.counters = {'requests': 0, 'nbytes': 0, 'drops': 0, 'missing': 0}
+        self.__lock = threading.Lock()
+        self.__random = random.Random(seed)
+
+    def count(self, key, value=1):
+        with self.__lock:
+            self.counters[key] += value
+
+    def wait(self):
+        """Wait latency
+        """
+        self.count('requests')
+        if self.latency > 0.:
+            time.sleep(self.latency)
+
+    def is_missing(self, path):
+        """Is file reported as not found, the same answer for each request
+        """
+        key = '{s}:{p}'.format(s=self.seed, p=path).encode('utf-8')
+        is_missing = zlib.crc32(key) / 2. ** 32 < self.missing
+        if is_missing:
+            self.count('missing')
+        return is_missing
+
+    def send(self, write, file, start=0, size=None, chunk=64 * 1024):
+        """Send file with bandwidth cap, may drop the connection
+
+        Returns:
+          bool: Is the whole file sent.
+        """
+        if size is None:
+            size = os.path.getsize(file) - start
+
+        with self.__lock:
+            is_drop = self.__random.random() < self.drop
+        stop = size // 2 if is_drop else size
+
+        sent = 0
+        t0 = time.time()
+        with open(file, 'rb') as fp:
+            fp.seek(start)
+            while sent < stop:
+                data = fp.read(min(chunk, stop - sent))
+                if not data:
+                    break
+                write(data)
+                sent += len(data)
+                if self.bandwidth:
+                    delay = t0 + sent / float(self.bandwidth) - time.time()
+                    if delay > 0.:
+                        time.sleep(delay)
+
+        self.count('nbytes', sent)
+        if is_drop:
+            self.count('drops')
+        return not is_drop
+
+
+class FTPHandler(socketserver.StreamRequestHandler):
+    """Minimal passive mode FTP, the commands used by ``ftplib``
+    """
+
+    def handle(self):
+        self.cwd = '/'
+        self.pasv = None
+        self.reply('220 WA stand-in FTP server')
+
+        for line in self.rfile:
+            cmd, _, arg = line.decode('utf-8', 'replace').strip().partition(' ')
+            method = getattr(self, 'ftp_' + cmd.upper(), None)
+            if method is None:
+                self.reply('502 Command not implemented')
+                continue
+
+            self.server.faults.wait()
+            try:
+                if method(arg) is False:
+                    break
+            except (ConnectionError, socket.timeout):
+                break
+
+        if self.pasv is not None:
+            self.pasv.close()
+
+    def reply(self, message):
+        self.wfile.write('{}\r\n'.format(message).encode('utf-8'))
+
+    def get_path(self, arg):
+        """Remote path to local file, inside the root
+        """
+        path = posixpath.normpath(posixpath.join(self.cwd, arg or '.'))
+        return path, os.path.join(self.server.root, path.lstrip('/'))
+
+    def accept(self):
+        if self.pasv is None:
+            self.reply('425 Use PASV first')
+            return None
+        conn, addr = self.pasv.accept()
+        self.pasv.close()
+        self.pasv = None
+        return conn
+
+    def ftp_USER(self, arg):
+        self.reply('331 Password required')
+
+    def ftp_PASS(self, arg):
+        self.reply('230 Logged in')
+
+    def ftp_SYST(self, arg):
+        self.reply('215 UNIX Type: L8')
+
+    def ftp_TYPE(self, arg):
+        self.reply('200 Type set to {}'.format(arg))
+
+    def ftp_NOOP(self, arg):
+        self.reply('200 OK')
+
+    def ftp_PWD(self, arg):
+        self.reply('257 "{}"'.format(self.cwd))
+
+    def ftp_CWD(self, arg):
+        path, local = self.get_path(arg)
+        if os.path.isdir(local):
+            self.cwd = path
+            self.reply('250 OK')
+        else:
+            self.reply('550 {} not found'.format(arg))
+
+    def ftp_PASV(self, arg):
+        if self.pasv is not None:
+            self.pasv.close()
+        self.pasv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.pasv.bind((self.server.server_address[0], 0))
+        self.pasv.listen(1)
+        self.pasv.settimeout(10.)
+        host, port = self.pasv.getsockname()
+        self.reply('227 Entering Passive Mode ({h},{p1},{p2})'.format(
+            h=host.replace('.', ','), p1=port // 256, p2=port % 256))
+
+    def ftp_SIZE(self, arg):
+        path, local = self.get_path(arg)
+        if os.path.isfile(local) and not self.server.faults.is_missing(path):
+            self.reply('213 {}'.format(os.path.getsize(local)))
+        else:
+            self.reply('550 {} not found'.format(arg))
+
+    def ftp_RETR(self, arg):
+        path, local = self.get_path(arg)
+        if not os.path.isfile(local) or self.server.faults.is_missing(path):
+            self.reply('550 {} not found'.format(arg))
+            return
+
+        conn = self.accept()
+        if conn is None:
+            return
+        self.reply('150 Opening BINARY mode data connection')
+        try:
+            is_done = self.server.faults.send(conn.sendall, local)
+        finally:
+            conn.close()
+        if is_done:
+            self.reply('226 Transfer complete')
+        else:
+            self.reply('426 Connection closed; transfer aborted')
+
+    def ftp_NLST(self, arg):
+        path, local = self.get_path(arg)
+        conn = self.accept()
+        if conn is None:
+            return
+        self.reply('150 Here comes the directory listing')
+        names = sorted(os.listdir(local)) if os.path.isdir(local) else []
+        conn.sendall(''.join('{}\r\n'.format(name) for name in names).encode('utf-8'))
+        conn.close()
+        self.reply('226 Directory send OK')
+
+    ftp_LIST = ftp_NLST
+
+    def ftp_QUIT(self, arg):
+        self.reply('221 Bye')
+        return False
+
+
+class HTTPHandler(BaseHTTPRequestHandler):
+    """HTTP GET and HEAD of files, with byte ranges, and directory indexes
+    """
+
+    def do_HEAD(self):
+        self.send_file(is_body=False)
+
+    def do_GET(self):
+        self.send_file(is_body=True)
+
+    def send_file(self, is_body):
+        self.server.faults.wait()
+
+        path = posixpath.normpath(unquote(urlparse(self.path).path))
+        local = os.path.join(self.server.root, path.lstrip('/'))
+        if os.path.isdir(local):
+            self.send_index(local, is_body)
+            return
+        if not os.path.isfile(local) or self.server.faults.is_missing(path):
+            self.send_error(404, 'Not Found')
+            return
+
+        size = os.path.getsize(local)
+        start, end = 0, size - 1
+        ranges = self.headers.get('Range', '')
+        if ranges.startswith('bytes='):
+            first, _, last = ranges[6:].partition('-')
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(size - int(last), 0)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {s}-{e}/{n}'.format(
+                s=start, e=end, n=size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        if is_body:
+            if not self.server.faults.send(self.wfile.write, local, start,
+                                           end - start + 1):
+                self.close_connection = True
+
+    def send_index(self, local, is_body):
+        """Directory index, the links of an Apache index page
+        """
+        body = ''.join('<a href="{n}">{n}</a>\n'.format(n=name)
+                       for name in sorted(os.listdir(local))).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if is_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+class ThreadingFTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Server(object):
+    """This Server class
+
+    Stand-in server in a thread, on a free port of 127.0.0.1.
+
+    Args:
+      root (str): Directory served as '/'.
+      kind (str): 'ftp' or 'http'.
+      faults (:obj:`Faults`): Fault injection, default no faults.
+    """
+    __conf = {
+        'kinds': {
+            'ftp': (ThreadingFTPServer, FTPHandler),
+            'http': (ThreadingHTTPServer, HTTPHandler)
+        }
+    }
+
+    def __init__(self, root, kind='http', faults=None):
+        """Class instantiation
+        """
+        if kind not in self.__conf['kinds']:
+            raise ValueError('Unknown kind: {v}'.format(v=kind))
+
+        server_class, handler_class = self.__conf['kinds'][kind]
+        self.kind = kind
+        self.server = server_class(('127.0.0.1', 0), handler_class)
+        self.server.root = str(root)
+        self.server.faults = Faults() if faults is None else faults
+        self.__thread = None
+
+    @property
+    def faults(self):
+        return self.server.faults
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return '{k}://{h}:{p}'.format(k=self.kind, h=host, p=port)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.server.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.__thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def populate(root, product, dataset, version, datatype, dates, data, **kwargs):
+    """Create the remote layout of a product
+
+    Args:
+      root (str): Directory served as '/'.
+      product (str): Product name, 'CHIRPS'.
+      dataset (str): Dataset name, 'Precipitation'.
+      version (str): Version name, 'v2'.
+      datatype (str): Data type, 'daily'.
+      dates (list): Dates, :obj:`datetime.date` like.
+      data (bytes or str): File content, or a file to link.
+      kwargs (dict): Other fields of ``dir`` and ``rmtname``, 'var'.
+
+    Returns:
+      list: Remote paths.
+    """
+    conf = Base.check_conf('data', is_status=False)
+    conf = conf['products'][product]['data'][dataset][version][datatype]
+
+    paths = []
+    for date in dates:
+        fields = dict(kwargs,
+                      Y='{:04d}'.format(date.year), m='{:02d}'.format(date.month),
+                      d='{:02d}'.format(date.day),
+                      j='{:03d}'.format(date.timetuple().tm_yday))
+        path = posixpath.join(conf['dir'].format(**fields),
+                              conf['rmtname'].format(**fields))
+        local = os.path.join(str(root), path.lstrip('/'))
+        if path in paths or os.path.exists(local):
+            continue
+
+        if not os.path.exists(os.path.dirname(local)):
+            os.makedirs(os.path.dirname(local))
+        if isinstance(data, bytes):
+            with open(local, 'wb') as fp:
+                fp.write(data)
+        else:
+            try:
+                os.link(data, local)
+            except OSError:
+                with open(data, 'rb') as fp_in, open(local, 'wb') as fp_out:
+                    fp_out.write(fp_in.read())
+        paths.append(path)
+
+    return paths
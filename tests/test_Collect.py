@@ -2,15 +2,36 @@
 """
 """
 import os
+import gzip
+import json
+import zipfile
+import datetime
+import ftplib
+import functools
+import urllib.request
 import numpy as np
+import pandas as pd
 
 import pytest
 
 from wateraccounting.Collect.accounts import Accounts
+from wateraccounting.Collect.aggregate import Aggregate
+from wateraccounting.Collect.download import Download, Pipeline
 from wateraccounting.Collect.gis import GIS
+from wateraccounting.Collect.grid import Grid
+from wateraccounting.Collect.job import Job
+from wateraccounting.Collect.ledger import Ledger
+from wateraccounting.Collect.metrics import Metrics
+from wateraccounting.Collect.planner import Planner
+from wateraccounting.Collect.progress import Progress
+from wateraccounting.Collect.serve import SubsetServer
+from wateraccounting.Collect.sync import Sync
+from wateraccounting.Collect.trace import Trace
+from wateraccounting.Collect.transform import Transform
+from wateraccounting.Collect.zonal import Zonal, Zones
+from wateraccounting.Collect.products import ALEXI, ASCAT, CFSR, CHIRPS, CMRSET, DEM
 
-import wateraccounting.Collect.ALEXI as ALEXI
-import wateraccounting.Collect.ASCAT as ASCAT
+from servers import Faults, populate
 
 __author__ = "Quan Pan"
 __copyright__ = "Quan Pan"
@@ -127,3 +148,906 @@ def test_GIS_save_tiff():
 #         'SWI', 'ASCAT', 'Daily')))
 #     print(nfiles)
 #     assert nfiles > 0
+
+
+def test_GIS_tiff_blocks(tmp_path):
+    path = __path_data
+    file_in = os.path.join(path, 'BigTIFF', 'Classic.tif')
+    file_out = os.path.join(str(tmp_path), 'Classic-blocks.tif')
+
+    gis = GIS(path, is_status=True)
+    data_in = gis.get_tif(file_in, 1)
+
+    # blocks cover the band once, halo is clipped at the edge
+    data_out = np.zeros(data_in.shape)
+    for window, data in gis.get_tif_blocks(file_in, 1, halo=2, size=(16, 16)):
+        xoff, yoff, xsize, ysize = window
+        assert data.shape[0] <= ysize + 4
+        assert data.shape[1] <= xsize + 4
+        data_out[yoff:yoff + ysize, xoff:xoff + xsize] += 1
+    assert np.all(data_out == 1)
+
+    blocks = gis.get_tif_blocks(file_in, 1, halo=2, size=(16, 16))
+    gis.save_tif_blocks(file_out, blocks, data_in.shape, [0, 1, 0, 0, 0, -1],
+                        "WGS84", halo=2)
+    assert np.all(gis.get_tif(file_out, 1) == data_in)
+
+    with pytest.raises(IOError, match=r".* not .*"):
+        next(gis.get_tif_blocks(os.path.join(path, 'missing.tif')))
+
+
+def test_GIS_resample():
+    path = __path_data
+    gis = GIS(path, is_status=True)
+
+    geo = [0, 1, 0, 2, 0, -1]
+    data = np.array([[1., 2.], [3., -9999.]])
+
+    # nearest, upsample
+    data_out = gis.resample(data, geo, [0, 0.5, 0, 2, 0, -0.5], (4, 4), 'nearest')
+    assert data_out.shape == (4, 4)
+    assert data_out[0, 0] == 1.
+    assert data_out[3, 3] == -9999.
+
+    # average, downsample, nodata excluded
+    data_out = gis.resample(data, geo, [0, 2, 0, 2, 0, -2], (1, 1), 'average')
+    assert data_out[0, 0] == 2.
+
+    # bilinear, outside source grid
+    data_out = gis.resample(data, geo, [-2, 1, 0, 2, 0, -1], (2, 4), 'bilinear')
+    assert np.all(data_out[:, :2] == -9999.)
+    assert data_out[0, 2] == 1.
+
+    # weights are cached by grid, target grid and method
+    weights = gis.get_resample_weights(geo, (2, 2), [0, 2, 0, 2, 0, -2], (1, 1),
+                                       'average')
+    assert weights is gis.get_resample_weights(geo, (2, 2), [0, 2, 0, 2, 0, -2],
+                                               (1, 1), 'average')
+
+    with pytest.raises(ValueError, match=r"Unknown .*"):
+        gis.get_resample_weights(geo, (2, 2), geo, (2, 2), 'cubic')
+
+
+def test_GIS_encoding(tmp_path):
+    gis = GIS(str(tmp_path), is_status=False)
+    file = str(tmp_path / 'test.tif')
+    geo = [0., 1., 0., 2., 0., -1.]
+    data = np.array([[0., 12.34, 6553.4], [-9999., np.nan, 7000.]])
+
+    encoding = GIS.get_encoding('CHIRPS', 'Precipitation', 'v2', 'daily', 'P')
+    assert encoding['dtype'] == 'uint16'
+    gis.save_tif(file, data, geo, 'WGS84', encoding)
+    f, lock = gis.open_tif(file)
+    with lock:
+        assert f.GetRasterBand(1).ReadAsArray().dtype == np.uint16
+
+    # read back as float32, nodata as -9999, clipped to the dtype
+    decoded = gis.get_tif(file, 1)
+    assert decoded.dtype == np.float32
+    assert np.allclose(decoded, [[0., 12.3, 6553.4], [-9999., -9999., 6553.4]])
+
+    # resampled and block read values are decoded as well
+    resampled = str(tmp_path / 'resampled.tif')
+    gis.resample_tif(file, resampled, [0., 0.5, 0., 2., 0., -0.5], (4, 6))
+    assert np.allclose(gis.get_tif(resampled, 1)[::2, ::2], decoded)
+    blocks = list(gis.get_tif_blocks(file, 1))
+    assert len(blocks) == 1
+    assert np.allclose(blocks[0][1], decoded)
+
+    assert GIS.get_encoding('ALEXI', 'Evaporation', 'v1', 'daily', 'ETa') is None
+    assert GIS.get_encoding('DEM', 'DEM', 'v1', '15s')['dtype'] == 'int16'
+
+
+def test_Grid():
+    grid = Grid.from_conf('CHIRPS', 'Precipitation', 'v2', 'daily', 'P')
+
+    assert grid.shape == (2000, 7200)
+    assert grid is Grid.from_conf('CHIRPS', 'Precipitation', 'v2', 'daily', 'P')
+
+    # snapped window, same as the former CHIRPS index
+    yID, xID = grid.window([-10, 30], [-20, -10])
+    assert yID == (400, 1200)
+    assert xID == (3200, 3400)
+    assert grid.window_geo(yID, xID) == [-20., 0.05, 0., 30., 0., -0.05]
+
+    # vectorized windows and points
+    yIDs, xIDs = grid.windows([[-10, 30], [-60, 60]], [[-20, -10], [-200, 200]])
+    assert yIDs.tolist() == [[400, 1200], [0, 2000]]
+    assert xIDs.tolist() == [[3200, 3400], [0, 7200]]
+
+    rows, cols = grid.to_index(np.array([49.99, -49.99]), np.array([-179.99, 179.99]))
+    assert rows.tolist() == [0, 1999]
+    assert cols.tolist() == [0, 7199]
+
+    latlim, lonlim = grid.check_latlon([-60, 30], [-20, 190])
+    assert latlim == [-50., 30.]
+    assert lonlim == [-20., 180.]
+
+    with pytest.raises(KeyError, match=r".* not .*"):
+        Grid.from_conf('CHIRPS', 'Precipitation', 'v2', 'yearly', 'P')
+
+
+def test_Transform():
+    raw = np.arange(-6., 18.).reshape(4, 6) * 2.45
+    expected = np.flipud(raw)[1:3, 2:5] / 2.45
+    expected[expected < 0] = -9999
+    transform = Transform.from_conf('ALEXI', 'Evaporation', 'v1', 'daily', 'ETa')
+    data = transform(raw, (1, 3), (2, 5))
+    assert np.allclose(data, expected)
+    # the window of the block is changed in place
+    assert np.shares_memory(data, raw)
+    assert Transform.from_conf('ALEXI', 'Evaporation', 'v1', 'daily', 'ETa') \
+        is transform
+
+    # the halves are swapped in place, like np.roll
+    raw = np.arange(24.).reshape(4, 6)
+    expected = np.roll(raw, 3, axis=1)
+    transform = Transform.from_conf('CFSR', 'Radiation', 'v2', 'daily', 'dswsfc')
+    assert transform(raw) is raw
+    assert np.array_equal(raw, expected)
+
+    # integers are copied once to float32
+    data = Transform([{'scale': 0.5}, {'nodata': {'above': 100.}}])(
+        np.array([[10, 255]], dtype=np.uint8))
+    assert data.dtype == np.float32
+    assert data.tolist() == [[5., -9999.]]
+
+    with pytest.raises(ValueError, match=r"Unknown .*"):
+        Transform(['flipup'])
+    with pytest.raises(ValueError, match=r"Layout .*"):
+        Transform([{'scale': 2.}, 'flipud'])
+
+
+def test_Zonal(tmp_path):
+    geojson = {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': {'name': 'west'},
+         'geometry': {'type': 'Polygon',
+                      'coordinates': [[[0, 0], [2, 0], [2, 4], [0, 4], [0, 0]]]}},
+        {'type': 'Feature', 'properties': {'name': 'east'},
+         'geometry': {'type': 'Polygon',
+                      'coordinates': [[[2, 0], [4, 0], [4, 4], [2, 4], [2, 0]],
+                                      [[3, 1], [4, 1], [4, 2], [3, 2], [3, 1]]]}}
+    ]}
+    file = str(tmp_path / 'basins.geojson')
+    with open(file, 'w') as fp:
+        json.dump(geojson, fp)
+    zones = Zones.from_file(file, 'name')
+    assert zones.names == ['west', 'east']
+
+    gis = GIS(str(tmp_path), is_status=False)
+    geo = [-1., 1., 0., 5., 0., -1.]
+    index = zones.rasterize(geo, (6, 6))
+    assert index['window'] == (1, 1, 4, 4)
+    assert np.array_equal(np.bincount(index['zones']), [8, 7])
+    assert zones.rasterize(geo, (6, 6)) is index
+
+    data = np.arange(36.).reshape(6, 6)
+    data[1, 1] = -9999
+    files = []
+    for day in (2, 1):
+        files.append(str(tmp_path / 'P_mm.day_2010.01.{:02d}.tif'.format(day)))
+        gis.save_tif(files[-1], np.where(data == -9999, -9999, data * day), geo,
+                     'WGS84')
+
+    zonal = Zonal(str(tmp_path), is_status=False)
+    output = str(tmp_path / 'zonal')
+    results = zonal.run(files, zones, output)
+    assert len(results) == 3
+    frame = pd.read_csv(os.path.join(output, 'sum_zonal.csv'), index_col=0)
+    assert list(frame.columns) == ['west', 'east']
+    assert list(frame.index) == ['2010-01-01', '2010-01-02']
+    west = data[1:5, 1:3].ravel()[1:].sum()
+    east = data[1:5, 3:5].sum() - data[3, 4]
+    assert np.allclose(frame.values, [[west, east], [west * 2, east * 2]])
+    frame = pd.read_csv(os.path.join(output, 'count_zonal.csv'), index_col=0)
+    assert frame.values.tolist() == [[7, 7], [7, 7]]
+
+    # dates already in the outputs are skipped
+    assert zonal.run(files, zones, output) == []
+    with pytest.raises(ValueError, match=r".* zones differ .*"):
+        zonal.run(files, Zones(zones.polygons), output)
+
+
+def test_GIS_clip(tmp_path, monkeypatch):
+    # a diagonal basin, the corners of its extent are outside
+    geojson = {'type': 'Polygon',
+               'coordinates': [[[1, 5], [3.5, 5], [5, 3.5], [5, 1], [2.5, 1],
+                                [1, 2.5]]]}
+    file = str(tmp_path / 'basin.geojson')
+    with open(file, 'w') as fp:
+        json.dump(geojson, fp)
+    monkeypatch.setenv('WA_CLIP', file)
+
+    gis = GIS(str(tmp_path), is_status=False)
+    zones = GIS.get_clip()
+    assert GIS.get_clip(file) is zones
+
+    name = str(tmp_path / 'test.tif')
+    geo = [0., 1., 0., 6., 0., -1.]
+    gis.save_tif(name, np.arange(36.).reshape(6, 6), geo, 'WGS84', clip=zones)
+    assert gis.get_tif_info(name)[2:] == (4, 4)
+    assert list(gis.get_tif_geo(name)) == [1., 1., 0., 5., 0., -1.]
+    data = gis.get_tif(name, 1)
+    outside = np.tri(4, k=-3, dtype=bool)
+    assert np.array_equal(data == -9999, outside | outside.T)
+    assert data[0, 0] == 7.
+    # the mask is rasterized once per grid
+    assert zones.rasterize(geo, (6, 6)) is zones.rasterize(geo, (6, 6))
+
+    with pytest.raises(ValueError, match=r"Zones outside .*"):
+        gis.save_tif(name, np.ones((2, 2)), [10., 1., 0., 2., 0., -1.], 'WGS84',
+                     clip=zones)
+    # intermediate files are not clipped
+    gis.save_tif(name, np.ones((6, 6)), geo, 'WGS84')
+    assert gis.get_tif_info(name)[2:] == (6, 6)
+
+
+def test_GIS_tif_cache(tmp_path):
+    gis = GIS(str(tmp_path), is_status=False)
+    file = str(tmp_path / 'test.tif')
+    geo = [0., 1., 0., 4., 0., -1.]
+    gis.save_tif(file, np.ones((4, 4)), geo, 'WGS84')
+
+    cache = GIS.get_tif_cache()
+    assert gis.get_tif_info(file)[2:] == (4, 4)
+    assert np.allclose(gis.get_tif(file, 1), 1.)
+    assert GIS.get_tif_cache()['opens'] - cache['opens'] == 1
+    assert GIS.get_tif_cache()['hits'] - cache['hits'] == 1
+
+    # a write invalidates the handle
+    gis.save_tif(file, np.full((4, 4), 2.), geo, 'WGS84')
+    assert np.allclose(gis.get_tif(file, 1), 2.)
+    assert GIS.get_tif_cache()['opens'] - cache['opens'] == 2
+
+    size = GIS.get_tif_cache()['size']
+    try:
+        for i in range(3):
+            gis.save_tif(str(tmp_path / '{}.tif'.format(i)), np.ones((4, 4)),
+                         geo, 'WGS84')
+            gis.get_tif(str(tmp_path / '{}.tif'.format(i)), 1)
+        assert GIS.set_tif_cache(2)['files'] == 2
+    finally:
+        GIS.set_tif_cache(size)
+    gis.close_tif(str(tmp_path))
+    assert GIS.get_tif_cache()['files'] == 0
+
+    # a re-downloaded archive invalidates the handles of the files in it
+    archive = str(tmp_path / 'test.zip')
+    for value, mtime in [(1., 1.0e9), (3., 1.0e9 + 60)]:
+        gis.save_tif(file, np.full((4, 4), value), geo, 'WGS84')
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.write(file, 'test.tif')
+        os.utime(archive, (mtime, mtime))
+        assert np.allclose(gis.get_tif('/vsizip/{}/test.tif'.format(archive), 1),
+                           value)
+
+
+def test_Aggregate(tmp_path):
+    path = __path_data
+    geo = [0, 1, 0, 2, 0, -1]
+
+    gis = GIS(path, is_status=True)
+    files = []
+    for date, value in [('2003.01.01', 1.), ('2003.01.02', 2.),
+                        ('2003.01.03', -9999.), ('2003.02.01', 5.)]:
+        file = os.path.join(str(tmp_path), 'P_CHIRPS_daily_{}.tif'.format(date))
+        gis.save_tif(file, np.full((2, 2), value), geo, "WGS84")
+        files.append(file)
+
+    output_folder = os.path.join(str(tmp_path), 'Monthly')
+    aggregate = Aggregate(path, is_status=True)
+
+    results = aggregate.run(files[:2], output_folder, 'monthly')
+    assert len(results) == 3
+    assert np.all(aggregate.get_tif(results[0], 1) == 3.)
+    assert np.all(aggregate.get_tif(results[1], 1) == 1.5)
+    assert np.all(aggregate.get_tif(results[2], 1) == 2.)
+
+    # new days update the saved state, old periods without new days are skipped
+    results = aggregate.run(files, output_folder, 'monthly', stats=('sum', 'count'))
+    assert [os.path.basename(file) for file in results] == [
+        'sum_monthly_2003.01.01.tif', 'count_monthly_2003.01.01.tif',
+        'sum_monthly_2003.02.01.tif', 'count_monthly_2003.02.01.tif']
+    assert np.all(aggregate.get_tif(results[1], 1) == 2.)
+    assert aggregate.run(files, output_folder, 'monthly') == []
+
+    with pytest.raises(ValueError, match=r"Unknown .*"):
+        aggregate.run(files, output_folder, 'weekly')
+
+
+def test_DEM_Merge_vsizip(tmp_path):
+    gis = GIS(str(tmp_path), is_status=False)
+    res = 0.00416667 * 2
+    data = np.arange(120 * 120, dtype=np.float32).reshape(120, 120)
+    gis.save_tif(str(tmp_path / 'af_dem_30s.bil'), data, [0., res, 0., 1., 0., -res],
+                 'WGS84')
+    with zipfile.ZipFile(str(tmp_path / 'af_dem_30s_bil.zip'), 'w') as zf:
+        zf.write(str(tmp_path / 'af_dem_30s.bil'), 'af_dem_30s.bil')
+    os.remove(str(tmp_path / 'af_dem_30s.bil'))
+
+    # the tile is read in place from the zip file, the window only
+    tile = '/vsizip/{}/af_dem_30s.bil'.format(tmp_path / 'af_dem_30s_bil.zip')
+    merged, geo = DEM.Merge_DEM_15s_30s(str(tmp_path), None, [0.5, 1.], [0., 0.5],
+                                        '30s', [tile])
+    assert merged.shape == (60, 60)
+    assert np.allclose(merged, data[:60, :60])
+    assert os.listdir(str(tmp_path)) == ['af_dem_30s_bil.zip']
+
+    files = GIS.get_tif_cache()['files']
+    gis.close_tif(str(tmp_path))
+    assert GIS.get_tif_cache()['files'] == files - 1
+
+
+def test_DEM_cache(tmp_path, monkeypatch):
+    res = 0.00416667 * 2
+    data = np.arange(120 * 120, dtype=np.float32).reshape(120, 120)
+    downloads = []
+
+    def download_data(nameFile, output_folder_trash, *args):
+        downloads.append(nameFile)
+        gis = GIS(str(tmp_path), is_status=False)
+        gis.save_tif(os.path.join(output_folder_trash, 'af_dem_30s.bil'), data,
+                     [0., res, 0., 1., 0., -res], 'WGS84')
+        output_file = os.path.join(output_folder_trash, nameFile)
+        with zipfile.ZipFile(output_file, 'w') as zf:
+            zf.write(os.path.join(output_folder_trash, 'af_dem_30s.bil'),
+                     'af_dem_30s.bil')
+        return output_file, nameFile
+
+    monkeypatch.setattr(DEM, 'Download_Data', download_data)
+    monkeypatch.setenv('WA_DEM_CACHE', str(tmp_path / 'Cache'))
+    monkeypatch.chdir(str(tmp_path))
+
+    # the continent is downloaded once, the next requests read the cache
+    for col in (0, 30):
+        output_folder = str(tmp_path / 'Output')
+        DEM.DownloadData(output_folder, [0.5, 1.], [col * res, (col + 60) * res],
+                         'dem_30s', '30s')
+        merged = GIS(output_folder, is_status=False).get_tif(
+            os.path.join(output_folder, 'DEM_HydroShed_m_30s.tif'))
+        assert np.allclose(merged, data[:60, col:col + 60])
+    assert downloads == ['af_dem_30s_bil.zip']
+    assert os.listdir(str(tmp_path / 'Cache')) == ['af_dem_30s.tif']
+
+
+def test_DEM_3s_vsimem(tmp_path, monkeypatch):
+    # a sea tile is not published, its chunks are written in memory
+    monkeypatch.setattr(DEM, 'Download_Data', lambda *args: None)
+    monkeypatch.setenv('WA_VSIMEM', '1')
+    monkeypatch.chdir(str(tmp_path))
+
+    output_folder = str(tmp_path / 'Output')
+    DEM.DownloadData(output_folder, [0.5, 0.6], [0.5, 0.6], 'dem_3s', '3s')
+    data = GIS(output_folder, is_status=False).get_tif(
+        os.path.join(output_folder, 'DEM_HydroShed_m_3s.tif'))
+    assert data.shape == (121, 121)
+    assert np.all(data == -9999)
+    assert os.listdir(output_folder) == ['DEM_HydroShed_m_3s.tif']
+
+
+def test_Download_map():
+    results = []
+    for mode in ['serial', 'thread', 'process', 'asyncio']:
+        assert Download.map(abs, [-1, -2, 3], mode, 2, results.append) == [1, 2, 3]
+    assert sorted(results) == [1] * 4 + [2] * 4 + [3] * 4
+
+    # warm pools are reused across calls
+    assert Download.get_pool('process', 2) is Download.get_pool('process', 2)
+
+    with pytest.raises(ValueError, match=r"Unknown .*"):
+        Download.map(abs, [-1], 'gpu', 2)
+
+
+def test_Download_vsimem(tmp_path, monkeypatch):
+    download = Download('', '', is_status=False)
+    file = str(tmp_path / 'global.tif')
+    data = np.arange(12.).reshape(3, 4)
+    download.save_tif(file, data, [-20., 0.05, 0., 30., 0., -0.05], 'WGS84')
+    with open(file, 'rb') as fp:
+        buffer = gzip.compress(fp.read())
+    os.remove(file)
+    assert Download.get_temp(file) == file
+
+    # the CHIRPS .tif.gz is read in place, the window only
+    args = [download, str(tmp_path), 'daily', (1, 3), (0, 2), None]
+    download.put_temp(file + '.gz', buffer)
+    task = CHIRPS.Decode_data({'Date': pd.Timestamp('2003-01-01'), 'args': args,
+                               'file': file + '.gz'})
+    assert np.allclose(task['data'], data[0:2, 1:3])
+    assert os.listdir(str(tmp_path)) == []
+
+    # the downloaded .tif.gz is kept in memory
+    monkeypatch.setenv('WA_VSIMEM', '1')
+    assert Download.get_temp(file).startswith('/vsimem/wa/')
+    task = CHIRPS.Decode_data({'Date': pd.Timestamp('2003-01-01'), 'args': args,
+                               'file': file, 'buffer': buffer})
+    assert np.allclose(task['data'], data[0:2, 1:3])
+    assert 'buffer' not in task
+    assert os.listdir(str(tmp_path)) == []
+    with pytest.raises(IOError, match=r".*not found.*"):
+        download.get_tif('/vsigzip/' + Download.get_temp(file), 1)
+
+
+def test_Pipeline():
+    def check(value):
+        if value == 3:
+            raise ValueError('Bad value')
+        return None if value == 4 else value
+
+    pipeline = Pipeline([('negative', np.negative, 'thread', 2),
+                         ('absolute', abs, 'process', 2),
+                         ('check', check, 'thread', 1)], maxsize=1)
+    assert sorted(pipeline.run(range(-10, 0))) == [
+        1, 2, 5, 6, 7, 8, 9, 10]
+    assert [(name, item) for name, item, err in pipeline.errors] == [('check', 3)]
+
+    with pytest.raises(ValueError, match=r"Unknown .*"):
+        Pipeline([('negative', np.negative, 'gpu', 2)])
+
+
+def test_Progress():
+    progress = Progress(4, is_print=False)
+    pipeline = Pipeline([('download', lambda task: dict(task, nbytes=1024), 'thread', 2),
+                         ('save', lambda task: task if task['i'] > 0 else None,
+                          'thread', 1)],
+                        progress=progress)
+    pipeline.run({'i': i} for i in range(4))
+
+    info = progress.get()
+    assert info['files'] == 4
+    assert info['nbytes'] == 4 * 1024
+    assert info['eta'] == 0.
+    assert sorted(info['stages'].keys()) == ['download', 'save']
+    assert info['stages']['download']['count'] == 4
+    assert '4/4 files' in progress.format()
+
+
+def test_Metrics(tmp_path):
+    def download(task):
+        with Metrics.timer(task, 'transfer'):
+            task['nbytes'] = 1024
+        if task['i'] == 0:
+            task['cache_hit'] = True
+            return None
+        if task['i'] == 1:
+            raise IOError('Connection lost')
+        return task
+
+    def save(task):
+        with Metrics.timer(task, 'write'):
+            task['nbytes_out'] = 100
+        return task
+
+    metrics = Metrics('CHIRPS', {'datatype': 'daily'},
+                      jsonl=str(tmp_path / 'metrics.jsonl'),
+                      textfile=str(tmp_path))
+    pipeline = Pipeline([('download', download, 'thread', 2),
+                         ('save', save, 'thread', 1)], metrics=metrics)
+    pipeline.run({'i': i} for i in range(4))
+
+    info = metrics.get()
+    assert info['files'] == 3
+    assert info['errors'] == 1
+    assert info['cache_hits'] == 1
+    assert info['nbytes_in'] == 4 * 1024
+    assert info['nbytes_out'] == 2 * 100
+    assert info['stages']['transfer']['count'] == 4
+    assert info['stages']['write']['count'] == 2
+    assert info['stages']['download']['count'] == 4
+
+    metrics.close()
+    lines = (tmp_path / 'metrics.jsonl').read_text().splitlines()
+    assert len(lines) == 4 + 2 + 1
+    assert '"type": "summary"' in lines[-1]
+    text = (tmp_path / 'wa_collect_CHIRPS_daily.prom').read_text()
+    assert 'wa_collect_files{datatype="daily",product="CHIRPS"} 3.0' in text
+    assert 'wa_collect_stage_seconds{datatype="daily",product="CHIRPS",' \
+           'stage="write"}' in text
+
+
+def test_Ledger(tmp_path):
+    def download(task):
+        task['nbytes'] = 1024
+        if task['Date'].day == 2:
+            raise IOError('File not found')
+        return task
+
+    file = str(tmp_path / 'collect.sqlite')
+    dates = pd.date_range('2003-01-01', '2003-01-05')
+
+    ledger = Ledger('CHIRPS', {'datatype': 'daily'}, file=file)
+    assert ledger.claim(dates) == list(dates)
+    # Dates of a live run are not claimed twice
+    assert Ledger('CHIRPS', {'datatype': 'daily'}, file=file).claim(dates) == []
+    pipeline = Pipeline([('download', download, 'thread', 2)], ledger=ledger)
+    pipeline.run({'Date': Date} for Date in dates[:4])
+    ledger.close()
+
+    # The failed date and the date of the killed run are retried
+    ledger = Ledger('CHIRPS', {'datatype': 'daily'}, file=file, attempts=2)
+    info = ledger.get()
+    assert (info['done'], info['failed'], info['planned']) == (3, 1, 1)
+    assert info['nbytes'] == 4 * 1024
+    assert ledger.get_failed()[0][1:] == (1, "OSError('File not found')")
+    assert ledger.claim(dates) == [dates[1], dates[4]]
+    ledger.update({'Date': dates[1], 'error': IOError('File not found')},
+                  is_done=True)
+    ledger.close()
+    assert Ledger('CHIRPS', {'datatype': 'daily'}, file=file,
+                  attempts=2).claim(dates) == [dates[4]]
+    # Other labels have other tasks, a disabled ledger claims all dates
+    assert Ledger('CHIRPS', {'datatype': 'monthly'}, file=file).claim(
+        dates[:2]) == list(dates[:2])
+    assert Ledger('CHIRPS', file='').claim(dates) == list(dates)
+
+
+def test_Trace(tmp_path):
+    def download(task):
+        with Metrics.timer(task, 'transfer'):
+            task['value'] = -task['i']
+        return task['value']
+
+    assert Trace.get_active() is None
+    trace = Trace('CHIRPS', {'datatype': 'daily'}, file=str(tmp_path)).start()
+    pipeline = Pipeline([('download', download, 'thread', 2),
+                         ('absolute', abs, 'process', 2)])
+    pipeline.run({'i': i, 'Date': datetime.date(2003, 1, i + 1)} for i in range(3))
+    Download.map(abs, [-1, -2], 'process', 2)
+    file = trace.stop()
+    assert Trace.get_active() is None
+
+    with open(file) as fp:
+        events = json.load(fp)['traceEvents']
+    spans = [event for event in events if event['ph'] == 'X']
+    names = sorted(set(event['name'] for event in spans))
+    assert names == ['abs', 'absolute', 'download', 'transfer']
+    assert len([event for event in spans if event['name'] == 'abs']) == 3 + 2
+    transfer = [event for event in spans if event['name'] == 'transfer'][0]
+    assert transfer['args']['product'] == 'CHIRPS'
+    assert transfer['args']['date'].startswith('2003-01-0')
+    # spans of the process workers are on their own lanes
+    assert len(set(event['pid'] for event in spans)) > 1
+    thread_names = [event['args']['name'] for event in events
+                    if event['name'] == 'thread_name']
+    assert 'download-0' in thread_names or 'download-1' in thread_names
+
+    # disabled, spans are a shared no-op
+    assert Trace.span('download') is Trace.span('save')
+
+
+def test_Planner(ftp_server, tmp_path, monkeypatch):
+    dates = [datetime.date(2003, 1, 1), datetime.date(2003, 1, 2)]
+    populate(ftp_server.server.root, 'CHIRPS', 'Precipitation', 'v2', 'daily',
+             dates, b'x' * 1000)
+    monkeypatch.setenv('WA_URL_CHIRPS', ftp_server.url)
+    (tmp_path / 'P_CHIRPS.v2.0_mm-day-1_daily_2003.01.03.tif').write_bytes(b'')
+
+    metrics = Metrics('CHIRPS', {'datatype': 'daily'},
+                      jsonl=str(tmp_path / 'metrics.jsonl'))
+    metrics.record({'nbytes_out': 400}, 'download', 1., nbytes=1000, files=1)
+    metrics.close()
+
+    planner = Planner('CHIRPS', 'Precipitation', 'v2', 'daily',
+                      latlim=[-10, 30], lonlim=[-20, -10],
+                      Startdate='2003-01-01', Enddate='2003-01-04',
+                      folder=str(tmp_path), history=str(tmp_path / 'metrics.jsonl'))
+    plan = planner.plan()
+    assert (plan['tasks'], plan['satisfied'], plan['todo']) == (4, 1, 3)
+    # the 2003-01-04 file is not on the server, it counts as the mean size
+    assert plan['remote_unknown'] == 1
+    assert plan['remote_nbytes'] == 3 * 1000
+    assert plan['output_estimate'] == 'history'
+    assert plan['output_nbytes'] == 3 * 400
+    assert plan['seconds'] > 0.
+    assert '3 to do' in planner.format(plan)
+
+    plan = Planner('CHIRPS', 'Precipitation', 'v2', 'daily',
+                   latlim=[-10, 30], lonlim=[-20, -10],
+                   Startdate='2003-01-01', Enddate='2003-01-04',
+                   history='').plan(is_remote=False)
+    # uint16 encoded output
+    assert plan['output_nbytes'] == 4 * 800 * 200 * 2
+    assert plan['seconds'] is None
+
+    with pytest.raises(ValueError, match=r"Date .* out of range .*"):
+        Planner('ALEXI', 'Evaporation', 'v1', 'daily',
+                Startdate='2004-12-31', Enddate='2005-01-10')
+    with pytest.raises(KeyError, match=r".*not found.*"):
+        Planner('CFSR', 'Radiation', 'v2', 'monthly')
+
+
+def test_Job(tmp_path):
+    conf = {
+        'output': str(tmp_path),
+        'regions': {
+            'nile': {'latlim': [-5, 32], 'lonlim': [21, 48]},
+            'volta': {'latlim': [5, 15], 'lonlim': [-6, 2]}
+        },
+        'products': [
+            {'product': 'CHIRPS', 'dataset': 'Precipitation', 'version': 'v2',
+             'datatype': 'daily', 'Startdate': '2003-01-01', 'Enddate': '2003-01-10'},
+            {'product': 'CHIRPS', 'dataset': 'Precipitation', 'version': 'v2',
+             'datatype': 'daily', 'regions': ['volta'],
+             'Startdate': '2003-01-05', 'Enddate': '2003-01-20'}
+        ]
+    }
+    folder = tmp_path / 'nile' / 'Precipitation' / 'CHIRPS' / 'Daily'
+    folder.mkdir(parents=True)
+    (folder / 'P_CHIRPS.v2.0_mm-day-1_daily_2003.01.03.tif').write_bytes(b'')
+
+    groups = Job(conf).plan()
+    assert len(groups) == 1
+    group = groups[0]
+    assert sorted(group['regions']) == ['nile', 'volta']
+    assert group['tasks'] == 10 + 10 + 16
+    assert group['todo'] == 9 + 10 + 16
+    # the remote files of the overlapping dates and regions are shared
+    assert group['files'] == 20
+    assert group['shared'] == 9
+    assert [(s.day, e.day) for s, e in group['ranges']] == [(1, 20)]
+    assert '20 files, 9 shared' in Job(conf).format(groups)
+
+    dates = pd.to_datetime(['2003-01-01', '2003-02-01', '2003-04-01'])
+    assert len(Job.get_ranges(dates, 'MS')) == 2
+
+    with pytest.raises(KeyError, match=r".*has no runner.*"):
+        Job({'products': [{'product': 'ALEXI', 'datatype': 'daily'}]})
+    with pytest.raises(KeyError, match=r"Region .* not found.*"):
+        Job(dict(conf, products=[dict(conf['products'][0], regions=['nil'])]))
+
+    # the regions are clipped from the union with the encoding of the group
+    key = Job.get_group(conf['products'][0])
+    encoding = GIS.get_encoding('CHIRPS', 'Precipitation', 'v2', 'daily', 'P')
+    assert Job.get_encoding(key) == encoding
+    staging = tmp_path / '.staging'
+    staging.mkdir()
+    gis = GIS(str(tmp_path), is_status=False)
+    gis.save_tif(str(staging / 'P.tif'), np.full((40, 60), 1.5),
+                 [-10., 1., 0., 35., 0., -1.], 'WGS84', encoding)
+    regions = {name: dict(region, Dir=str(tmp_path / 'clip' / name))
+               for name, region in conf['regions'].items()}
+    Job(conf).clip(str(staging), regions, key)
+    f, lock = gis.open_tif(str(tmp_path / 'clip' / 'volta' / 'P.tif'))
+    assert f.GetRasterBand(1).GetScale() == encoding['scale']
+    assert np.allclose(gis.get_tif(str(tmp_path / 'clip' / 'volta' / 'P.tif')),
+                       1.5)
+
+
+def test_Sync(ftp_server, http_server, tmp_path, monkeypatch):
+    today = pd.Timestamp('today').normalize()
+    dates = pd.date_range(today - pd.Timedelta(days=5), today - pd.Timedelta(days=1))
+    for server in (ftp_server, http_server):
+        populate(server.server.root, 'CHIRPS', 'Precipitation', 'v2', 'daily',
+                 dates, b'x' * 1000)
+    monkeypatch.setenv('WA_URL_CHIRPS', ftp_server.url)
+    folder = tmp_path / 'Daily'
+    folder.mkdir()
+
+    sync = Sync(str(tmp_path / 'sync.json'))
+    planner = sync.get_planner('CHIRPS', 'Precipitation', 'v2', 'daily', None,
+                               [-10, 30], [-20, -10], dates[0], str(folder))
+    tasks = sync.discover(planner)
+    assert [task['Date'] for task in tasks] == list(dates)
+    # one listing for the published dates, cached for the next discovery
+    requests = ftp_server.faults.counters['requests']
+    assert requests < 10
+    assert len(sync.discover(planner)) == len(dates)
+    assert ftp_server.faults.counters['requests'] == requests
+
+    for task in tasks[:3] + tasks[4:]:
+        open(task['local'], 'wb').close()
+    assert sync.update(planner) == dates[2]
+    sync.save()
+
+    # the next sync plans from the mark, the failed date is retried
+    sync = Sync(str(tmp_path / 'sync.json'))
+    planner = sync.get_planner('CHIRPS', 'Precipitation', 'v2', 'daily', None,
+                               [-10, 30], [-20, -10], dates[0], str(folder))
+    assert planner.Startdate == dates[3]
+    assert [task['Date'] for task in sync.discover(planner)] == [dates[3]]
+    open(sync.discover(planner)[0]['local'], 'wb').close()
+    assert sync.update(planner) == dates[-1]
+
+    # HTTP index
+    listing = Sync(ttl=0).list_dir(http_server.url, planner.get_tasks()[0][
+        'remote'].rsplit('/', 1)[0] + '/')
+    assert 'chirps-v2.0.{}.tif.gz'.format(dates[0].strftime('%Y.%m.%d')) in listing
+
+
+def test_SubsetServer(tmp_path):
+    gis = GIS(str(tmp_path), is_status=False)
+    folder = tmp_path / 'Precipitation' / 'CHIRPS' / 'Daily'
+    folder.mkdir(parents=True)
+    geo = [-20., 0.05, 0., 30., 0., -0.05]
+    for day in range(1, 4):
+        data = np.full((800, 200), float(day), dtype=np.float32)
+        data[0, 0] = -9999
+        gis.save_tif(str(folder / 'P_CHIRPS.v2.0_mm-day-1_daily_2003.01.{:02d}.tif'
+                         .format(day)), data, geo, 'WGS84')
+
+    with SubsetServer(str(tmp_path)) as server:
+        url = server.url + '/subset?product=CHIRPS&datatype=daily&variable=P' \
+            '&latlim=20,30&lonlim=-20,-15&Startdate=2003-01-01&Enddate=2003-01-05'
+        cache = GIS.get_tif_cache()
+        with urllib.request.urlopen(url + '&format=nc') as fp:
+            body = fp.read()
+        from netCDF4 import Dataset
+        with Dataset('subset.nc', memory=body) as fh:
+            assert fh['P'].shape == (3, 200, 100)
+            assert np.ma.is_masked(fh['P'][0, 0, 0])
+            assert np.allclose(fh['P'][:, 1, 1], [1., 2., 3.])
+            assert np.allclose(fh['lat'][0], 29.975)
+
+        with urllib.request.urlopen(url + '&format=tif') as fp:
+            assert fp.headers['Content-Type'] == 'image/tiff'
+            assert len(fp.read()) > 0
+        # the handles of the check and of the first request are reused
+        assert GIS.get_tif_cache()['opens'] - cache['opens'] == 3
+        assert GIS.get_tif_cache()['hits'] - cache['hits'] == 3 + 3 + 3
+
+        with urllib.request.urlopen(server.url + '/products') as fp:
+            assert [p['datatype'] for p in json.loads(fp.read())] == ['daily']
+        with pytest.raises(urllib.error.HTTPError, match=r".*400.*"):
+            urllib.request.urlopen(server.url + '/subset?product=CHIRP')
+
+        # a window of another grid is rejected before the response starts
+        gis.save_tif(str(folder / 'P_CHIRPS.v2.0_mm-day-1_daily_2003.01.03.tif'),
+                     np.ones((400, 100)), [-20., 0.1, 0., 30., 0., -0.1], 'WGS84')
+        with pytest.raises(urllib.error.HTTPError, match=r".*400.*"):
+            urllib.request.urlopen(url + '&format=tif')
+        with urllib.request.urlopen(url.replace('2003-01-05', '2003-01-02')) as fp:
+            assert len(fp.read()) > 0
+
+
+def test_CFSR_Save_vars(tmp_path):
+    download = Download('', '', is_status=False)
+    geo = [-20., 0.3125, 0., 30., 0., -0.3125]
+    names = ['dlwsfc', 'dswsfc']
+    months = {'201101': {'days': 2, 'count': 0, 'geo': geo, 'means': {}}}
+    args = [download, str(tmp_path), None, names, 2, set(months)]
+    (tmp_path / 'Monthly').mkdir()
+
+    for day, value in [(1, 100.), (2, 300.)]:
+        data = {var: np.full((4, 3), value * (i + 1)) for i, var in enumerate(names)}
+        task = CFSR.Save_vars({'Date': pd.Timestamp(2011, 1, day), 'args': args,
+                               'data': data, 'geo': geo}, months)
+    assert len(task['output']) == 2 + 2
+    assert months['201101']['count'] == 2
+
+    mean = download.get_tif(str(tmp_path / 'Monthly' /
+                                'DSWR_CFSRv2_W-m2_2011.01.01.tif'), 1)
+    assert np.allclose(mean, 400.)
+
+
+def test_CFSR_Save_vars_clip(tmp_path, monkeypatch):
+    file = str(tmp_path / 'basin.geojson')
+    with open(file, 'w') as fp:
+        json.dump({'type': 'Polygon', 'coordinates': [
+            [[-19.9, 29.9], [-19.1, 29.9], [-19.1, 29.1], [-19.9, 29.1]]]}, fp)
+    monkeypatch.setenv('WA_CLIP', file)
+
+    download = Download('', '', is_status=False)
+    geo = [-20., 0.3125, 0., 30., 0., -0.3125]
+    names = ['dlwsfc']
+    (tmp_path / 'Monthly').mkdir()
+
+    def save(months, day, value):
+        args = [download, str(tmp_path), None, names, 2, set(months)]
+        data = None if value is None else {'dlwsfc': np.full((4, 3), value)}
+        CFSR.Save_vars({'Date': pd.Timestamp(2011, 1, day), 'args': args,
+                        'data': data, 'geo': geo}, months)
+
+    save({}, 1, 100.)
+    # a resumed month reads the clipped output of day 1 back
+    months = {'201101': {'days': 2, 'count': 0, 'geo': geo, 'means': {}}}
+    save(months, 1, None)
+    save(months, 2, 300.)
+
+    name = str(tmp_path / 'Monthly' / 'DLWR_CFSRv2_W-m2_2011.01.01.tif')
+    assert download.get_tif_info(name)[2:] == (3, 3)
+    assert np.allclose(download.get_tif(name, 1), 200.)
+
+
+def test_CFSR_Get_window():
+    windows = {1: 'CFSR', 2: 'CFSRv2'}
+    assert CFSR.Get_window(pd.Timestamp('2010-12-31'), windows, 1) == 'CFSR'
+    assert CFSR.Get_window(pd.Timestamp('2011-01-01'), windows, 1) == 'CFSRv2'
+    assert CFSR.Get_window(pd.Timestamp('2011-01-01'), windows, 2) == 'CFSRv2'
+
+
+def test_CFSR_Read_6hourly(tmp_path):
+    download = Download('', '', is_status=False)
+    file = str(tmp_path / 'dlwsfc.grb2')
+    data = np.arange(24.).reshape(4, 6)
+    download.save_tif(file, data, [0., 60., 0., 90., 0., -45.], 'WGS84')
+
+    files = GIS.get_tif_cache()['files']
+    transform = Transform.from_conf('CFSR', 'Radiation', 'v2', 'daily', 'dlwsfc')
+    result = CFSR.Read_6hourly(download, file, [1] * 4, (4, 6), (1, 3), (0, 2),
+                               transform)
+    assert np.allclose(result, np.roll(data, 3, axis=1)[1:3, 0:2])
+    # the decode workers keep no handle to the removed grib file
+    assert GIS.get_tif_cache()['files'] == files
+
+
+def test_ALEXI_daily_file(ftp_server, tmp_path, monkeypatch):
+    # one row of the global grid, in MJ/m2d, repeated to the grid shape
+    raw = (np.arange(7200) * 2.45).astype('<f4')
+    populate(ftp_server.server.root, 'ALEXI', 'Evaporation', 'v1', 'daily',
+             [datetime.date(2005, 1, 1)], gzip.compress(raw.tobytes()))
+    monkeypatch.setenv('WA_URL_ALEXI', ftp_server.url)
+
+    output_folder = tmp_path / 'Daily'
+    output_folder.mkdir()
+    download = Download('', 'FTP_WA', is_status=False)
+    geo = [-179.5, 0.05, 0., 89.75, 0., -0.05]
+    args = [download, str(output_folder), (5, 7), (10, 13), geo, 'daily']
+    task = ALEXI.ALEXI_daily_file(pd.Timestamp('2005-01-01'), args)
+    assert task['nbytes'] > 0
+    assert 'error' not in task
+
+    name = str(output_folder / 'ETa_ALEXI_CSFR_mm-day-1_daily_2005.01.01.tif')
+    assert np.allclose(download.get_tif(name, 1), [[10., 11., 12.]] * 2)
+    assert download.get_tif_geo(name) == geo
+    assert os.listdir(str(output_folder)) == [os.path.basename(name)]
+
+
+def test_CMRSET_monthly_file(ftp_server, tmp_path, monkeypatch):
+    download = Download('', '', is_status=False)
+    file = str(tmp_path / 'M01CMRSETGlobalY2003M01.tif')
+    data = np.arange(24.).reshape(4, 6)
+    download.save_tif(file, data, [-180., 60., 0., 90., 0., -45.], 'WGS84')
+    populate(ftp_server.server.root, 'CMRSET', 'Evaporation', 'v1', 'monthly',
+             [datetime.date(2003, 1, 1)], file)
+    monkeypatch.setenv('WA_URL_CMRSET', ftp_server.url)
+
+    output_folder = tmp_path / 'Monthly'
+    output_folder.mkdir()
+    geo = [-120., 60., 0., 45., 0., -45.]
+    args = [download, str(output_folder), (1, 3), (1, 4), geo]
+    task = CMRSET.CMRSET_monthly_file(pd.Timestamp('2003-01-01'), args)
+
+    name = str(output_folder / 'ETa_CMRSET_mm-month-1_monthly_2003.01.01.tif')
+    assert task['nbytes'] == os.path.getsize(file)
+    assert np.allclose(download.get_tif(name, 1), data[1:3, 1:4])
+    assert download.get_tif_geo(name) == geo
+    assert os.listdir(str(output_folder)) == [os.path.basename(name)]
+
+    # a missing month is counted as an error, the done month as a cache hit
+    metrics = Metrics('CMRSET', {'datatype': 'monthly'})
+    Download.map(functools.partial(CMRSET.CMRSET_monthly_file, args=args),
+                 pd.date_range('2003-01-01', '2003-02-01', freq='MS'),
+                 metrics=metrics)
+    assert metrics.counters['files'] == 1
+    assert metrics.counters['errors'] == 1
+    assert metrics.counters['cache_hits'] == 1
+
+
+def test_servers(ftp_server, http_server, tmp_path, monkeypatch):
+    dates = [datetime.date(2003, 1, 1), datetime.date(2003, 1, 2)]
+    populate(ftp_server.server.root, 'CHIRPS', 'Precipitation', 'v2', 'daily',
+             dates, b'x' * 1000)
+    monkeypatch.setenv('WA_URL_CHIRPS', ftp_server.url)
+
+    # CHIRPS download stage from the stand-in FTP server
+    task = {'Date': dates[0], 'args': [None, str(tmp_path), 'daily', None, None, None]}
+    task = CHIRPS.Download_from_FTP(task)
+    assert task['nbytes'] == 1000
+    assert os.path.basename(task['file']) == 'chirps-v2.0.2003.01.01.tif.gz'
+
+    ftp_server.server.faults = Faults(drop=1.)
+    with pytest.raises(ftplib.error_temp):
+        CHIRPS.Download_from_FTP({'Date': dates[1], 'args': task['args']})
+    ftp_server.server.faults = Faults(missing=1.)
+    with pytest.raises(ftplib.error_perm):
+        CHIRPS.Download_from_FTP({'Date': dates[1], 'args': task['args']})
+
+    # byte range, latency and bandwidth of the stand-in HTTP server
+    paths = populate(http_server.server.root, 'CHIRPS', 'Precipitation', 'v2',
+                     'daily', dates, bytes(range(200)) * 50)
+    http_server.server.faults = Faults(latency=0.1, bandwidth=50000.)
+    request = urllib.request.Request(http_server.url + paths[0],
+                                     headers={'Range': 'bytes=10-19'})
+    assert urllib.request.urlopen(request).read() == bytes(range(10, 20))
+    assert len(urllib.request.urlopen(http_server.url + paths[0]).read()) == 10000
+    assert http_server.faults.counters['requests'] == 2
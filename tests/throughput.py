@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+**Throughput**
+
+`Description`
+
+End-to-end throughput of the product downloads against the local stand-in
+servers, under latency, bandwidth caps, dropped connections and missing files.
+
+The remote files are synthetic global inputs with the real shapes,
+see ``benchmarks/synthetic.py``. Only CHIRPS runs end to end offline,
+the other products need accounts or external converters.
+
+**Examples:**
+::
+
+    python tests/throughput.py --start 2003-01-01 --end 2003-01-31 --cores 4
+    python tests/throughput.py --latency 0.2 --bandwidth 2 --drop 0.1 --missing 0.05
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import pandas as pd
+
+__path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, __path)
+sys.path.insert(0, os.path.join(__path, '..'))
+
+from servers import Faults, Server, populate  # noqa: E402
+from benchmarks import synthetic  # noqa: E402
+
+from wateraccounting.Collect.products import CHIRPS  # noqa: E402
+
+# Conditions of the default run, name: Faults arguments
+conditions = {
+    'clean': {},
+    'latency': {'latency': 0.2},
+    'bandwidth': {'bandwidth': 2 * 1024 ** 2},
+    'drop': {'drop': 0.1},
+    'missing': {'missing': 0.1}
+}
+
+
+def run(root, folder, dates, faults, cores):
+    """Run CHIRPS daily against a stand-in FTP server
+
+    Returns:
+      dict: Counters of the server, files written, seconds and MB/s.
+    """
+    output = os.path.join(folder, 'output')
+    with Server(root, 'ftp', faults) as server:
+        os.environ['WA_URL_CHIRPS'] = server.url
+
+        t0 = time.time()
+        CHIRPS.DownloadData(output, dates[0], dates[-1],
+                            synthetic.latlim, synthetic.lonlim,
+                            0, cores, 'daily')
+        seconds = time.time() - t0
+
+    files = os.listdir(os.path.join(output, 'Precipitation', 'CHIRPS', 'Daily'))
+    shutil.rmtree(output)
+
+    result = dict(server.faults.counters)
+    result['files'] = len([file for file in files if file.startswith('P_CHIRPS')])
+    result['seconds'] = seconds
+    result['mbps'] = server.faults.counters['nbytes'] / 1024. ** 2 / seconds
+    return result
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('`Description`')[0])
+    parser.add_argument('--start', default='2003-01-01')
+    parser.add_argument('--end', default='2003-01-10')
+    parser.add_argument('--cores', type=int, default=4,
+                        help='workers of the pipeline, 0 runs serial')
+    parser.add_argument('--latency', type=float, help='seconds per command')
+    parser.add_argument('--bandwidth', type=float, help='MB/s per transfer')
+    parser.add_argument('--drop', type=float, help='fraction of dropped transfers')
+    parser.add_argument('--missing', type=float, help='fraction of missing files')
+    args = parser.parse_args(args)
+
+    runs = conditions
+    custom = {key: getattr(args, key)
+              for key in ['latency', 'bandwidth', 'drop', 'missing']
+              if getattr(args, key) is not None}
+    if custom:
+        if 'bandwidth' in custom:
+            custom['bandwidth'] *= 1024 ** 2
+        runs = {'custom': custom}
+
+    dates = pd.date_range(args.start, args.end, freq='D')
+    folder = tempfile.mkdtemp()
+    try:
+        root = os.path.join(folder, 'ftp')
+        os.makedirs(root)
+        populate(root, 'CHIRPS', 'Precipitation', 'v2', 'daily', dates,
+                 synthetic.chirps_tif_gz(folder))
+
+        print('{:10} {:>6} {:>9} {:>8} {:>8} {:>6} {:>8}'.format(
+            'condition', 'files', 'MB', 'seconds', 'MB/s', 'drops', 'missing'))
+        for name, kwargs in runs.items():
+            result = run(root, folder, dates, Faults(**kwargs), args.cores)
+            print('{:10} {:>6} {:>9.1f} {:>8.2f} {:>8.2f} {:>6} {:>8}'.format(
+                name, '{}/{}'.format(result['files'], len(dates)),
+                result['nbytes'] / 1024. ** 2, result['seconds'], result['mbps'],
+                result['drops'], result['missing']))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()